@@ -0,0 +1,207 @@
+import argparse
+import csv
+import os
+import sys
+import time
+
+from typing import List, Optional, Tuple
+
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy') # 音は鳴らさずにデコードだけ行う
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import pygame
+
+try:
+    import numpy as np
+    import pygame.sndarray
+except ImportError:
+    print("エラー: 自動譜面生成には NumPy が必要です。'pip install numpy' を実行してください。")
+    sys.exit(1)
+
+#  自動譜面生成
+# 曲の音声を pygame.mixer.Sound / pygame.sndarray でデコードし、NumPy でまとめて解析して譜面 (beatmap.csv) を作る。
+# 1. 短時間フーリエ変換 (STFT) で対数振幅スペクトログラムを求め、
+#    各フレームでスペクトルが前フレームより増えた量の合計 (スペクトルフラックス) を音の立ち上がりの強さとする
+# 2. 立ち上がりの強さの自己相関からテンポ (BPM) を推定し、ノーツの最小間隔 (1/4拍) を決める
+# 3. 移動平均より十分大きい極大を音の立ち上がり (オンセット) として取り出し、ノーツにする
+# 4. レーンは立ち上がりの瞬間の音の高さ (スペクトル重心) で決める (低い音ほど左のレーン)
+# 5. 立ち上がり後も音量が保たれている場合はロングノーツにする
+# ループは全フレームに対してではなく、取り出したノーツ (数百個) に対してだけ行う。
+
+SONG_FILE = 'maou_short_14_shining_star.mp3'
+OUTPUT_CSV_FILE = 'beatmap.csv'
+LANE_COUNT: int = 4
+
+FRAME_SIZE: int = 2048 # STFTの窓の長さ (サンプル数)
+HOP_SIZE: int = 512 # STFTの窓をずらす間隔 (サンプル数)。44.1kHz で約11.6ms
+STFT_BATCH_FRAMES: int = 1024 # STFTを一度に計算するフレーム数 (メモリ使用量の上限を決める)
+LOG_COMPRESSION: float = 100.0 # 対数振幅 log(1 + C * 振幅) の C
+THRESHOLD_WINDOW_MS: float = 500.0 # オンセット判定の移動平均をとる範囲
+PEAK_WINDOW_MS: float = 50.0 # この範囲で最大の点だけを極大とみなす
+DEFAULT_SENSITIVITY: float = 0.1 # 移動平均にこれ (正規化した強さ) を足した値を超えた極大をオンセットとする
+MIN_BPM: float = 70.0 # 推定するテンポの範囲
+MAX_BPM: float = 200.0
+BEAT_SUBDIVISION: int = 4 # ノーツの最小間隔を 1/BEAT_SUBDIVISION 拍にする
+LONG_NOTE_MIN_MS: int = 400 # これ以上音量が保たれたらロングノーツにする
+SUSTAIN_RATIO: float = 0.6 # 立ち上がり時の音量に対して、この割合以上が保たれている間を「続いている」とみなす
+LONG_NOTE_RELEASE_GAP_MS: int = 100 # ロングノーツの終わりから、次のノーツまでに空ける時間
+
+# 1つのノーツ: (開始時間, レーン) または (開始時間, レーン, 終了時間)
+NoteRow = Tuple[int, ...]
+
+
+def load_audio(path: str) -> Tuple[np.ndarray, int]:
+    """音声ファイルをデコードし、モノラルの float32 サンプル列 (-1.0〜1.0) とサンプリング周波数を返します。"""
+    if not pygame.mixer.get_init():
+        pygame.mixer.init()
+    sample_rate, bit_format, _ = pygame.mixer.get_init()
+    samples = pygame.sndarray.array(pygame.mixer.Sound(path))
+    if samples.ndim == 2:
+        samples = samples.mean(axis=1) # ステレオは左右の平均をとる
+    scale = float(2 ** (abs(bit_format) - 1)) if bit_format < 0 else float(2 ** (bit_format - 1))
+    return samples.astype(np.float32) / scale, sample_rate
+
+
+def spectrogram(samples: np.ndarray) -> np.ndarray:
+    """ハン窓をかけた STFT の対数振幅スペクトログラム (フレーム数 × 周波数ビン数) を返します。"""
+    if len(samples) < FRAME_SIZE:
+        samples = np.pad(samples, (0, FRAME_SIZE - len(samples)))
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME_SIZE)[::HOP_SIZE] # コピーなしのビュー
+    window = np.hanning(FRAME_SIZE).astype(np.float32)
+    spec = np.empty((len(frames), FRAME_SIZE // 2 + 1), dtype=np.float32)
+    # 窓をかけたフレームのコピーが大きくならないよう、STFT_BATCH_FRAMES フレームずつまとめて変換する
+    for start in range(0, len(frames), STFT_BATCH_FRAMES):
+        batch = frames[start:start + STFT_BATCH_FRAMES] * window
+        spec[start:start + len(batch)] = np.log1p(LOG_COMPRESSION * np.abs(np.fft.rfft(batch, axis=1)))
+    return spec
+
+
+def spectral_flux(spec: np.ndarray) -> np.ndarray:
+    """各フレームのスペクトルフラックス (前フレームから増えた振幅の合計) を、最大値が1になるよう正規化して返します。"""
+    flux = np.maximum(np.diff(spec, axis=0), 0.0).sum(axis=1)
+    flux = np.concatenate(([0.0], flux))
+    peak = flux.max()
+    return flux / peak if peak > 0 else flux
+
+
+def estimate_tempo(flux: np.ndarray, frame_ms: float) -> float:
+    """スペクトルフラックスの自己相関が最大になる周期から、テンポ (BPM) を推定します。"""
+    centered = flux - flux.mean()
+    size = 1 << int(np.ceil(np.log2(2 * len(centered))))
+    spectrum = np.fft.rfft(centered, size)
+    autocorr = np.fft.irfft(spectrum * np.conj(spectrum), size)[:len(centered)] # FFTで自己相関をまとめて計算する
+    min_lag = max(1, int(round(60000.0 / MAX_BPM / frame_ms)))
+    max_lag = min(len(autocorr) - 1, int(round(60000.0 / MIN_BPM / frame_ms)))
+    if max_lag <= min_lag:
+        return 120.0
+    lag = min_lag + int(np.argmax(autocorr[min_lag:max_lag + 1]))
+    return 60000.0 / (lag * frame_ms)
+
+
+def moving_average(values: np.ndarray, width: int) -> np.ndarray:
+    """中心を揃えた移動平均を返します (累積和を使うので、幅に関係なく O(n))。"""
+    width = max(1, width)
+    padded = np.pad(values, (width // 2, width - 1 - width // 2), mode='edge')
+    cumsum = np.concatenate(([0.0], np.cumsum(padded)))
+    return (cumsum[width:] - cumsum[:-width]) / width
+
+
+def pick_onsets(flux: np.ndarray, frame_ms: float, sensitivity: float, min_interval_ms: float) -> np.ndarray:
+    """スペクトルフラックスからオンセットのフレーム番号を取り出します。"""
+    peak_width = max(1, int(PEAK_WINDOW_MS / frame_ms))
+    local_max = np.lib.stride_tricks.sliding_window_view(
+        np.pad(flux, peak_width, mode='constant'), 2 * peak_width + 1).max(axis=1)
+    threshold = moving_average(flux, int(THRESHOLD_WINDOW_MS / frame_ms)) + sensitivity
+    candidates = np.flatnonzero((flux >= local_max) & (flux > threshold))
+
+    # 最小間隔より近いオンセットは、先のものだけを残す (候補は数百個なので、ここは1つずつ見る)
+    min_interval_frames = min_interval_ms / frame_ms
+    onsets: List[int] = []
+    for frame in candidates:
+        if not onsets or frame - onsets[-1] >= min_interval_frames:
+            onsets.append(int(frame))
+    return np.array(onsets, dtype=np.int64)
+
+
+def assign_lanes(spec: np.ndarray, onsets: np.ndarray) -> np.ndarray:
+    """オンセットの瞬間のスペクトル重心 (音の高さ) の分位点でレーンを決めます (低い音ほど左のレーン)。"""
+    if len(onsets) == 0:
+        return np.zeros(0, dtype=np.int64)
+    frames = spec[onsets]
+    bins = np.arange(spec.shape[1], dtype=np.float32)
+    centroids = (frames * bins).sum(axis=1) / np.maximum(frames.sum(axis=1), 1e-9)
+    boundaries = np.quantile(centroids, np.linspace(0, 1, LANE_COUNT + 1)[1:-1])
+    return np.searchsorted(boundaries, centroids)
+
+
+def sustain_ends(energy: np.ndarray, onsets: np.ndarray) -> np.ndarray:
+    """
+    各オンセットから、音量が立ち上がり時の SUSTAIN_RATIO 倍を下回るまで (最長で次のオンセットまで) のフレーム番号を返します。
+    """
+    ends = np.empty(len(onsets), dtype=np.int64)
+    next_onsets = np.append(onsets[1:], len(energy))
+    for i, (start, limit) in enumerate(zip(onsets, next_onsets)):
+        below = np.flatnonzero(energy[start:limit] < energy[start] * SUSTAIN_RATIO)
+        ends[i] = start + below[0] if len(below) else limit
+    return ends
+
+
+def generate_beatmap(samples: np.ndarray, sample_rate: int, sensitivity: float = DEFAULT_SENSITIVITY) -> Tuple[List[NoteRow], float]:
+    """音声のサンプル列から譜面のノーツと推定したテンポ (BPM) を返します。"""
+    frame_ms = HOP_SIZE * 1000.0 / sample_rate
+    spec = spectrogram(samples)
+    flux = spectral_flux(spec)
+    bpm = estimate_tempo(flux, frame_ms)
+    onsets = pick_onsets(flux, frame_ms, sensitivity, 60000.0 / bpm / BEAT_SUBDIVISION)
+    lanes = assign_lanes(spec, onsets)
+    energy = spec.mean(axis=1)
+    ends = sustain_ends(energy, onsets)
+
+    # フレーム番号を、窓の中心の時刻 (ms) に変換する
+    offset_ms = FRAME_SIZE / 2 * 1000.0 / sample_rate
+    start_times = np.rint(onsets * frame_ms + offset_ms).astype(np.int64)
+    end_times = np.rint(ends * frame_ms + offset_ms).astype(np.int64) - LONG_NOTE_RELEASE_GAP_MS
+
+    notes: List[NoteRow] = []
+    for start_ms, lane, end_ms in zip(start_times.tolist(), lanes.tolist(), end_times.tolist()):
+        if end_ms - start_ms >= LONG_NOTE_MIN_MS:
+            notes.append((start_ms, lane, end_ms))
+        else:
+            notes.append((start_ms, lane))
+    return notes, bpm
+
+
+def save_beatmap(path: str, notes: List[NoteRow]) -> None:
+    """ノーツを CSV 譜面に保存します (ノーツは開始時間順に並んでいる)。"""
+    with open(path, 'w', newline='') as f:
+        csv.writer(f).writerows(notes)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="曲の音声を解析して、譜面 (CSV) を自動で作成します。")
+    parser.add_argument('song', nargs='?', default=SONG_FILE, help=f"解析する音楽ファイル (既定: {SONG_FILE})")
+    parser.add_argument('-o', '--output', default=OUTPUT_CSV_FILE, help=f"保存する譜面ファイル (既定: {OUTPUT_CSV_FILE})")
+    parser.add_argument('--sensitivity', type=float, default=DEFAULT_SENSITIVITY,
+                        help=f"オンセット検出のしきい値。小さいほどノーツが増えます (既定: {DEFAULT_SENSITIVITY})")
+    args = parser.parse_args(argv)
+
+    wall_start = time.perf_counter()
+    try:
+        samples, sample_rate = load_audio(args.song)
+    except (pygame.error, FileNotFoundError) as e:
+        print(f"エラー: 音楽ファイル '{args.song}' を読み込めませんでした。{e}")
+        sys.exit(1)
+    notes, bpm = generate_beatmap(samples, sample_rate, args.sensitivity)
+    wall_s = time.perf_counter() - wall_start
+
+    if not notes:
+        print("ノーツが検出されなかったので、ファイルは作成されませんでした。--sensitivity を小さくしてみてください。")
+        sys.exit(1)
+    save_beatmap(args.output, notes)
+    long_count = sum(1 for note in notes if len(note) == 3)
+    print(f"譜面を'{args.output}'に保存しました。(ノーツ数: {len(notes)}, うちロングノーツ: {long_count},"
+          f" 推定テンポ: {bpm:.1f} BPM, 曲の長さ: {len(samples) / sample_rate:.1f} 秒, 処理時間: {wall_s:.2f} 秒)")
+
+
+if __name__ == '__main__':
+    main()
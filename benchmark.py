@@ -0,0 +1,261 @@
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+
+from typing import Dict, List, Optional, Tuple
+
+# 画面や音声デバイスが無い環境でも描画の計測ができるよう、ダミーのドライバを使う
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import pygame
+
+import rhythm_game
+from compile_beatmap import compiled_path_for
+
+#  ベンチマーク
+# ノーツ数の異なる合成譜面 (同時押し・ロングノーツを含む) を作り、ゲームの主要な処理の時間を計測して JSON に保存する。
+# 計測する処理:
+#   load_beatmap (CSVからのコンパイルと、コンパイル済み譜面の読み込み)、ロジックtick全体 (run_logic_ticks) と
+#   その中のノーツの生成 (generate_notes)・update_notes_position・update_timers、入力の判定全体 (apply_key_event) と
+#   その中の process_key_press・ロングノーツの押し終わり (process_key_release)、draw_notes
+# ゲームと同じく、1/60秒ごとのフレームで入力の判定 (handle_play_input) → ロジックtick (run_logic_ticks) → 描画 の順に進める。
+# ゲームの処理を書き写さずに GameSession のメソッドをそのまま呼び、時間はメソッドを包んで測るので、
+# ゲームループが変わればベンチマークもそのまま新しい処理を計測する。
+# 入力は全ノーツをちょうどのタイミングで押す自動入力なので、ノーツは全てヒットして処理される。
+
+DEFAULT_NOTE_COUNTS: List[int] = [1_000, 10_000, 100_000, 1_000_000]
+FRAME_MS: float = 1000.0 / 60 # 描画1フレームの間隔
+MAX_DRAW_SAMPLES: int = 20_000 # 1つの譜面で draw_notes を計測する最大回数 (大きな譜面ではフレームを間引く)
+
+SYNTHETIC_STEP_MS: Tuple[int, int] = (20, 60) # 次のノーツ (または同時押し) までの間隔の範囲
+SYNTHETIC_CHORD_WEIGHTS: List[int] = [60, 30, 10] # 1/2/3 レーン同時押しの割合
+SYNTHETIC_LONG_NOTE_RATIO: float = 0.15 # ロングノーツの割合
+SYNTHETIC_LONG_NOTE_MS: Tuple[int, int] = (200, 1200) # ロングノーツの長さの範囲
+SYNTHETIC_LANE_GAP_MS: int = 250 # 同じレーンで、前のノーツを離してから次のノーツまでの最小間隔
+
+
+def generate_synthetic_rows(note_count: int, seed: int = 0) -> List[Tuple[int, int, int]]:
+    """
+    合成譜面の (開始時間, レーン, 終了時間) を開始時間順に note_count 個作ります。
+    同時押しとロングノーツを含み、同じレーンのノーツが重ならないようにします。
+    """
+    rng = random.Random(seed)
+    lane_free_at = [0] * rhythm_game.LANE_COUNT # 各レーンに次のノーツを置ける時刻
+    rows: List[Tuple[int, int, int]] = []
+    current_ms = 2000
+    while len(rows) < note_count:
+        current_ms += rng.randint(*SYNTHETIC_STEP_MS)
+        free_lanes = [lane for lane in range(rhythm_game.LANE_COUNT) if lane_free_at[lane] <= current_ms]
+        if not free_lanes:
+            continue
+        chord_size = min(len(free_lanes), rng.choices([1, 2, 3], SYNTHETIC_CHORD_WEIGHTS)[0], note_count - len(rows))
+        for lane in sorted(rng.sample(free_lanes, chord_size)):
+            if rng.random() < SYNTHETIC_LONG_NOTE_RATIO:
+                end_ms = current_ms + rng.randint(*SYNTHETIC_LONG_NOTE_MS)
+                release_ms = end_ms
+            else:
+                end_ms = current_ms
+                release_ms = current_ms + rhythm_game.AUTOPLAY_TAP_MS
+            lane_free_at[lane] = release_ms + SYNTHETIC_LANE_GAP_MS
+            rows.append((current_ms, lane, end_ms))
+    return rows
+
+
+def write_beatmap_csv(path: str, rows: List[Tuple[int, int, int]]) -> None:
+    """合成譜面を beatmap.csv と同じ形式で書き出します (単発ノーツは2列)。"""
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for start, lane, end in rows:
+            writer.writerow((start, lane, end) if end > start else (start, lane))
+
+
+class PhaseTimer:
+    """処理ごとの呼び出し回数・合計時間・最大時間を集計する。"""
+    def __init__(self):
+        self.count: int = 0
+        self.total: float = 0.0
+        self.max: float = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            'calls': self.count,
+            'total_ms': round(self.total * 1000, 3),
+            'mean_us': round(self.total / self.count * 1e6, 3) if self.count else 0.0,
+            'max_us': round(self.max * 1e6, 3),
+        }
+
+
+def benchmark_load(csv_path: str) -> Dict[str, float]:
+    """CSVからのコンパイルを含む初回の読み込みと、コンパイル済み譜面の読み込みの時間 (ms) を計測します。"""
+    chart_path = compiled_path_for(csv_path)
+    if os.path.exists(chart_path):
+        os.remove(chart_path)
+    start = time.perf_counter()
+    rhythm_game.load_beatmap(csv_path)
+    compile_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    rhythm_game.load_beatmap(csv_path)
+    load_ms = (time.perf_counter() - start) * 1000
+    return {'compile_and_load_ms': round(compile_ms, 3), 'load_compiled_ms': round(load_ms, 3)}
+
+
+def time_method(session, name: str, timer: PhaseTimer) -> None:
+    """
+    session のメソッド name を、呼び出しごとの時間を timer に記録するラッパーに置き換えます。
+    インスタンスの属性として上書きするので、GameSession の中からの呼び出し (self.generate_notes など) も計測される。
+    """
+    method = getattr(session, name)
+    perf = time.perf_counter
+
+    def timed(*args):
+        start = perf()
+        try:
+            return method(*args)
+        finally:
+            timer.add(perf() - start)
+    setattr(session, name, timed)
+
+
+def benchmark_play(beatmap, draw: bool) -> Dict[str, Dict[str, float]]:
+    """
+    自動入力で譜面を最後までプレイし、フレームごとに各処理の時間を計測します。
+    入力とロジックtickはゲームのメインループと同じく handle_play_input と run_logic_ticks で進め、
+    各処理の時間は GameSession のメソッドを包んで測ります (外側の時間には内側の計測のわずかな時間も含まれる)。
+    """
+    perf = time.perf_counter
+    timers = {name: PhaseTimer() for name in
+              ('run_logic_ticks', 'generate_notes', 'update_notes_position', 'update_timers',
+               'apply_key_event', 'process_key_press', 'process_key_release', 'draw_notes')}
+    song_length_ms = rhythm_game.default_song_length_ms(beatmap)
+    clock = rhythm_game.VirtualClock(song_length_ms)
+    session = rhythm_game.GameSession(beatmap, clock)
+    for name in ('run_logic_ticks', 'generate_notes', 'update_notes_position', 'update_timers',
+                 'apply_key_event', 'process_key_press', 'process_key_release'):
+        time_method(session, name, timers[name])
+    clock.start()
+    inputs = rhythm_game.autoplay_inputs(beatmap)
+    input_index = 0
+    frame_count = int(song_length_ms / FRAME_MS) + 1
+    draw_every = max(1, frame_count // MAX_DRAW_SAMPLES)
+
+    frame = 0
+    wall_start = perf()
+    while session.game_state == rhythm_game.GAME_STATE_PLAYING:
+        frame_ms = frame * FRAME_MS
+        clock.advance_to(frame_ms)
+        # 1. 入力: このフレームまでに起きた入力を、その時刻までロジックを進めてから判定する
+        while input_index < len(inputs) and inputs[input_index][0] <= frame_ms:
+            time_ms, key, is_down = inputs[input_index]
+            input_index += 1
+            event = pygame.event.Event(pygame.KEYDOWN if is_down else pygame.KEYUP, key=key)
+            session.handle_play_input(event, time_ms)
+        # 2. 更新
+        session.run_logic_ticks(frame_ms)
+        # 3. 描画
+        if draw and frame % draw_every == 0:
+            t0 = perf()
+            rhythm_game.draw_notes(session, frame_ms)
+            timers['draw_notes'].add(perf() - t0)
+        frame += 1
+
+    results: Dict[str, Dict[str, float]] = {name: timer.to_dict() for name, timer in timers.items()}
+    results['play'] = {
+        'wall_ms': round((perf() - wall_start) * 1000, 3),
+        'song_ms': round(song_length_ms, 3),
+        'frames': frame,
+        'draw_every': draw_every,
+        **session.result(),
+    }
+    return results
+
+
+def git_commit() -> Optional[str]:
+    """現在のコミットのハッシュを返します (git が使えなければ None)。"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(previous: Dict, current: Dict) -> None:
+    """以前の計測結果と比べて、平均時間 (mean_us) の比を表示します。"""
+    print(f"比較: {previous.get('commit')} -> {current.get('commit')}")
+    for note_count, phases in current['results'].items():
+        old_phases = previous.get('results', {}).get(note_count)
+        if not old_phases:
+            continue
+        for name, stats in phases.items():
+            old_stats = old_phases.get(name, {})
+            if 'mean_us' in stats and old_stats.get('mean_us'):
+                ratio = stats['mean_us'] / old_stats['mean_us']
+                mark = "  <-- 遅くなった" if ratio > 1.2 else ""
+                print(f"  {note_count:>8} {name:<22} {old_stats['mean_us']:>10.2f} -> {stats['mean_us']:>10.2f} us (x{ratio:.2f}){mark}")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="合成譜面でゲームの主要な処理の時間を計測し、結果を JSON に保存します。")
+    parser.add_argument('--notes', type=int, nargs='+', default=DEFAULT_NOTE_COUNTS, help="譜面のノーツ数 (既定: 1000 10000 100000 1000000)")
+    parser.add_argument('--seed', type=int, default=0, help="合成譜面の乱数シード")
+    parser.add_argument('--no-draw', action='store_true', help="draw_notes を計測しません")
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help="結果の出力先 (既定: benchmark_results.json)")
+    parser.add_argument('--compare', default=None, help="以前の結果の JSON と比較して表示します")
+    args = parser.parse_args(argv)
+
+    draw = not args.no_draw
+    if draw:
+        pygame.display.init()
+        rhythm_game.screen = pygame.display.set_mode((rhythm_game.SCREEN_WIDTH, rhythm_game.SCREEN_HEIGHT))
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pygame': pygame.version.ver,
+        'platform': platform.platform(),
+        'video_driver': pygame.display.get_driver() if draw else None,
+        'seed': args.seed,
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory() as work_dir:
+        for note_count in args.notes:
+            print(f"{note_count} ノーツの譜面を計測中...")
+            csv_path = os.path.join(work_dir, f"synthetic_{note_count}.csv")
+            write_beatmap_csv(csv_path, generate_synthetic_rows(note_count, args.seed))
+            results = {'load_beatmap': benchmark_load(csv_path)}
+            results.update(benchmark_play(rhythm_game.load_beatmap(csv_path), draw))
+            report['results'][str(note_count)] = results
+            for name, stats in results.items():
+                if 'mean_us' in stats:
+                    print(f"  {name:<22} {stats['calls']:>9} 回  平均 {stats['mean_us']:>9.2f} us  最大 {stats['max_us']:>10.2f} us")
+            print(f"  load_beatmap           コンパイル {results['load_beatmap']['compile_and_load_ms']:.1f} ms"
+                  f" / 読み込み {results['load_beatmap']['load_compiled_ms']:.2f} ms")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果を '{args.output}' に保存しました。")
+
+    if args.compare:
+        try:
+            with open(args.compare, 'r', encoding='utf-8') as f:
+                compare_results(json.load(f), report)
+        except (OSError, ValueError) as e:
+            print(f"警告: 比較する結果を読み込めませんでした。{e}")
+
+
+if __name__ == '__main__':
+    main()
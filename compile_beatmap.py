@@ -0,0 +1,336 @@
+import argparse
+import array
+import csv
+import itertools
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from operator import itemgetter
+
+from typing import Iterator, List, Optional, Tuple
+
+#  譜面コンパイラ
+# beatmap.csv を固定長のバイナリ譜面 (.chart) に変換し、mmap でコピーなしに読み込む
+#
+# ファイル形式 (全てリトルエンディアン):
+#   ヘッダ (32バイト): マジック b'RGBM', バージョン(uint16), レコード長(uint16), ノーツ数(uint32), CRC32(uint32),
+#                      コンパイル元のCSVのサイズ(uint64), 更新時刻ns(uint64)
+#   レコード (12バイト × ノーツ数): 開始時間ms(int32), レーン(int32), 終了時間ms(int32)
+#   レコードは開始時間順 (同時刻ならレーン順) に並ぶので、ゲーム側はそのままノーツの生成順として使い、二分探索できる
+# CRC32 はレコード部分全体に対して計算する
+# CSVのサイズと更新時刻がヘッダの値と違えば古い譜面として再コンパイルする (更新時刻の前後だけで比べると、
+# コンパイルと同じ時刻の単位内での編集や、git checkout などで古い更新時刻に戻ったCSVを見逃す)。
+# メモリ上でコンパイルした譜面では両方とも 0 になる
+#
+# BeatmapWatcher はプレイ中にCSV譜面の更新を監視し、変わった行だけを解析し直して譜面を作り直す (ホットリロード)
+
+CHART_MAGIC: bytes = b'RGBM'
+CHART_VERSION: int = 3 # 2: レコードを開始時間順に並べることを保証 / 3: コンパイル元のCSVのサイズと更新時刻を記録
+CHART_HEADER_FORMAT: str = '<4sHHIIQQ'
+CHART_HEADER_SIZE: int = struct.calcsize(CHART_HEADER_FORMAT)
+CHART_RECORD_FORMAT: str = '<iii'
+CHART_RECORD_SIZE: int = struct.calcsize(CHART_RECORD_FORMAT)
+CHART_FIELDS_PER_RECORD: int = 3
+COMPILED_CHART_EXTENSION: str = '.chart'
+LONG_NOTE_MIN_MS: int = 200 # 譜面を記録・整形するとき、これ以上押し続けた押下をロングノーツにする (短い押下は単発ノーツ)
+WATCH_POLL_INTERVAL_S: float = 0.25 # 譜面の更新を確認する間隔 (秒)
+
+NoteRow = Tuple[int, int, int] # (開始時間, レーン, 終了時間)
+SourceStamp = Tuple[int, int] # コンパイル元のCSVの (サイズ, 更新時刻ns)
+
+
+class BeatmapFormatError(ValueError):
+    """バイナリ譜面のヘッダやチェックサムが不正な場合に送出されます。"""
+
+
+def compiled_path_for(csv_path: str) -> str:
+    """CSV譜面に対応するコンパイル済み譜面のパスを返します (beatmap.csv -> beatmap.chart)。"""
+    return os.path.splitext(csv_path)[0] + COMPILED_CHART_EXTENSION
+
+
+def source_stamp(csv_path: str) -> SourceStamp:
+    """CSV譜面のサイズと更新時刻を返します。"""
+    stat = os.stat(csv_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def is_compiled_chart_stale(csv_path: str, chart_path: str) -> bool:
+    """
+    コンパイル済み譜面が存在しないか、古い形式か、ヘッダに記録したCSVのサイズ・更新時刻が今のCSVと違う場合に True を返します。
+    """
+    try:
+        with open(chart_path, 'rb') as f:
+            header = f.read(CHART_HEADER_SIZE)
+    except OSError:
+        return True
+    if len(header) < CHART_HEADER_SIZE:
+        return True
+    magic, version, _, _, _, source_size, source_mtime_ns = struct.unpack(CHART_HEADER_FORMAT, header)
+    if magic != CHART_MAGIC or version != CHART_VERSION:
+        return True
+    return (source_size, source_mtime_ns) != source_stamp(csv_path)
+
+
+def parse_csv_row(row: List[str]) -> Optional[NoteRow]:
+    """
+    CSV譜面の1行を (開始時間, レーン, 終了時間) に変換します。
+    2列の行は単発ノーツとして終了時間を開始時間と同じにします。列数が違う行は警告を表示して None を返します。
+    数値に変換できない場合は ValueError を送出します。
+    """
+    if len(row) == 2:
+        # 単発ノーツ: [開始時間, レーン] -> 終了時間を開始時間と同じにする
+        start = int(row[0])
+        return start, int(row[1]), start
+    elif len(row) == 3:
+        # ロングノーツ: [開始時間, レーン, 終了時間]
+        return int(row[0]), int(row[1]), int(row[2])
+    print(f"警告: 不正な譜面データ形式の行をスキップしました: {row}")
+    return None
+
+
+def read_csv_rows(path: str) -> Iterator[NoteRow]:
+    """
+    CSV譜面を1行ずつ読み、(開始時間, レーン, 終了時間) を返します。
+    数値に変換できない行があった場合は ValueError を送出します。
+    """
+    with open(path, 'r') as f:
+        for row in csv.reader(f):
+            note = parse_csv_row(row)
+            if note is not None:
+                yield note
+
+
+def encode_chart(values: array.array, stamp: SourceStamp = (0, 0)) -> bytes:
+    """
+    (開始時間, レーン, 終了時間) を並べた int32 配列を、ヘッダ付きのバイナリ譜面に変換します。
+    stamp にはコンパイル元のCSVの (サイズ, 更新時刻ns) を渡す (メモリ上だけで使う譜面では省略する)。
+    """
+    if values.itemsize != 4:
+        raise BeatmapFormatError("int32 の配列が必要です。")
+    if sys.byteorder != 'little':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    payload = values.tobytes()
+    header = struct.pack(CHART_HEADER_FORMAT, CHART_MAGIC, CHART_VERSION, CHART_RECORD_SIZE,
+                         len(values) // CHART_FIELDS_PER_RECORD, zlib.crc32(payload), *stamp)
+    return header + payload
+
+
+def compile_rows(rows: Iterator[Tuple[int, int, int]], stamp: SourceStamp = (0, 0)) -> bytes:
+    """
+    ノーツ行の列を、開始時間順 (同時刻ならレーン順) に並べ替えてバイナリ譜面のバイト列に変換します。
+    CSVは記録した順に行が並ぶので、手で追記した行などで順序が崩れていることがある。
+    stamp は encode_chart() と同じく、コンパイル元のCSVの (サイズ, 更新時刻ns)。
+    """
+    records = list(rows)
+    ordered = sorted(records, key=itemgetter(0, 1))
+    if ordered != records:
+        print("警告: 譜面の行が開始時間順に並んでいなかったため、並べ替えてコンパイルしました。")
+    return encode_chart(array.array('i', itertools.chain.from_iterable(ordered)), stamp)
+
+
+def compile_beatmap(csv_path: str, chart_path: Optional[str] = None) -> str:
+    """
+    CSV譜面をコンパイルしてバイナリ譜面ファイルを書き出し、そのパスを返します。
+    書き込み途中のファイルが読まれないよう、一時ファイルに書いてから置き換えます。
+    一時ファイルの名前はプロセスとスレッドごとに変えるので、同じ譜面を同時にコンパイルしても書き込みが混ざらない
+    (曲の先読みのスレッドプールなど。置き換えは後に終わった方が残るだけで、どちらも同じ内容)。
+    """
+    if chart_path is None:
+        chart_path = compiled_path_for(csv_path)
+    stamp = source_stamp(csv_path) # 読む前に取り、コンパイル中に更新された場合は次回コンパイルし直されるようにする
+    data = compile_rows(read_csv_rows(csv_path), stamp)
+    tmp_path = f"{chart_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'xb') as f:
+            f.write(data)
+        os.replace(tmp_path, chart_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return chart_path
+
+
+class CompiledBeatmap:
+    """
+    バイナリ譜面を読み込んだ譜面データ。
+    レコード部分を int32 の memoryview として参照するだけなので、ノーツ数に関係なくコピーは発生しない。
+    beatmap[i] は (開始時間, レーン, 終了時間) のタプルを返し、従来の List[List[int]] と同じように使える。
+    start_times / lanes / end_times は各列を指す (コピーなしの) memoryview。
+    """
+    def __init__(self, buffer, verify: bool = True, source: Optional[mmap.mmap] = None):
+        self._source = source # mmapを閉じないように参照を保持する
+        view = memoryview(buffer)
+        if len(view) < CHART_HEADER_SIZE:
+            raise BeatmapFormatError("ヘッダが短すぎます。")
+        magic, version, record_size, count, checksum, source_size, source_mtime_ns = struct.unpack_from(CHART_HEADER_FORMAT, view)
+        if magic != CHART_MAGIC:
+            raise BeatmapFormatError(f"マジックナンバーが一致しません: {magic!r}")
+        if version != CHART_VERSION or record_size != CHART_RECORD_SIZE:
+            raise BeatmapFormatError(f"未対応の譜面バージョンです: version={version}, record_size={record_size}")
+        payload = view[CHART_HEADER_SIZE:CHART_HEADER_SIZE + count * CHART_RECORD_SIZE]
+        if len(payload) != count * CHART_RECORD_SIZE:
+            raise BeatmapFormatError("ファイルがノーツ数に対して短すぎます。")
+        if verify and zlib.crc32(payload) != checksum:
+            raise BeatmapFormatError("チェックサムが一致しません。ファイルが壊れている可能性があります。")
+
+        if sys.byteorder == 'little':
+            values = payload.cast('i')
+        else:
+            # ビッグエンディアン環境ではバイト順を入れ替える必要があるため、ここだけはコピーになる
+            swapped = array.array('i', payload.tobytes())
+            swapped.byteswap()
+            values = memoryview(swapped)
+        self._values = values
+        self.count: int = count
+        self.checksum: int = checksum
+        self.source_stamp: SourceStamp = (source_size, source_mtime_ns)
+        self.start_times = values[0::CHART_FIELDS_PER_RECORD]
+        self.lanes = values[1::CHART_FIELDS_PER_RECORD]
+        self.end_times = values[2::CHART_FIELDS_PER_RECORD]
+        self._max_note_length_ms: Optional[int] = None
+
+    @classmethod
+    def open(cls, path: str, verify: bool = True) -> 'CompiledBeatmap':
+        """バイナリ譜面ファイルを mmap で開きます。"""
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise BeatmapFormatError("空のファイルです。")
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mm, verify=verify, source=mm)
+
+    @property
+    def max_note_length_ms(self) -> int:
+        """譜面で最も長いノーツの長さ (ms)。初めて参照したときに一度だけ計算する。"""
+        if self._max_note_length_ms is None:
+            self._max_note_length_ms = max((end - start for start, end in zip(self.start_times, self.end_times)), default=0)
+        return self._max_note_length_ms
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index: int) -> Tuple[int, int, int]:
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("beatmap index out of range")
+        values = self._values
+        i = index * CHART_FIELDS_PER_RECORD
+        return values[i], values[i + 1], values[i + 2]
+
+    def __iter__(self) -> Iterator[Tuple[int, int, int]]:
+        for index in range(self.count):
+            yield self[index]
+
+
+class BeatmapWatcher:
+    """
+    CSV譜面の更新を監視し、変更があったら譜面を作り直します (プレイ中の譜面のホットリロード用)。
+    ファイルのサイズと更新時刻を poll_interval_s ごとに確認し、変わっていたら前回の内容と行単位で比べて、
+    先頭と末尾の一致する行を除いた範囲 (追記なら増えた末尾だけ) の行だけを解析し直す。
+    """
+    def __init__(self, csv_path: str, poll_interval_s: float = WATCH_POLL_INTERVAL_S):
+        self.path: str = csv_path
+        self.poll_interval_s: float = poll_interval_s
+        self.next_poll_time: float = 0.0
+        self.stamp: Optional[Tuple[int, int]] = None # 最後に読んだときの (サイズ, 更新時刻ns)
+        self.lines: List[bytes] = [] # 最後に読んだときの各行
+        self.rows: List[Optional[NoteRow]] = [] # 各行を解析した結果 (不正な行は None)
+        self.reparsed_line_count: int = 0 # 直近の再読み込みで解析し直した行数
+        self.poll(force=True) # 最初の内容を読んでおく (この時点の譜面は読み込み済みなので返さない)
+
+    def poll(self, force: bool = False) -> Optional[CompiledBeatmap]:
+        """
+        前回の確認から poll_interval_s 以上経っていれば更新を確認し、変わっていれば新しい譜面を返します。
+        変わっていない・確認の間隔が来ていない場合は None を返します。
+        保存途中などで読めない・不正な行がある場合は警告を表示し、前の譜面のまま次の更新を待ちます。
+        """
+        now = time.perf_counter()
+        if not force and now < self.next_poll_time:
+            return None
+        self.next_poll_time = now + self.poll_interval_s
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None # エディタが保存のためにファイルを置き換えている途中など
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        if stamp == self.stamp:
+            return None
+        self.stamp = stamp # 読めなかった場合も、同じ内容で警告を繰り返さないよう記録する
+        try:
+            with open(self.path, 'rb') as f:
+                lines = f.read().splitlines(keepends=True)
+            rows = self._reparse(lines)
+        except (OSError, ValueError) as e:
+            print(f"警告: 譜面を再読み込みできませんでした。{e}")
+            return None
+        self.lines = lines
+        self.rows = rows
+        ordered = sorted((row for row in rows if row is not None), key=itemgetter(0, 1))
+        return CompiledBeatmap(encode_chart(array.array('i', itertools.chain.from_iterable(ordered))))
+
+    def _reparse(self, lines: List[bytes]) -> List[Optional[NoteRow]]:
+        """前回の各行と比べ、変わった範囲の行だけを解析して、全行の解析結果を返します。"""
+        old_lines = self.lines
+        limit = min(len(old_lines), len(lines))
+        prefix = 0
+        while prefix < limit and old_lines[prefix] == lines[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < limit - prefix and old_lines[-1 - suffix] == lines[-1 - suffix]:
+            suffix += 1
+        changed = lines[prefix:len(lines) - suffix]
+        # 1行ずつ解析する (行と解析結果を1対1に対応させるため。空行は列数0の行として警告する)
+        parsed = [parse_csv_row(next(csv.reader([line.decode()]), [])) for line in changed]
+        self.reparsed_line_count = len(changed)
+        return self.rows[:prefix] + parsed + self.rows[len(self.rows) - suffix:]
+
+
+def load_compiled_beatmap(csv_path: str) -> CompiledBeatmap:
+    """
+    CSV譜面に対応するコンパイル済み譜面を読み込みます。
+    コンパイル済み譜面が無い・古い・壊れている場合はCSVからコンパイルし直します。
+    書き込めないディレクトリの場合はメモリ上でコンパイルした譜面を返します。
+    """
+    if csv_path.endswith(COMPILED_CHART_EXTENSION):
+        return CompiledBeatmap.open(csv_path)
+
+    chart_path = compiled_path_for(csv_path)
+    if not is_compiled_chart_stale(csv_path, chart_path):
+        try:
+            return CompiledBeatmap.open(chart_path)
+        except BeatmapFormatError as e:
+            print(f"警告: コンパイル済み譜面を読み込めませんでした。再コンパイルします。{e}")
+    try:
+        return CompiledBeatmap.open(compile_beatmap(csv_path, chart_path))
+    except OSError as e:
+        print(f"警告: コンパイル済み譜面を書き込めませんでした。メモリ上で読み込みます。{e}")
+        return CompiledBeatmap(compile_rows(read_csv_rows(csv_path)))
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="CSV譜面をバイナリ譜面 (.chart) にコンパイルします。")
+    parser.add_argument('csv_path', nargs='?', default='beatmap.csv', help="入力するCSV譜面 (既定: beatmap.csv)")
+    parser.add_argument('-o', '--output', default=None, help="出力するバイナリ譜面 (既定: 拡張子を .chart にしたパス)")
+    args = parser.parse_args(argv)
+
+    try:
+        chart_path = compile_beatmap(args.csv_path, args.output)
+    except FileNotFoundError as e:
+        print(f"エラー: 譜面ファイルが見つかりません。{e}")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"エラー: 譜面データの内容が不正です。数値に変換できませんでした。{e}")
+        sys.exit(1)
+    chart = CompiledBeatmap.open(chart_path)
+    print(f"'{args.csv_path}' を '{chart_path}' にコンパイルしました。(ノーツ数: {len(chart)}, CRC32: {chart.checksum:08x})")
+
+
+if __name__ == '__main__':
+    main()
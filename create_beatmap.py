@@ -1,9 +1,34 @@
-import pygame  # import pygame as pg にするとpgでも動くようになる
+import argparse
+import csv
+import heapq
+import io
+import os
+import queue
 import sys
+import tempfile
+import threading
 import time
-import csv
+
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+import pygame  # import pygame as pg にするとpgでも動くようになる
+
+from compile_beatmap import LONG_NOTE_MIN_MS
+from waveform import WaveformPeaks, load_waveform_peaks
 
 #  譜面作成
+# 音楽に合わせて A, S, D, F を押し、押した時刻と離した時刻から譜面 (beatmap.csv) を作る。
+# キーを押した (KEYDOWN) 時刻と離した (KEYUP) 時刻をレーンごとに組にして、1回の押下を1つのノーツとして記録する。
+# LONG_NOTE_MIN_MS 以上押し続けた場合はロングノーツ (開始時間, レーン, 終了時間)、それより短ければ単発ノーツ (開始時間, レーン) になる。
+#
+# 記録したノーツはメモリに溜めずに、追記専用のジャーナル (beatmap.csv.journal) へ少しずつ書き込む。
+# 終了時にジャーナルを外部マージソートして開始時間順の譜面を書き出すので、長時間記録してもメモリは増えない。
+# 途中で落ちた・強制終了した場合もジャーナルは残るので、--recover で譜面に書き出すか、--resume で続きから記録できる。
+#
+# 画面下部のタイムラインには、曲の波形と記録したノーツを表示する。波形は waveform.py のピークのミップマップ
+# (音楽ファイルの隣にキャッシュする) から描くので、スクロール・ズームしても音声をデコードし直さない。
+
 # --- 設定 ---
 # あなたのゲームで使うキー設定に合わせます
 KEYS = {  # 辞書
@@ -14,90 +39,448 @@ KEYS = {  # 辞書
 }
 SONG_FILE = 'maou_short_14_shining_star.mp3'
 OUTPUT_CSV_FILE = 'beatmap.csv'
+JOURNAL_EXTENSION: str = '.journal'
+JOURNAL_BATCH_SIZE: int = 32 # これだけノーツが溜まったらジャーナルに書き込む
+JOURNAL_FLUSH_INTERVAL_S: float = 1.0 # ノーツが少なくても、この間隔でジャーナルに書き込む
+MERGE_CHUNK_ROWS: int = 100000 # 外部マージソートで一度にメモリ上で並べ替える行数
+RESUME_PREROLL_MS: int = 3000 # 続きから記録するとき、リズムを掴めるよう記録位置の少し前から再生する
+
+# タイムライン (波形と記録したノーツ) の表示
+SCREEN_SIZE: Tuple[int, int] = (800, 600)
+INPUT_POLL_FPS: int = 240 # 入力を取り出す頻度 (キー入力の時刻の細かさになる)
+DRAW_INTERVAL_S: float = 1 / 60 # 画面を描き直す間隔
+TIMELINE_LEFT: int = 20
+TIMELINE_WIDTH: int = 760
+TIMELINE_PLAYHEAD_X: int = 220 # 再生位置を表示する x 座標 (スクロールしていないとき)
+WAVEFORM_TOP: int = 170
+WAVEFORM_HEIGHT: int = 180
+LANE_ROW_TOP: int = 370
+LANE_ROW_HEIGHT: int = 40
+DEFAULT_MS_PER_PIXEL: float = 10.0 # 1ピクセルあたりの時間 (ズームの初期値)
+MIN_MS_PER_PIXEL: float = 0.5
+MAX_MS_PER_PIXEL: float = 500.0
+ZOOM_STEP: float = 1.25 # ズーム1回あたりの倍率
+SCROLL_STEP_PIXELS: int = 80 # ホイール1目盛りでスクロールするピクセル数
+GRID_INTERVALS_MS: List[int] = [100, 250, 500, 1000, 2000, 5000, 10000, 30000, 60000] # 時間の目盛りの間隔の候補
+VIEW_NOTE_HISTORY: int = 4096 # タイムラインに表示するために覚えておく、直近のノーツの数
+LANE_VIEW_COLORS: List[Tuple[int, int, int]] = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0)] # ゲームのレーンの色
+
+# 記録した1つのノーツ: (開始時間, レーン) または (開始時間, レーン, 終了時間)
+NoteRow = Tuple[int, ...]
+
+
+def journal_path_for(csv_path: str) -> str:
+    """譜面ファイルに対応するジャーナルのパスを返します (beatmap.csv -> beatmap.csv.journal)。"""
+    return csv_path + JOURNAL_EXTENSION
+
+
+def parse_note_row(row: List[str]) -> Optional[NoteRow]:
+    """CSVの1行をノーツに変換します。壊れた行 (書き込み途中で終了した行など) は None を返します。"""
+    try:
+        values = tuple(int(value) for value in row)
+    except ValueError:
+        return None
+    return values if len(values) in (2, 3) else None
+
+
+def read_journal(path: str) -> Iterator[NoteRow]:
+    """ジャーナルのノーツを書き込んだ順に返します。壊れた行は警告を表示して読み飛ばします。"""
+    with open(path, 'r', newline='') as f:
+        for row in csv.reader(f):
+            note = parse_note_row(row)
+            if note is None:
+                print(f"警告: ジャーナルの壊れた行を読み飛ばしました: {row}")
+                continue
+            yield note
+
+
+def truncate_partial_line(path: str) -> None:
+    """
+    書き込み途中で終了したジャーナルの、最後の不完全な行を切り捨てます。
+    途中で切れた行は別の時刻・レーンのノーツとして読めてしまうことがあるので、読む前・続きを追記する前に呼ぶ。
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            line_start = data.rfind(b'\n') + 1
+            print(f"警告: ジャーナルの最後の書き込み途中の行を切り捨てました: {data[line_start:]!r}")
+            f.truncate(line_start)
+
+
+def last_journal_time(path: str) -> int:
+    """ジャーナルに記録されている最後の時刻 (ノーツの開始・終了時間の最大値) を返します。"""
+    last_ms = 0
+    for note in read_journal(path):
+        last_ms = max(last_ms, note[2] if len(note) == 3 else note[0]) # 単発ノーツの行は (開始時間, レーン)
+    return last_ms
+
+
+def note_sort_key(note: NoteRow) -> Tuple[int, int]:
+    """譜面の並び順 (開始時間順、同時刻ならレーン順) のキー。"""
+    return note[0], note[1]
+
+
+class NoteJournal:
+    """
+    記録したノーツを追記専用のジャーナルファイルに書き込む。
+    append() はメモリ上のバッファに追記するだけで、JOURNAL_BATCH_SIZE 件または JOURNAL_FLUSH_INTERVAL_S 秒ごとに
+    まとめて書き込みスレッドに渡す。書き込みスレッドは書くたびに fsync するので、
+    強制終了されても失うのは最後のまとまり (最大1秒程度) だけで、記録ループはディスクの書き込みを待たない。
+    """
+    def __init__(self, path: str):
+        self.path: str = path
+        truncate_partial_line(path)
+        self._buffer: List[NoteRow] = []
+        self._last_flush: float = time.perf_counter()
+        self._queue: 'queue.Queue[Optional[str]]' = queue.Queue()
+        self._file = open(path, 'a', newline='')
+        self._writer = threading.Thread(target=self._write_loop, name='journal-writer', daemon=True)
+        self._writer.start()
+
+    def append(self, note: NoteRow) -> None:
+        """ノーツを1件追記します。"""
+        self._buffer.append(note)
+        if len(self._buffer) >= JOURNAL_BATCH_SIZE:
+            self.flush()
+
+    def flush_if_due(self) -> None:
+        """前回の書き込みから JOURNAL_FLUSH_INTERVAL_S 秒経っていれば、溜まっているノーツを書き込みます (毎フレーム呼ぶ)。"""
+        if self._buffer and time.perf_counter() - self._last_flush >= JOURNAL_FLUSH_INTERVAL_S:
+            self.flush()
+
+    def flush(self) -> None:
+        """溜まっているノーツを書き込みスレッドに渡します。"""
+        self._last_flush = time.perf_counter()
+        if not self._buffer:
+            return
+        text = io.StringIO()
+        csv.writer(text).writerows(self._buffer)
+        self._queue.put(text.getvalue())
+        self._buffer.clear()
+
+    def close(self) -> None:
+        """残りのノーツを書き込み、ファイルを閉じます。"""
+        self.flush()
+        self._queue.put(None)
+        self._writer.join()
+
+    def _write_loop(self) -> None:
+        try:
+            while True:
+                chunk = self._queue.get()
+                if chunk is None:
+                    break
+                self._file.write(chunk)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+        except OSError as e:
+            print(f"警告: ジャーナル '{self.path}' に書き込めませんでした。{e}")
+        finally:
+            self._file.close()
+
+
+def _write_run(directory: str, index: int, notes: List[NoteRow]) -> str:
+    """並べ替えたノーツを、外部マージソートの一時ファイル (ラン) に書き出します。"""
+    path = os.path.join(directory, f"run_{index}.csv")
+    notes.sort(key=note_sort_key)
+    with open(path, 'w', newline='') as f:
+        csv.writer(f).writerows(notes)
+    return path
+
+
+def _read_run(f) -> Iterator[NoteRow]:
+    for row in csv.reader(f):
+        yield tuple(int(value) for value in row)
+
 
-# --- Pygameの初期化 ---
-pygame.init()
-screen = pygame.display.set_mode((800, 600))
-pygame.display.set_caption("譜面作成ツール: A, S, D, F を押して記録 (ウィンドウを閉じると保存)")
-font = pygame.font.Font(None, 48)
-
-# --- 音楽の読み込み ---
-try:
-    pygame.mixer.music.load(SONG_FILE)
-except pygame.error as e:
-    print(f"エラー: '{SONG_FILE}'が見つかりません。プログラムと同じフォルダにありますか？")
+def merge_journal(journal_path: str, output_path: str, chunk_rows: int = MERGE_CHUNK_ROWS) -> int:
+    """
+    ジャーナルを開始時間順に並べ替えて譜面ファイルに書き出し、ノーツ数を返します。
+    chunk_rows 行ずつ並べ替えて一時ファイルに書き、それらを heapq.merge で1つにまとめる (外部マージソート) ので、
+    ジャーナルがどれだけ大きくてもメモリ上に持つのは chunk_rows 行だけ。
+    書き込み途中の譜面が読まれないよう、一時ファイルに書いてから置き換える。
+    """
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    with tempfile.TemporaryDirectory(dir=output_dir) as run_dir:
+        run_paths: List[str] = []
+        chunk: List[NoteRow] = []
+        for note in read_journal(journal_path):
+            chunk.append(note)
+            if len(chunk) >= chunk_rows:
+                run_paths.append(_write_run(run_dir, len(run_paths), chunk))
+                chunk = []
+        if chunk:
+            run_paths.append(_write_run(run_dir, len(run_paths), chunk))
+
+        run_files = [open(path, 'r', newline='') for path in run_paths]
+        tmp_path = output_path + '.tmp'
+        count = 0
+        try:
+            with open(tmp_path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                for note in heapq.merge(*(_read_run(run_file) for run_file in run_files), key=note_sort_key):
+                    writer.writerow(note)
+                    count += 1
+        finally:
+            for run_file in run_files:
+                run_file.close()
+    if count:
+        os.replace(tmp_path, output_path)
+    else:
+        os.remove(tmp_path)
+    return count
+
+
+class NoteRecorder:
+    """
+    レーンごとにキーを押した時刻を覚えておき、離したときに押した時刻と組にしてノーツを作り、ジャーナルに書き込む。
+    押しっぱなしの間に届く KEYDOWN (キーリピート) は無視するので、1回の押下から複数のノーツはできない。
+    resume_ms より前に押したキーは記録しない (続きから記録するときに、すでに記録した部分を重複させないため)。
+    """
+    def __init__(self, journal: NoteJournal, long_note_min_ms: int = LONG_NOTE_MIN_MS, resume_ms: int = 0):
+        self.journal: NoteJournal = journal
+        self.long_note_min_ms: int = long_note_min_ms
+        self.resume_ms: int = resume_ms
+        self.press_times: Dict[int, int] = {} # 押下中のレーン -> 押した時刻 (ms)
+        self.note_count: int = 0
+        self.long_note_count: int = 0
+        # タイムラインに表示する直近のノーツ (全ノーツはジャーナルにあるので、メモリ上には一定数だけ残す)
+        self.recent_notes: Deque[NoteRow] = deque(maxlen=VIEW_NOTE_HISTORY)
+
+    def press(self, lane: int, time_ms: int) -> None:
+        """レーンのキーを押した時刻を記録します。"""
+        if lane not in self.press_times and time_ms >= self.resume_ms:
+            self.press_times[lane] = time_ms
+
+    def release(self, lane: int, time_ms: int) -> Optional[NoteRow]:
+        """レーンのキーを離した時刻から、押した時刻と組にしたノーツを作って返します。"""
+        start_ms = self.press_times.pop(lane, None)
+        if start_ms is None:
+            return None # 記録を始める前から押されていたキー
+        if time_ms - start_ms >= self.long_note_min_ms:
+            note: NoteRow = (start_ms, lane, time_ms) # ロングノーツ
+            self.long_note_count += 1
+        else:
+            note = (start_ms, lane) # 単発ノーツ
+        self.journal.append(note)
+        self.recent_notes.append(note)
+        self.note_count += 1
+        return note
+
+    def release_all(self, time_ms: int) -> None:
+        """記録の終了時に押されたままのキーを、全て time_ms に離したものとして記録します。"""
+        for lane in sorted(self.press_times):
+            self.release(lane, time_ms)
+
+
+class TimelineView:
+    """
+    曲の波形と記録したノーツを、横方向の時間軸に並べて表示する。
+    通常は再生位置に合わせて流れ、マウスホイールで前後にスクロール、Ctrl+ホイールまたは +/- キーでズーム、
+    Home キーで再生位置に戻る。
+    """
+    def __init__(self, peaks: Optional[WaveformPeaks]):
+        self.peaks: Optional[WaveformPeaks] = peaks
+        self.ms_per_pixel: float = DEFAULT_MS_PER_PIXEL
+        self.scroll_ms: float = 0.0 # 再生位置からのずれ (スクロールした量)
+        self.label_font = pygame.font.Font(None, 24)
+
+    def handle_event(self, event: pygame.event.Event) -> None:
+        """スクロールとズームの操作を処理します。"""
+        if event.type == pygame.MOUSEWHEEL:
+            if pygame.key.get_mods() & pygame.KMOD_CTRL:
+                self.zoom(ZOOM_STEP ** -event.y)
+            else:
+                self.scroll_ms -= event.y * SCROLL_STEP_PIXELS * self.ms_per_pixel
+        elif event.type == pygame.KEYDOWN:
+            if event.key in (pygame.K_PLUS, pygame.K_EQUALS, pygame.K_KP_PLUS):
+                self.zoom(1 / ZOOM_STEP)
+            elif event.key in (pygame.K_MINUS, pygame.K_KP_MINUS):
+                self.zoom(ZOOM_STEP)
+            elif event.key == pygame.K_HOME:
+                self.scroll_ms = 0.0
+
+    def zoom(self, factor: float) -> None:
+        """1ピクセルあたりの時間を factor 倍にします (再生位置の表示位置は変えない)。"""
+        self.scroll_ms *= factor # スクロールした量もピクセル単位で保つ
+        self.ms_per_pixel = min(MAX_MS_PER_PIXEL, max(MIN_MS_PER_PIXEL, self.ms_per_pixel * factor))
+
+    def x_at(self, time_ms: float, view_start_ms: float) -> float:
+        return TIMELINE_LEFT + (time_ms - view_start_ms) / self.ms_per_pixel
+
+    def draw(self, screen: pygame.Surface, current_time_ms: float, recorder: NoteRecorder) -> None:
+        """タイムラインを描画します。"""
+        view_start_ms = current_time_ms + self.scroll_ms - (TIMELINE_PLAYHEAD_X - TIMELINE_LEFT) * self.ms_per_pixel
+        view_end_ms = view_start_ms + TIMELINE_WIDTH * self.ms_per_pixel
+        lanes_bottom = LANE_ROW_TOP + LANE_ROW_HEIGHT * len(KEYS)
+
+        # 時間の目盛り (間隔が50ピクセル以上になる最も細かい間隔)
+        grid_ms = next((ms for ms in GRID_INTERVALS_MS if ms / self.ms_per_pixel >= 50), GRID_INTERVALS_MS[-1])
+        tick_ms = max(0, int(view_start_ms // grid_ms) * grid_ms)
+        while tick_ms <= view_end_ms:
+            x = self.x_at(tick_ms, view_start_ms)
+            if x >= TIMELINE_LEFT:
+                pygame.draw.line(screen, (50, 50, 50), (x, WAVEFORM_TOP), (x, lanes_bottom))
+                label = self.label_font.render(f"{tick_ms / 1000:g}s", True, (120, 120, 120))
+                screen.blit(label, (x + 2, WAVEFORM_TOP - 18))
+            tick_ms += grid_ms
+
+        # 波形 (1列ごとに、その範囲の最小値から最大値まで縦線を引く)
+        if self.peaks is not None:
+            middle = WAVEFORM_TOP + WAVEFORM_HEIGHT // 2
+            scale = WAVEFORM_HEIGHT / 2 / 32768
+            columns = self.peaks.column_peaks(view_start_ms, self.ms_per_pixel, TIMELINE_WIDTH)
+            for x, peak in enumerate(columns, TIMELINE_LEFT):
+                if peak is not None:
+                    pygame.draw.line(screen, (70, 130, 180), (x, middle - peak[1] * scale), (x, middle - peak[0] * scale))
+
+        # 記録したノーツ (レーンごとの行に、単発ノーツは短い四角、ロングノーツは長さのある帯で描く)
+        for lane in range(len(KEYS)):
+            pygame.draw.rect(screen, (30, 30, 30), (TIMELINE_LEFT, LANE_ROW_TOP + lane * LANE_ROW_HEIGHT + 2,
+                                                    TIMELINE_WIDTH, LANE_ROW_HEIGHT - 4))
+        pressing = [(start_ms, lane, current_time_ms) for lane, start_ms in recorder.press_times.items()]
+        for note in list(recorder.recent_notes) + pressing:
+            start_ms, lane = note[0], note[1]
+            end_ms = note[2] if len(note) == 3 else start_ms # 単発ノーツの行は (開始時間, レーン)
+            if end_ms < view_start_ms or start_ms > view_end_ms:
+                continue
+            x0 = max(TIMELINE_LEFT, self.x_at(start_ms, view_start_ms))
+            x1 = min(TIMELINE_LEFT + TIMELINE_WIDTH, max(self.x_at(end_ms, view_start_ms), x0 + 3))
+            pygame.draw.rect(screen, LANE_VIEW_COLORS[lane % len(LANE_VIEW_COLORS)],
+                             (x0, LANE_ROW_TOP + lane * LANE_ROW_HEIGHT + 6, x1 - x0, LANE_ROW_HEIGHT - 12))
+
+        # 再生位置
+        playhead_x = self.x_at(current_time_ms, view_start_ms)
+        if TIMELINE_LEFT <= playhead_x <= TIMELINE_LEFT + TIMELINE_WIDTH:
+            pygame.draw.line(screen, (255, 255, 255), (playhead_x, WAVEFORM_TOP), (playhead_x, lanes_bottom), 2)
+        help_text = self.label_font.render("Wheel: scroll   Ctrl+Wheel / +,-: zoom   Home: follow playback",
+                                           True, (150, 150, 150))
+        screen.blit(help_text, (TIMELINE_LEFT, lanes_bottom + 8))
+
+
+def record(song_file: str, journal: NoteJournal, resume_ms: int = 0) -> NoteRecorder:
+    """
+    音楽を再生し、ウィンドウを閉じるまでのキー入力をノーツとしてジャーナルに記録します。
+    resume_ms を指定すると、その少し前から再生し、resume_ms 以降の入力だけを記録します。
+    """
+    screen = pygame.display.set_mode(SCREEN_SIZE)
+    pygame.display.set_caption("譜面作成ツール: A, S, D, F を押して記録 (ウィンドウを閉じると保存)")
+    font = pygame.font.Font(None, 48)
+    clock = pygame.time.Clock()
+
+    # --- 音楽の読み込み ---
+    try:
+        pygame.mixer.music.load(song_file)
+    except pygame.error as e:
+        print(f"エラー: '{song_file}'が見つかりません。プログラムと同じフォルダにありますか？")
+        pygame.quit()
+        sys.exit()
+
+    # 波形のピーク (初回だけ音声をデコードして作り、以降は音楽ファイルの隣のキャッシュから読む)
+    timeline = TimelineView(load_waveform_peaks(song_file))
+
+    recorder = NoteRecorder(journal, resume_ms=resume_ms)
+    if resume_ms:
+        recorder.recent_notes.extend(read_journal(journal.path)) # 前回記録した分もタイムラインに表示する
+    play_from_ms = max(0, resume_ms - RESUME_PREROLL_MS)
+    print("音楽の再生を開始します。")
+    if play_from_ms:
+        pygame.mixer.music.play(start=play_from_ms / 1000)
+        print(f"{resume_ms} ms から続きを記録します。")
+    else:
+        pygame.mixer.music.play()
+    # 高精度の時計で、曲の先頭からの経過時間を測る (途中から再生した場合は再生位置の分だけ前を起点にする)
+    start_time = time.perf_counter() - play_from_ms / 1000
+    running = True  # 動いている間
+    next_draw_time = 0.0
+
+    while running:
+        events = pygame.event.get()
+        # イベントを取り出した時点の時刻を、このフレームで届いたキー入力の時刻とする (描画の時刻ではない)
+        current_time_ms = int((time.perf_counter() - start_time) * 1000)
+        for event in events:
+            if event.type == pygame.QUIT:
+                running = False
+            elif event.type == pygame.KEYDOWN and event.key in KEYS:
+                recorder.press(KEYS[event.key], current_time_ms)
+            elif event.type == pygame.KEYUP and event.key in KEYS:
+                recorder.release(KEYS[event.key], current_time_ms)
+            else:
+                timeline.handle_event(event)
+        if not running:
+            recorder.release_all(current_time_ms)
+            break
+        journal.flush_if_due()
+
+        # 画面の描画 (入力は細かく取り出しつつ、描き直すのは60FPSに抑える)
+        if time.perf_counter() < next_draw_time:
+            clock.tick(INPUT_POLL_FPS)
+            continue
+        next_draw_time = time.perf_counter() + DRAW_INTERVAL_S
+        screen.fill((0, 0, 0))
+        time_text = font.render(f"Time: {int((time.perf_counter() - start_time) * 1000)} ms", True, (255, 255, 255))
+        notes_text = font.render(f"Notes: {recorder.note_count}", True, (255, 255, 255))  # 記録したノーツの数を画面に表示
+        screen.blit(time_text, (10, 10))
+        screen.blit(notes_text, (10, 60))
+        # 押下中のレーンを表示 (ロングノーツを記録中であることが分かるように)
+        for lane in recorder.press_times:
+            pygame.draw.rect(screen, (100, 100, 100), (10 + lane * 60, 120, 50, 20))
+        timeline.draw(screen, time.perf_counter() * 1000 - start_time * 1000, recorder)
+        pygame.display.flip()
+        clock.tick(INPUT_POLL_FPS) # 入力を取り出す間隔を短く保つ
+
+    return recorder
+
+
+def finish_beatmap(journal_path: str, output_path: str) -> None:
+    """ジャーナルを並べ替えて譜面ファイルに書き出し、書き出せたらジャーナルを削除します。"""
+    count = merge_journal(journal_path, output_path)
+    os.remove(journal_path)
+    if count:
+        print(f"譜面を'{output_path}'に保存しました。(ノーツ数: {count})")
+    else:
+        print("ノーツが記録されなかったので、ファイルは作成されませんでした。")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="音楽に合わせて A, S, D, F を押し、譜面 (CSV) を作成します。")
+    parser.add_argument('-o', '--output', default=OUTPUT_CSV_FILE, help=f"保存する譜面ファイル (既定: {OUTPUT_CSV_FILE})")
+    parser.add_argument('--song', default=SONG_FILE, help="再生する音楽ファイル")
+    parser.add_argument('--resume', action='store_true', help="前回中断した記録 (ジャーナル) の続きから記録します")
+    parser.add_argument('--recover', action='store_true', help="前回中断した記録 (ジャーナル) を記録せずにそのまま譜面に書き出します")
+    args = parser.parse_args(argv)
+
+    journal_path = journal_path_for(args.output)
+    resume_ms = 0
+    if os.path.exists(journal_path):
+        truncate_partial_line(journal_path) # 異常終了で切れた最後の行を、ノーツとして読まないようにする
+        if args.recover:
+            finish_beatmap(journal_path, args.output)
+            sys.exit()
+        if not args.resume:
+            print(f"エラー: 前回中断した記録 '{journal_path}' が残っています。")
+            print("続きから記録する場合は --resume、そのまま譜面に書き出す場合は --recover を付けて実行してください。")
+            sys.exit(1)
+        resume_ms = last_journal_time(journal_path)
+    elif args.resume or args.recover:
+        print(f"エラー: 中断した記録 '{journal_path}' が見つかりません。")
+        sys.exit(1)
+
+    pygame.init()
+    journal = NoteJournal(journal_path)
+    try:
+        record(args.song, journal, resume_ms)
+    finally:
+        journal.close() # 例外で終了した場合も、そこまでのノーツをジャーナルに残す
+
+    # --- 譜面の保存 ---
+    pygame.quit()  # 辞めたとき
+    finish_beatmap(journal_path, args.output)
     sys.exit()
 
-# --- メイン処理 ---
-recorded_notes = []  # ノーツを記録するリスト
-print("音楽の再生を開始します。")
-pygame.mixer.music.play()
-start_time = time.time()
-running = True  # 動いている間
-
-while running:
-
-    key_list=pygame.key.get_pressed()  # pg.key.get_pressed()で押されている間
-
-    for event in pygame.event.get():  
-        if key_list[pygame.K_a]:  # 長押しで連続に作成
-              # print("aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa") 確認用
-            current_time_ms = int((time.time() - start_time)*1000)  # キーが押された瞬間の時間をミリ秒で記録 current_time_ms =(現在の時刻-ゲーム開始の時刻)*1000
-            lane_index = KEYS[pygame.K_a]  # 押されたキーから対応したレーンの番号を取り出す:
-            recorded_notes.append([current_time_ms, lane_index])  # ノーツを記録するリストに追加　押された時間(タイミング),レーン
-        if key_list[pygame.K_s]:
-              # print("ssssssssssssssssssssssssssssssss") 確認用
-            current_time_ms = int((time.time() - start_time) * 1000)  # キーが押された瞬間の時間をミリ秒で記録 current_time_ms =(現在の時刻-ゲーム開始の時刻)*1000
-            lane_index = KEYS[pygame.K_s]  # 押されたキーから対応したレーンの番号を取り出す
-            recorded_notes.append([current_time_ms, lane_index])  # ノーツを記録するリストに追加　押された時間(タイミング),レーン
-        if key_list[pygame.K_d]:
-              # print("dddddddddddddddddddddddddddddddd") 確認用
-            current_time_ms = int((time.time() - start_time) * 1000)  # キーが押された瞬間の時間をミリ秒で記録 current_time_ms =(現在の時刻-ゲーム開始の時刻)*1000
-            lane_index = KEYS[pygame.K_d]  # 押されたキーから対応したレーンの番号を取り出す
-            recorded_notes.append([current_time_ms, lane_index])  # ノーツを記録するリストに追加　押された時間(タイミング),レーン
-        if key_list[pygame.K_f]:
-              # print("ffffffffffffffffffffffffffffffff") 確認用
-            current_time_ms = int((time.time() - start_time) * 1000)  # キーが押された瞬間の時間をミリ秒で記録 current_time_ms =(現在の時刻-ゲーム開始の時刻)*1000
-            lane_index = KEYS[pygame.K_f]  # 押されたキーから対応したレーンの番号を取り出す
-            recorded_notes.append([current_time_ms, lane_index])  # ノーツを記録するリストに追加　押された時間(タイミング),レーン
-
-        if event.type == pygame.QUIT:
-            running = False  # 押されていない間while文が実行されない
-        # if event.type == pygame.KEYDOWN:  # キーが押されたとき pg.key.get_pressed()で押されている間
-        #     #for i,key in enumerate(KEYS):  # for i,n in enumerate(): i=数,n=リスト内のもの  4つに変更
-        #     if event.key in KEYS:  # KEYSに対応したキーが押されたならば KEYS[[対応したキーが押されてというイベント][レーン番号]]
-        #         current_time_ms = int((time.time() - start_time) * 1000)  # キーが押された瞬間の時間をミリ秒で記録 current_time_ms =(現在の時刻-ゲーム開始の時刻)*1000
-        #         lane_index = KEYS[event.key]  # 押されたキーから対応したレーンの番号を取り出す
-        #         recorded_notes.append([current_time_ms, lane_index])  # ノーツを記録するリストに追加　押された時間(タイミング),レーン
-        #         print(f"ノーツ記録: {current_time_ms}ms, レーン: {lane_index}")  # ターミナルに出力
-        #         #if event.key == key:  # KEYSに対応したキーが押されたならば KEYS[[対応したキーが押されてというイベント][レーン番号]]
-        #         print("すごい途中")
-        #         #for key in (KEYS):  # for i,n in enumerate(): i=数,n=リスト内のもの
-        #             #current_time_ms = int((time.time() - start_time) * 1000)  # キーが押された瞬間の時間をミリ秒で記録 current_time_ms =(現在の時刻-ゲーム開始の時刻)*1000
-        #             #dafsdlane_index = KEYS[event.key]  # 押されたキーから対応したレーンの番号を取り出す
-        #             # if key_list[key]:  # 対応しているキーが押されている時間を記録したい
-        #             #     current_time_ms +=1000  # キーが押された瞬間の時間をミリ秒で記録 current_time_ms =(現在の時刻-ゲーム開始の時刻)*1000
-        #             #     # lane_index = KEYS[event.key]  # 押されたキーから対応したレーンの番号を取り出す
-        #             #     recorded_notes.append([current_time_ms, lane_index])  # ノーツを記録するリストに追加　押された時間(タイミング),レーン
-        #             #     print(f"ノーツ記録: {current_time_ms}ms, レーン: {lane_index}")  # ターミナルに出力
-
-    # 画面の描画
-    screen.fill((0, 0, 0))
-    time_text = font.render(f"Time: {int((time.time() - start_time) * 1000)} ms", True, (255, 255, 255))
-    notes_text = font.render(f"Notes: {len(recorded_notes)}", True, (255, 255, 255))  # 追加したノーツの数を画面に表示
-    screen.blit(time_text, (10, 10))
-    screen.blit(notes_text, (10, 60))
-    pygame.display.flip()
-
-# --- 譜面の保存 ---
-pygame.quit()  # 辞めたとき
-if recorded_notes:
-    # 時間順に並べ替えてから保存
-    recorded_notes.sort(key=lambda x: x[0])  # lambda:無名関数 xを受け取りx[0]を返す 2番目の要素でソートする
-    with open(OUTPUT_CSV_FILE, 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerows(recorded_notes)
-    print(f"譜面を'{OUTPUT_CSV_FILE}'に保存しました。")
-else:
-    print("ノーツが記録されなかったので、ファイルは作成されませんでした。")
-sys.exit()
\ No newline at end of file
+
+
+if __name__ == '__main__':
+    main()
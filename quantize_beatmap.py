@@ -0,0 +1,221 @@
+import argparse
+import csv
+import os
+import sys
+import time
+
+from typing import Iterator, List, Optional, Tuple
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+try:
+    import numpy as np
+except ImportError:
+    print("エラー: 譜面の整形には NumPy が必要です。'pip install numpy' を実行してください。")
+    sys.exit(1)
+
+from compile_beatmap import LONG_NOTE_MIN_MS
+
+#  譜面の整形 (クオンタイズ)
+# 手で記録した譜面のタイミングのぶれや、キーを押しっぱなしにしたときの連続したノーツを整えて、
+# load_beatmap がそのまま読める、開始時間順の譜面に書き出す。
+# 1. 同じレーンで MERGE_WINDOW_MS 以内に続くノーツをまとめる (長く続いたものはロングノーツにする)
+# 2. BPM とオフセット (指定がなければノーツの時刻から推定) から作ったグリッドに、開始・終了時間を合わせる
+# 3. 同じレーンで、押している最中のロングノーツの中に入ってしまったノーツ (物理的に押せない) を取り除く
+# CSVの読み書きは BATCH_ROWS 行ずつ行い、間の処理は NumPy の配列に対してまとめて行う。
+
+BATCH_ROWS: int = 100000 # CSVを一度に読み書きする行数
+DEFAULT_SUBDIVISION: int = 4 # 1拍を何分割したグリッドに合わせるか (4 なら16分音符)
+MERGE_WINDOW_MS: int = 80 # 同じレーンでこれより短い間隔で続くノーツは、1つの押下とみなしてまとめる
+MIN_BPM: float = 70.0 # 推定するテンポの範囲
+MAX_BPM: float = 200.0
+BPM_STEP: float = 0.1 # BPM を推定するときの刻み
+BPM_CANDIDATE_BATCH: int = 64 # BPM の候補を一度に評価する数 (メモリ使用量の上限を決める)
+BPM_SAMPLE_NOTES: int = 20000 # BPM の推定に使うノーツの最大数 (多い場合は間引く)
+
+
+def read_chart(path: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    CSV譜面を BATCH_ROWS 行ずつ読み、開始時間・レーン・終了時間の配列を返します。
+    2列の行 (単発ノーツ) は終了時間を開始時間と同じにします。
+    """
+    batches: List[np.ndarray] = []
+    rows: List[Tuple[int, int, int]] = []
+    with open(path, 'r', newline='') as f:
+        for row in csv.reader(f):
+            if len(row) == 2:
+                start = int(row[0])
+                rows.append((start, int(row[1]), start))
+            elif len(row) == 3:
+                rows.append((int(row[0]), int(row[1]), int(row[2])))
+            else:
+                print(f"警告: 不正な譜面データ形式の行をスキップしました: {row}")
+                continue
+            if len(rows) >= BATCH_ROWS:
+                batches.append(np.array(rows, dtype=np.int64))
+                rows = []
+    if rows or not batches:
+        batches.append(np.array(rows, dtype=np.int64).reshape(-1, 3))
+    table = np.concatenate(batches)
+    return table[:, 0], table[:, 1], table[:, 2]
+
+
+def sort_notes(starts: np.ndarray, lanes: np.ndarray, ends: np.ndarray, by_lane: bool) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ノーツを開始時間順 (by_lane なら、レーンごとに開始時間順) に並べ替えます。"""
+    order = np.lexsort((starts, lanes)) if by_lane else np.lexsort((lanes, starts))
+    return starts[order], lanes[order], ends[order]
+
+
+def merge_duplicates(starts: np.ndarray, lanes: np.ndarray, ends: np.ndarray,
+                     window_ms: int, long_note_min_ms: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    同じレーンで window_ms 以内に続くノーツ (押しっぱなしで連続して記録されたノーツなど) を1つにまとめます。
+    まとめたノーツが long_note_min_ms 以上続いていればロングノーツ、そうでなければ単発ノーツにします。
+    ノーツはレーンごとに開始時間順に並んでいる必要があります。
+    """
+    if len(starts) == 0:
+        return starts, lanes, ends
+    # 同じレーンのそれまでのノーツの終わりの最大 (ロングノーツの途中に短いノーツがあっても、ロングノーツの終わり) から
+    # window_ms 以内に始まるなら、同じまとまり。drop_overlaps と同じく、レーンごとに時刻をずらして累積最大を求める
+    lane_offset = lanes * (int(ends.max()) + 1)
+    held_until = np.maximum.accumulate(ends + lane_offset)
+    continues = np.zeros(len(starts), dtype=bool)
+    continues[1:] = (lanes[1:] == lanes[:-1]) & (starts[1:] + lane_offset[1:] - held_until[:-1] <= window_ms)
+    group_starts = np.flatnonzero(~continues)
+    merged_starts = starts[group_starts]
+    merged_lanes = lanes[group_starts]
+    merged_ends = np.maximum.reduceat(ends, group_starts)
+    merged_ends = np.where(merged_ends - merged_starts >= long_note_min_ms, merged_ends, merged_starts)
+    return merged_starts, merged_lanes, merged_ends
+
+
+def phase_offset(starts: np.ndarray, period_ms: float) -> float:
+    """ノーツの時刻を周期 period_ms の位相に変換し、その平均の角度から、グリッドの起点 (0〜period_ms) を返します。"""
+    phases = 2 * np.pi * starts / period_ms
+    angle = np.arctan2(np.sin(phases).mean(), np.cos(phases).mean())
+    return float((angle / (2 * np.pi) * period_ms) % period_ms)
+
+
+def estimate_grid(starts: np.ndarray, subdivision: int) -> Tuple[float, float]:
+    """
+    ノーツの開始時間が最もよく揃う拍の周期を探し、(BPM, オフセットms) を返します。
+    各候補の周期でノーツの時刻を位相 (角度) に変換し、その平均ベクトルの長さ (位相の揃い具合) を求める。
+    8分音符のノーツは拍の周期では半分が逆位相になって打ち消し合うので、拍の 1/k (k は subdivision の約数) の周期の
+    揃い具合の合計が最大の候補を選ぶ。オフセットはグリッドの刻み (1/subdivision 拍) の位相から求める。
+    """
+    times = np.unique(starts).astype(np.float64)
+    if len(times) < 2:
+        return 120.0, 0.0
+    if len(times) > BPM_SAMPLE_NOTES:
+        times = times[np.linspace(0, len(times) - 1, BPM_SAMPLE_NOTES).astype(np.int64)]
+    candidates = np.arange(MIN_BPM, MAX_BPM + BPM_STEP / 2, BPM_STEP)
+    harmonics = [k for k in range(1, subdivision + 1) if subdivision % k == 0]
+    strengths = np.zeros(len(candidates))
+    for i in range(0, len(candidates), BPM_CANDIDATE_BATCH):
+        periods = 60000.0 / candidates[i:i + BPM_CANDIDATE_BATCH]
+        for k in harmonics:
+            phases = 2 * np.pi * k * times[None, :] / periods[:, None]
+            strengths[i:i + len(periods)] += np.hypot(np.cos(phases).mean(axis=1), np.sin(phases).mean(axis=1))
+    bpm = float(candidates[int(np.argmax(strengths))])
+    return bpm, phase_offset(times, 60000.0 / bpm / subdivision)
+
+
+def snap_to_grid(starts: np.ndarray, ends: np.ndarray, bpm: float, offset_ms: float, subdivision: int) -> Tuple[np.ndarray, np.ndarray]:
+    """開始・終了時間を、offset_ms から 1/subdivision 拍ごとに刻んだグリッドの最も近い点に合わせます。"""
+    step = 60000.0 / bpm / subdivision
+    snapped_starts = np.rint(offset_ms + np.rint((starts - offset_ms) / step) * step).astype(np.int64)
+    snapped_ends = np.rint(offset_ms + np.rint((ends - offset_ms) / step) * step).astype(np.int64)
+    # 単発ノーツ、またはグリッドに合わせたら長さがなくなったロングノーツは、単発ノーツにする
+    is_long = (ends > starts) & (snapped_ends > snapped_starts)
+    return np.maximum(snapped_starts, 0), np.where(is_long, snapped_ends, np.maximum(snapped_starts, 0))
+
+
+def drop_overlaps(starts: np.ndarray, lanes: np.ndarray, ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    同じレーンで、前のノーツ (ロングノーツなら押している間) と重なるノーツを取り除きます。
+    同じ時刻・同じレーンに重なったノーツもここで1つになります。ノーツはレーンごとに開始時間順に並んでいる必要があります。
+    """
+    if len(starts) == 0:
+        return starts, lanes, ends
+    # レーンごとに時刻をずらして1本の列にし、累積最大で「それまでのノーツが押されている最後の時刻」を求める
+    lane_offset = lanes * (int(ends.max()) + 1)
+    held_until = np.maximum.accumulate(ends + lane_offset)
+    keep = np.ones(len(starts), dtype=bool)
+    keep[1:] = starts[1:] + lane_offset[1:] > held_until[:-1]
+    return starts[keep], lanes[keep], ends[keep]
+
+
+def iter_rows(starts: np.ndarray, lanes: np.ndarray, ends: np.ndarray) -> Iterator[List[Tuple[int, ...]]]:
+    """書き出す行を BATCH_ROWS 行ずつ返します (単発ノーツは2列、ロングノーツは3列)。"""
+    for i in range(0, len(starts), BATCH_ROWS):
+        batch = zip(starts[i:i + BATCH_ROWS].tolist(), lanes[i:i + BATCH_ROWS].tolist(), ends[i:i + BATCH_ROWS].tolist())
+        yield [(start, lane, end) if end > start else (start, lane) for start, lane, end in batch]
+
+
+def write_chart(path: str, starts: np.ndarray, lanes: np.ndarray, ends: np.ndarray) -> None:
+    """ノーツを CSV 譜面に書き出します。書き込み途中の譜面が読まれないよう、一時ファイルに書いてから置き換えます。"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for rows in iter_rows(starts, lanes, ends):
+            writer.writerows(rows)
+    os.replace(tmp_path, path)
+
+
+def quantize(starts: np.ndarray, lanes: np.ndarray, ends: np.ndarray, bpm: Optional[float], offset_ms: Optional[float],
+             subdivision: int = DEFAULT_SUBDIVISION, merge_window_ms: int = MERGE_WINDOW_MS,
+             long_note_min_ms: int = LONG_NOTE_MIN_MS) -> Tuple[Tuple[np.ndarray, np.ndarray, np.ndarray], float, float]:
+    """
+    ノーツを整形し、((開始時間, レーン, 終了時間) の配列, BPM, オフセット) を返します。
+    bpm や offset_ms が None なら、重複をまとめたノーツの開始時間から推定します。
+    """
+    starts, lanes, ends = sort_notes(starts, lanes, ends, by_lane=True)
+    starts, lanes, ends = merge_duplicates(starts, lanes, ends, merge_window_ms, long_note_min_ms)
+    if bpm is None:
+        bpm, estimated_offset_ms = estimate_grid(starts, subdivision)
+        offset_ms = estimated_offset_ms if offset_ms is None else offset_ms
+    elif offset_ms is None:
+        # BPM だけ指定された場合は、そのグリッドの刻みで位相の揃う位置をオフセットにする
+        offset_ms = phase_offset(starts, 60000.0 / bpm / subdivision)
+    starts, ends = snap_to_grid(starts, ends, bpm, offset_ms, subdivision)
+    starts, lanes, ends = sort_notes(starts, lanes, ends, by_lane=True) # グリッドに合わせて順序が入れ替わった場合に備える
+    starts, lanes, ends = drop_overlaps(starts, lanes, ends)
+    return sort_notes(starts, lanes, ends, by_lane=False), bpm, offset_ms
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="譜面のタイミングをBPMのグリッドに合わせ、重複や重なりを取り除いて書き出します。")
+    parser.add_argument('input', nargs='?', default='beatmap.csv', help="整形する譜面ファイル (既定: beatmap.csv)")
+    parser.add_argument('-o', '--output', default=None, help="書き出す譜面ファイル (既定: 入力名_quantized.csv)")
+    parser.add_argument('--bpm', type=float, default=None, help="曲のBPM (省略するとノーツの時刻から推定します)")
+    parser.add_argument('--offset', type=float, default=None, help="最初の拍の位置 (ms) (省略すると推定します)")
+    parser.add_argument('--subdivision', type=int, default=DEFAULT_SUBDIVISION,
+                        help=f"1拍を何分割したグリッドに合わせるか (既定: {DEFAULT_SUBDIVISION} = 16分音符)")
+    parser.add_argument('--merge-window', type=int, default=MERGE_WINDOW_MS,
+                        help=f"同じレーンでこの間隔 (ms) 以内に続くノーツを1つにまとめます (既定: {MERGE_WINDOW_MS})")
+    args = parser.parse_args(argv)
+    if args.subdivision < 1 or (args.bpm is not None and args.bpm <= 0):
+        parser.error("--bpm と --subdivision には正の値を指定してください")
+    output = args.output or os.path.splitext(args.input)[0] + '_quantized.csv'
+
+    wall_start = time.perf_counter()
+    try:
+        starts, lanes, ends = read_chart(args.input)
+    except FileNotFoundError as e:
+        print(f"エラー: 譜面ファイルが見つかりません。{e}")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"エラー: 譜面データの内容が不正です。数値に変換できませんでした。{e}")
+        sys.exit(1)
+    (new_starts, new_lanes, new_ends), bpm, offset_ms = quantize(
+        starts, lanes, ends, args.bpm, args.offset, args.subdivision, args.merge_window)
+    write_chart(output, new_starts, new_lanes, new_ends)
+    wall_s = time.perf_counter() - wall_start
+
+    print(f"譜面を'{output}'に書き出しました。(ノーツ数: {len(starts)} -> {len(new_starts)},"
+          f" うちロングノーツ: {int(np.count_nonzero(new_ends > new_starts))},"
+          f" BPM: {bpm:.1f}, オフセット: {offset_ms:.1f} ms, 1/{args.subdivision} 拍, 処理時間: {wall_s:.2f} 秒)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+import os
+import queue
+import struct
+import threading
+
+from typing import Iterator, List, Optional, Tuple
+
+#  入力リプレイ
+# プレイ中のキー入力 (レーン, ゲーム時間ms, 押した/離した) を固定長のバイナリ形式で記録し、
+# 同じ判定処理に流し直してスコア・最大コンボ・HPを再現できるようにする
+#
+# ファイル形式 (全てリトルエンディアン):
+#   ヘッダ (16バイト): マジック b'RGRP', バージョン(uint16), フラグ(uint16), ロジックtick数/秒(uint16), 予約(uint16), 譜面のCRC32(uint32)
+#   レコード (14バイト × 件数): ゲーム時間ms(float64), 判定前に進めたロジックtick数(uint32), レーン(uint8), 種類(uint8)
+# ゲーム時間は判定に使った値をそのまま float64 で保存するので、丸めによる判定のずれは起きない。
+# ロジックtick数も記録するので、処理落ちでtickを捨てた場合も含めて、入力とロジックの順序をそのまま再現できる。
+
+REPLAY_MAGIC: bytes = b'RGRP'
+REPLAY_VERSION: int = 1
+REPLAY_HEADER_FORMAT: str = '<4sHHHHI'
+REPLAY_HEADER_SIZE: int = struct.calcsize(REPLAY_HEADER_FORMAT)
+REPLAY_RECORD_FORMAT: str = '<dIBB'
+REPLAY_RECORD_SIZE: int = struct.calcsize(REPLAY_RECORD_FORMAT)
+REPLAY_EXTENSION: str = '.rpl'
+
+# レコードの種類
+REPLAY_KEY_UP: int = 0 # キーを離した
+REPLAY_KEY_DOWN: int = 1 # キーを押した
+REPLAY_SKIP: int = 2 # 処理落ちでロジックtickを捨てた (ゲーム時間は次のtickの時刻)
+REPLAY_END: int = 3 # 記録の終わり (レーンの欄は、曲の最後まで到達したなら 1)
+REPLAY_KINDS: Tuple[int, ...] = (REPLAY_KEY_UP, REPLAY_KEY_DOWN, REPLAY_SKIP, REPLAY_END)
+
+REPLAY_LANE_COUNT: int = 4 # キー入力のレコードに記録できるレーンの数 (ゲームのレーン数と同じ)
+
+# ヘッダのフラグ
+REPLAY_FLAG_BOOST: int = 1 # 判定強化を有効にして開始した
+
+REPLAY_FLUSH_BYTES: int = 4096 # これだけ溜まったら書き込みスレッドに渡す
+
+# 1件分のレコード: (種類, レーン, ロジックtick数, ゲーム時間ms)
+ReplayRecord = Tuple[int, int, int, float]
+
+
+class ReplayFormatError(ValueError):
+    """リプレイファイルのヘッダやレコードが不正な場合に送出されます。"""
+
+
+class ReplayRecorder:
+    """
+    入力をリプレイファイルに記録する。
+    record() はメモリ上のバッファに追記するだけで、ファイルへの書き込みは別スレッドで行うので、
+    ゲームループ (毎フレームの処理) の中でディスクの書き込みを待つことはない。
+    """
+    def __init__(self, path: str, chart_checksum: int, logic_fps: int, activate_boost_initially: bool = False):
+        self.path: str = path
+        self._record_struct = struct.Struct(REPLAY_RECORD_FORMAT)
+        self._buffer: bytearray = bytearray()
+        self._queue: 'queue.Queue[Optional[bytes]]' = queue.Queue()
+        flags = REPLAY_FLAG_BOOST if activate_boost_initially else 0
+        self._file = open(path, 'wb')
+        self._file.write(struct.pack(REPLAY_HEADER_FORMAT, REPLAY_MAGIC, REPLAY_VERSION, flags, logic_fps, 0, chart_checksum))
+        self._writer = threading.Thread(target=self._write_loop, name='replay-writer', daemon=True)
+        self._writer.start()
+
+    def record(self, kind: int, lane: int, tick_count: int, time_ms: float) -> None:
+        """レコードを1件追記します。"""
+        self._buffer += self._record_struct.pack(time_ms, tick_count, lane, kind)
+        if len(self._buffer) >= REPLAY_FLUSH_BYTES:
+            self._queue.put(bytes(self._buffer))
+            self._buffer.clear()
+
+    def close(self) -> None:
+        """残りのバッファを書き込み、ファイルを閉じます。"""
+        if self._buffer:
+            self._queue.put(bytes(self._buffer))
+            self._buffer.clear()
+        self._queue.put(None)
+        self._writer.join()
+
+    def _write_loop(self) -> None:
+        try:
+            while True:
+                chunk = self._queue.get()
+                if chunk is None:
+                    break
+                self._file.write(chunk)
+                self._file.flush()
+        except OSError as e:
+            print(f"警告: リプレイファイル '{self.path}' に書き込めませんでした。{e}")
+        finally:
+            self._file.close()
+
+
+def unpack_replay_header(data: bytes) -> Tuple[int, int, int]:
+    """リプレイのヘッダを検証し、(フラグ, ロジックtick数/秒, 譜面のCRC32) を返します。"""
+    if len(data) < REPLAY_HEADER_SIZE:
+        raise ReplayFormatError("ヘッダが短すぎます。")
+    magic, version, flags, logic_fps, _, chart_checksum = struct.unpack_from(REPLAY_HEADER_FORMAT, data)
+    if magic != REPLAY_MAGIC:
+        raise ReplayFormatError(f"マジックナンバーが一致しません: {magic!r}")
+    if version != REPLAY_VERSION:
+        raise ReplayFormatError(f"未対応のリプレイのバージョンです: version={version}")
+    return flags, logic_fps, chart_checksum
+
+
+def read_replay_header(path: str) -> Tuple[int, int, int]:
+    """リプレイファイルのヘッダだけを読み、(フラグ, ロジックtick数/秒, 譜面のCRC32) を返します。"""
+    with open(path, 'rb') as f:
+        return unpack_replay_header(f.read(REPLAY_HEADER_SIZE))
+
+
+class Replay:
+    """
+    読み込んだリプレイ。records は (種類, レーン, ロジックtick数, ゲーム時間ms) のリスト。
+    """
+    def __init__(self, data: bytes):
+        flags, logic_fps, chart_checksum = unpack_replay_header(data)
+        payload = memoryview(data)[REPLAY_HEADER_SIZE:]
+        # 書き込み途中で終了したファイルは、最後の不完全なレコードを捨てて読む
+        payload = payload[:len(payload) - len(payload) % REPLAY_RECORD_SIZE]
+        self.activate_boost_initially: bool = bool(flags & REPLAY_FLAG_BOOST)
+        self.logic_fps: int = logic_fps
+        self.chart_checksum: int = chart_checksum
+        self.records: List[ReplayRecord] = [
+            (kind, lane, tick_count, time_ms)
+            for time_ms, tick_count, lane, kind in struct.iter_unpack(REPLAY_RECORD_FORMAT, payload)
+        ]
+        # 壊れた・別のゲームのリプレイは、再生を始める前にここで弾く
+        for index, (kind, lane, _, _) in enumerate(self.records):
+            if kind not in REPLAY_KINDS:
+                raise ReplayFormatError(f"{index} 件目のレコードの種類が不正です: kind={kind}")
+            if kind in (REPLAY_KEY_DOWN, REPLAY_KEY_UP) and lane >= REPLAY_LANE_COUNT:
+                raise ReplayFormatError(f"{index} 件目のレコードのレーンが不正です: lane={lane}")
+
+    @classmethod
+    def load(cls, path: str) -> 'Replay':
+        """リプレイファイルを読み込みます。"""
+        with open(path, 'rb') as f:
+            return cls(f.read())
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __iter__(self) -> Iterator[ReplayRecord]:
+        return iter(self.records)
+
+
+def replay_path_for(directory: str, timestamp: str) -> str:
+    """保存先ディレクトリと日時の文字列から、リプレイファイルのパスを返します (同名があれば連番を付ける)。"""
+    path = os.path.join(directory, f"replay_{timestamp}{REPLAY_EXTENSION}")
+    suffix = 1
+    while os.path.exists(path):
+        path = os.path.join(directory, f"replay_{timestamp}_{suffix}{REPLAY_EXTENSION}")
+        suffix += 1
+    return path
@@ -0,0 +1,194 @@
+import argparse
+import csv
+import os
+import statistics
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1') # ワーカーごとに pygame の挨拶文が出ないようにする
+
+import rhythm_game
+from compile_beatmap import CompiledBeatmap, compiled_path_for
+from replay import Replay, ReplayFormatError, REPLAY_EXTENSION, read_replay_header
+
+#  リプレイの一括再採点
+# 判定幅やスコア・HPのルールを変えたときに、保存済みのリプレイを全て画面なしで再生し直して、
+# 新しいルールでのスコア分布を CSV に書き出す。
+# 譜面は親プロセスで一度だけコンパイルし、各ワーカーはそのバイナリ譜面を mmap で開く
+# (読み取り専用のページはOSのページキャッシュで共有されるので、ワーカー数を増やしても譜面はコピーされない)。
+
+RESULT_FIELDS: List[str] = ['score', 'max_combo', 'current_hp', 'finished']
+DEFAULT_SCORE_BUCKET: int = 500 # スコア分布の階級の幅
+DEFAULT_CHUNK_SIZE: int = 16 # ワーカーに一度に渡すリプレイの数 (プロセス間通信の回数を減らす)
+
+# --set で上書きできる、他の定数から計算されていない判定・スコア・HPのルール。
+# FPS や NOTE_SPEED などは SCROLL_SPEED / FALL_TIME_MS / LOGIC_TICK_MS などの計算に使われていて、
+# 上書きしても計算済みの値は変わらず、ルールが食い違ったまま採点されるので受け付けない
+RESCORABLE_RULES: List[str] = [
+    'JUDGEMENT_WINDOW_PERFECT', 'JUDGEMENT_WINDOW_GOOD', 'MAX_HP', 'HP_LOSS_PER_MISS',
+    'JUDGEMENT_BOOST_COMBO_THRESHOLD', 'FEVER_COMBO_THRESHOLD',
+]
+
+# ワーカープロセスごとの譜面 (initializer で開く)
+_worker_beatmap: Optional[CompiledBeatmap] = None
+
+
+def parse_rule_overrides(assignments: List[str]) -> Dict[str, float]:
+    """
+    'JUDGEMENT_WINDOW_PERFECT=40' のような指定を、rhythm_game の定数名と値の辞書に変換します。
+    RESCORABLE_RULES 以外の名前や、数値でない値を指定した場合は ValueError を送出します。
+    """
+    overrides: Dict[str, float] = {}
+    for assignment in assignments:
+        name, sep, value = assignment.partition('=')
+        name = name.strip()
+        if not sep or not name.isupper():
+            raise ValueError(f"'名前=値' の形式で指定してください: {assignment}")
+        if name not in RESCORABLE_RULES:
+            raise ValueError(f"'{name}' は上書きできません。指定できるのは {', '.join(RESCORABLE_RULES)} です。")
+        current = getattr(rhythm_game, name)
+        overrides[name] = int(value) if isinstance(current, int) else float(value)
+    return overrides
+
+
+def _init_worker(chart_path: str, overrides: Dict[str, float]) -> None:
+    """ワーカープロセスの初期化。譜面を mmap で開き、ルールの上書きを反映します。"""
+    global _worker_beatmap
+    _worker_beatmap = CompiledBeatmap.open(chart_path)
+    for name, value in overrides.items():
+        setattr(rhythm_game, name, value)
+
+
+def _rescore(path: str) -> Tuple[str, Optional[Dict[str, int]], str]:
+    """
+    リプレイ1つを再生し、(パス, 結果, エラーメッセージ) を返します。
+    どんな例外もエラーの結果として返し、1つの壊れたリプレイで一括処理全体が止まらないようにする。
+    """
+    try:
+        # 譜面とロジックtick数の不一致は、親プロセスでまとめて1回だけ警告する
+        return path, rhythm_game.run_replay(_worker_beatmap, Replay.load(path), warn=False), ''
+    except (OSError, ReplayFormatError) as e:
+        return path, None, str(e)
+    except Exception as e:
+        return path, None, f"{type(e).__name__}: {e}"
+
+
+def find_replays(paths: List[str]) -> List[str]:
+    """指定されたファイルとディレクトリ (再帰的に探す) から、リプレイファイルのパスを集めます。"""
+    replay_paths: List[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                replay_paths.extend(os.path.join(root, name) for name in files if name.endswith(REPLAY_EXTENSION))
+        else:
+            replay_paths.append(path)
+    return sorted(replay_paths)
+
+
+def check_replay_headers(replay_paths: List[str], chart_checksum: int) -> None:
+    """
+    リプレイのヘッダだけを読み、記録したときと譜面やロジックtick数が異なるものがあれば件数をまとめて警告します。
+    ヘッダを読めないリプレイは、再採点のときにエラーとして結果に記録されるのでここでは飛ばす。
+    """
+    chart_mismatches = 0
+    fps_mismatches = 0
+    for path in replay_paths:
+        try:
+            _, logic_fps, replay_checksum = read_replay_header(path)
+        except (OSError, ReplayFormatError):
+            continue
+        chart_mismatches += replay_checksum != chart_checksum
+        fps_mismatches += logic_fps != rhythm_game.FPS
+    if chart_mismatches:
+        print(f"警告: {chart_mismatches} 件のリプレイは記録したときと譜面が異なります。結果が一致しない可能性があります。")
+    if fps_mismatches:
+        print(f"警告: {fps_mismatches} 件のリプレイはロジックtick数が現在の設定 ({rhythm_game.FPS}/秒) と異なります。")
+
+
+def rescore_replays(replay_paths: List[str], chart_path: str, overrides: Dict[str, float],
+                    jobs: Optional[int] = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> List[Tuple[str, Optional[Dict[str, int]], str]]:
+    """リプレイをプロセスプールで並列に再採点し、入力と同じ順序で結果を返します。"""
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(chart_path, overrides)) as executor:
+        return list(executor.map(_rescore, replay_paths, chunksize=chunk_size))
+
+
+def write_results_csv(path: str, results: List[Tuple[str, Optional[Dict[str, int]], str]]) -> None:
+    """リプレイごとの再採点結果を CSV に書き出します。"""
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['replay'] + RESULT_FIELDS + ['error'])
+        for replay_path, result, error in results:
+            values = [result[field] for field in RESULT_FIELDS] if result else [''] * len(RESULT_FIELDS)
+            writer.writerow([replay_path] + values + [error])
+
+
+def write_distribution_csv(path: str, scores: List[int], bucket_size: int) -> None:
+    """スコアの分布 (階級ごとの度数と累積割合) を CSV に書き出します。"""
+    counts: Dict[int, int] = {}
+    for score in scores:
+        bucket = score // bucket_size * bucket_size
+        counts[bucket] = counts.get(bucket, 0) + 1
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['score_from', 'score_to', 'count', 'cumulative_ratio'])
+        cumulative = 0
+        for bucket in sorted(counts):
+            cumulative += counts[bucket]
+            writer.writerow([bucket, bucket + bucket_size - 1, counts[bucket], f"{cumulative / len(scores):.4f}"])
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="保存済みのリプレイを現在の判定ルールで一括して再採点し、スコア分布を CSV に書き出します。")
+    parser.add_argument('replays', nargs='+', help="リプレイファイル、またはリプレイを含むディレクトリ")
+    parser.add_argument('--beatmap', default=rhythm_game.BEATMAP_FULL_PATH, help="譜面ファイル (既定: beatmap.csv)")
+    parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='名前=値',
+                        help="判定・スコア・HPのルールを上書きして採点します (例: --set JUDGEMENT_WINDOW_PERFECT=40)。"
+                             f"指定できるのは {', '.join(RESCORABLE_RULES)}。複数指定可")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="ワーカープロセス数 (既定: CPUコア数)")
+    parser.add_argument('-o', '--output', default='rescore_results.csv', help="リプレイごとの結果の出力先")
+    parser.add_argument('-d', '--distribution', default='rescore_distribution.csv', help="スコア分布の出力先")
+    parser.add_argument('--bucket', type=int, default=DEFAULT_SCORE_BUCKET, help=f"スコア分布の階級の幅 (既定: {DEFAULT_SCORE_BUCKET})")
+    args = parser.parse_args(argv)
+
+    try:
+        overrides = parse_rule_overrides(args.overrides)
+    except ValueError as e:
+        print(f"エラー: {e}")
+        sys.exit(1)
+
+    # 譜面は親プロセスで一度だけコンパイルし、ワーカーには .chart のパスだけを渡す
+    chart_path = args.beatmap if args.beatmap.endswith('.chart') else compiled_path_for(args.beatmap)
+    chart = rhythm_game.load_beatmap(args.beatmap)
+    if not os.path.exists(chart_path):
+        print(f"エラー: コンパイル済み譜面 '{chart_path}' を書き出せませんでした。書き込めるディレクトリに譜面を置いてください。")
+        sys.exit(1)
+
+    replay_paths = find_replays(args.replays)
+    if not replay_paths:
+        print("エラー: リプレイファイルが見つかりません。")
+        sys.exit(1)
+
+    check_replay_headers(replay_paths, chart.checksum)
+
+    wall_start = time.perf_counter()
+    results = rescore_replays(replay_paths, chart_path, overrides, args.jobs)
+    wall_s = time.perf_counter() - wall_start
+
+    write_results_csv(args.output, results)
+    scores = [result['score'] for _, result, _ in results if result]
+    if scores:
+        write_distribution_csv(args.distribution, scores, args.bucket)
+    failed = len(results) - len(scores)
+
+    print(f"{len(replay_paths)} 件のリプレイを再採点しました ({wall_s:.2f} 秒, {len(replay_paths) / max(wall_s, 1e-6):.0f} 件/秒)。失敗: {failed} 件")
+    if scores:
+        print(f"スコア 平均 {statistics.mean(scores):.1f} / 中央値 {statistics.median(scores):.0f}"
+              f" / 最小 {min(scores)} / 最大 {max(scores)}")
+        print(f"結果: '{args.output}'  分布: '{args.distribution}'")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,37 @@
 import pygame
+import argparse
+import array
+import bisect
 import csv
+import gc
+import json
+import statistics
 import time
+import tracemalloc
 import sys
 import os
 
-from typing import List, Dict, Tuple, Optional
+from collections import Counter, OrderedDict, deque
+from typing import List, Dict, Tuple, Optional, Iterator, Deque
+
+from compile_beatmap import BeatmapWatcher, CompiledBeatmap, BeatmapFormatError, compile_rows, load_compiled_beatmap
+from song_library import LoadedSong, SongCache, SongEntry, load_song_library
+from replay import (Replay, ReplayFormatError, ReplayRecorder, REPLAY_END, REPLAY_KEY_DOWN, REPLAY_KEY_UP, REPLAY_SKIP,
+                    replay_path_for)
 
 
 # --- 定数設定 (Constants) ---
 SCREEN_WIDTH: int = 800
 SCREEN_HEIGHT: int = 600
-FPS: int = 60
+FPS: int = 60 # ゲームロジックの更新回数 (回/秒)。各種タイマーはこの間隔 (tick) で数える
+
+# ゲームロジックは描画とは独立に、固定間隔 (LOGIC_TICK_MS) で進める
+LOGIC_TICK_MS: float = 1000.0 / FPS
+MAX_LOGIC_TICKS_PER_FRAME: int = 30 # 1回の描画で進めるロジックtick数の上限 (大きな処理落ち時に追いつくのを諦める)
+# 描画フレームレートの上限 (0で無制限)。VSYNCが使える場合はディスプレイのリフレッシュレートに同期する
+RENDER_FPS_LIMIT: int = 0
+USE_VSYNC: bool = True
+FALLBACK_RENDER_FPS: int = 240 # VSYNCが使えず、上限も無い場合に使う描画フレームレート
 
 # 色定義
 WHITE: Tuple[int, int, int] = (255, 255, 255)
@@ -30,16 +51,17 @@ LANE_WIDTH: int = 100
 LANE_SPACING: int = (SCREEN_WIDTH - LANE_COUNT * LANE_WIDTH) // (LANE_COUNT + 1)
 
 # ノーツ設定
-NOTE_SPEED: float = 5.0
+NOTE_SPEED: float = 5.0 # 1ロジックtickあたりの落下量 (px)
+SCROLL_SPEED: float = NOTE_SPEED * FPS / 1000.0 # ノーツの落下速度 (px/ms)。ノーツの位置は曲の時間から直接計算する
 NOTE_HEIGHT: int = 20 # 単発ノーツの表示高さ
 
 # 判定設定
 JUDGEMENT_LINE_Y: int = SCREEN_HEIGHT - 100
-JUDGEMENT_WINDOW_PERFECT: int = 15 # PERFECT判定の許容範囲 (JUDGEMENT_LINE_Yからの距離)
-JUDGEMENT_WINDOW_GOOD: int = 30 # GOOD判定の許容範囲 (JUDGEMENT_LINE_Yからの距離)
+JUDGEMENT_WINDOW_PERFECT: int = 50 # PERFECT判定の許容範囲 (ノーツの開始・終了時間からのずれ、ms)
+JUDGEMENT_WINDOW_GOOD: int = 100 # GOOD判定の許容範囲 (ノーツの開始・終了時間からのずれ、ms)
 
 # ノーツが画面上端から判定ラインまで落ちるのにかかる時間 (ミリ秒)
-FALL_TIME_MS: float = (JUDGEMENT_LINE_Y + NOTE_HEIGHT) / NOTE_SPEED * (1000 / FPS)
+FALL_TIME_MS: float = (JUDGEMENT_LINE_Y + NOTE_HEIGHT) / SCROLL_SPEED
 
 # 各レーンに対応するキーとレーンインデックス (キー入力判定用)
 key_to_lane_idx: Dict[int, int] = {
@@ -56,6 +78,10 @@ lane_colors: List[Tuple[int, int, int]] = [
     (100, 100, 255), # レーン2 (Dキー) の色
     (255, 255, 100) # レーン3 (Fキー) の色
 ]
+# 押下中のロングノーツの色 (元の色の半分)。毎フレーム計算しないよう事前に用意する
+lane_active_colors: List[Tuple[int, int, int]] = [(r // 2, g // 2, b // 2) for r, g, b in lane_colors]
+# 各レーンの左端のx座標
+lane_x_starts: List[int] = [LANE_SPACING + i * (LANE_WIDTH + LANE_SPACING) for i in range(LANE_COUNT)]
 
 # レーンインデックスに対応する表示文字
 lane_idx_to_key_char: Dict[int, str] = {0: 'A', 1: 'S', 2: 'D', 3: 'F'}
@@ -82,105 +108,240 @@ BEATMAP_FULL_PATH: str = os.path.join(ASSET_DIR, BEATMAP_FILE_NAME)
 MUSIC_FULL_PATH: str = os.path.join(ASSET_DIR, MUSIC_FILE_NAME)
 T_SOUND_FULL_PATH: str = os.path.join(ASSET_DIR, T_SOUND_FILE_NAME) # T.mp3のフルパスを定義
 
+# 曲ライブラリ (曲選択で選べる曲の一覧)。ファイルが無ければ上の音楽ファイルと譜面の1曲だけを使う
+SONG_LIBRARY_FILE_NAME: str = 'songs.json'
+SONG_LIBRARY_FULL_PATH: str = os.path.join(ASSET_DIR, SONG_LIBRARY_FILE_NAME)
+DEFAULT_SONG_TITLE: str = "シャイニングスター"
+DEFAULT_SONG_ARTIST: str = "魔王魂"
+SONG_PRELOAD_RADIUS: int = 1 # 選択中の曲の前後何曲までを裏で先読みするか
+
+# 入力リプレイの保存先
+REPLAY_DIR_NAME: str = 'replays'
+REPLAY_DIR: str = os.path.join(BASE_DIR, REPLAY_DIR_NAME)
+RECORD_REPLAYS: bool = True # プレイごとに入力リプレイを記録するか
+
+# ユーザー設定ファイル (音声の遅延補正など)
+SETTINGS_FILE_NAME: str = 'settings.json'
+SETTINGS_FULL_PATH: str = os.path.join(BASE_DIR, SETTINGS_FILE_NAME)
+DEFAULT_SETTINGS: Dict[str, float] = {
+    'audio_offset_ms': 0.0, # 音声出力の遅延補正 (ms)。正の値にすると譜面が遅れて流れる
+    'input_offset_ms': 0.0, # 入力の遅延補正 (ms)。キー入力の時刻からこの値を引いて判定する (キャリブレーションで測定)
+    'visual_offset_ms': 0.0, # 表示の遅延補正 (ms)。ノーツをこの値だけ先の時間の位置に描画する (キャリブレーションで測定)
+}
+
+# --- キャリブレーション (タイミング調整) の設定 ---
+CALIBRATION_BPM: int = 120 # メトロノームのテンポ
+CALIBRATION_BEATS: int = 16 # 1フェーズあたりの拍数
+CALIBRATION_WARMUP_BEATS: int = 4 # 測定に使わない最初の拍数 (リズムに慣れるため)
+CALIBRATION_LEAD_IN_MS: float = 1000.0 # フェーズ開始から最初の拍までの待ち時間
+CALIBRATION_FLASH_MS: float = 80.0 # 表示フェーズで拍ごとに光らせる時間
+
+# --- 文字描画キャッシュの設定 ---
+TEXT_CACHE_SIZE: int = 256 # 描画済み文字列を保持する最大件数 (超えたら最も長く使われていないものから捨てる)
+
+# 毎フレーム同じ内容で表示する文字列 (起動時に一度だけ描画しておく)
+MENU_CATCHPHRASE_LINE1: str = "音と光が織りなす究極の律動――"
+MENU_CATCHPHRASE_LINE2: str = "さぁ、君もシャイニングマスターの道へ！"
+MENU_OPTION1_TEXT: str = "1: ゲームスタート (判定強化なし)"
+MENU_OPTION2_TEXT: str = "2: ゲームスタート (判定強化あり)"
+MENU_OPTION3_TEXT: str = "3: タイミング調整"
+MENU_INFO_TEXT: str = "←→キーで曲を選び、数字キーで選択してください"
+RESTART_TEXT: str = "Rキーでメニューに戻る"
+CALIBRATION_TITLE_TEXT: str = "タイミング調整"
+
+# --- デバッグ表示 (入力遅延の計測) の設定 ---
+LATENCY_SAMPLE_COUNT: int = 512 # 入力遅延の計測値を保持する件数 (古いものから捨てる)
+
+# フレームのプロファイラ設定 (--profile で有効、F4キーで表示の切り替え)
+PROFILER_FRAME_CAPACITY: int = 3600 # 保持するフレーム数 (60fpsで1分)。古いものから上書きする
+PROFILER_STATS_INTERVAL: int = 30 # 表示するパーセンタイルを計算し直す間隔 (フレーム数)
+PROFILER_DIR_NAME: str = 'profiles' # セッション終了時にCSVを書き出すディレクトリ
+PROFILER_DIR: str = os.path.join(BASE_DIR, PROFILER_DIR_NAME)
+# 計測する処理。logic はロジックtickのうち、ノーツ生成・見逃し判定・タイマー以外の部分
+PROFILER_PHASES: List[str] = [
+    'events', 'logic', 'spawn', 'update_notes_position', 'update_timers',
+    'draw_background', 'draw_lane_effects', 'draw_notes', 'draw_info_panel', 'draw_judgement_message', 'draw_other',
+    'present', 'tick_sleep',
+]
+
+# メモリ確保の計測設定 (--trace-alloc で有効、F3キーのデバッグ表示に集計を追加)
+ALLOC_TRACK_FRAME_COUNT: int = 3600 # フレームごとの計測値を保持するフレーム数
+ALLOC_TOP_SITE_COUNT: int = 10 # レポートに表示するメモリ確保の多い行の数
+ALLOC_HITCH_FRAME_MS: float = 1000 / FPS * 1.5 # これより長くかかったフレームを「カクつき」として数える
+
+# --- 曲の時間 (ソングクロック) の設定 ---
+SONG_CLOCK_DRIFT_GAIN: float = 0.1 # ミキサーの再生位置とのずれを、1回のサンプルで補正する割合
+SONG_CLOCK_RESYNC_THRESHOLD_MS: float = 100.0 # これ以上ずれていたら少しずつではなく一気に合わせ直す
+
 # --- HPバーのサイズ定義 ---
 HP_BAR_WIDTH: int = 200
 HP_BAR_HEIGHT: int = 20
+HP_BAR_X: int = (SCREEN_WIDTH - HP_BAR_WIDTH) // 2
+HP_BAR_Y: int = 10
 
 # --- ゲームの状態を管理するEnum (または定数) ---
 GAME_STATE_MENU: int = 0
 GAME_STATE_PLAYING: int = 1
 GAME_STATE_GAME_OVER: int = 2
+GAME_STATE_CALIBRATION: int = 3
 
-# --- グローバル変数 (ゲームの状態を保持) ---
-score: int = 0
-combo: int = 0
-max_combo: int = 0
-
+# --- ゲームのルール設定 ---
+# スコア・コンボ・HPなど1プレイ分の状態は GameSession が保持する
 MAX_HP: int = 500
-current_hp: int = MAX_HP
 HP_LOSS_PER_MISS: int = 10 # 通常のミスで減るHP量
 
 # 判定強化設定
 JUDGEMENT_BOOST_COMBO_THRESHOLD: int = 10 # 判定強化が発動するコンボの倍数
-JUDGEMENT_BOOST_DURATION_FRAMES: int = FPS * 5 # 判定強化の持続時間 (5秒)
-judgement_boost_active: bool = False # 判定強化が現在有効か
-judgement_boost_timer: int = 0 # 判定強化の残り時間（フレーム数）
+JUDGEMENT_BOOST_DURATION_FRAMES: int = FPS * 5 # 判定強化の持続時間 (5秒分のロジックtick数)
 
 # フィーバー演出設定
 FEVER_COMBO_THRESHOLD: int = 10 # フィーバーが発動するコンボ数
-fever_active: bool = False # フィーバーが現在有効か (コンボ数で継続)
-fever_flash_color_timer: int = 0 # 色を点滅させるためのタイマー (今回は背景には使わないが、他の用途のために残しておく)
 FEVER_FLASH_INTERVAL: int = 120 # (今回は背景には使わないが、他の用途のために残しておく)
 
-judgement_effect_timer: int = 0
-judgement_message: str = ""
-judgement_color: Tuple[int, int, int] = WHITE
-
-beatmap_index: int = 0
-# notesリストの各辞書に 'type', 'start_time_ms', 'end_time_ms', 'is_holding', 'is_released' を追加
-notes: List[Dict] = []
-
-# ゲーム状態の初期値はメニュー
+# 画面の状態 (メニュー・プレイ中・ゲームオーバー・キャリブレーション)。初期値はメニュー
 game_state: int = GAME_STATE_MENU
-game_start_time: float = 0.0
-
-lane_effects: List[Optional[Tuple[int, int, int]]] = [None] * LANE_COUNT
-lane_effect_timers: List[int] = [0] * LANE_COUNT
 
 # --- Pygameの初期化と画面設定 ---
-pygame.init()
-pygame.mixer.init()
-screen: pygame.Surface = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-pygame.display.set_caption("君もシャイニングマスターの道へ") # タイトル名を変更
+# 画面・フォント・音声は main() で初期化する。モジュールを import しただけではウィンドウを開かないので、
+# ゲームロジック (ノーツの生成・判定・HP・コンボ) だけを画面や音声デバイスなしで使える (run_headless を参照)
+render_fps_limit: int = RENDER_FPS_LIMIT
+screen: pygame.Surface
+
+def init_display() -> None:
+    """ウィンドウを作成します。VSYNCが使えない環境では描画フレームレートの上限を設定します。"""
+    global screen, render_fps_limit
+    try:
+        # VSYNCはSCALEDフラグと組み合わせたときだけ有効になる
+        screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SCALED if USE_VSYNC else 0, vsync=int(USE_VSYNC))
+    except pygame.error as e:
+        print(f"警告: VSYNCを有効にできませんでした。{e}")
+        screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+        if render_fps_limit == 0:
+            render_fps_limit = FALLBACK_RENDER_FPS
+    pygame.display.set_caption("君もシャイニングマスターの道へ") # タイトル名を変更
 
 
 # --- フォントの設定 ---
 font_path: Optional[str] = None
-try:
-    if sys.platform.startswith('win'): # Windows
-        potential_font_paths = [
-            "C:/Windows/Fonts/YuGothM.ttc", # 游ゴシック Medium
-            "C:/Windows/Fonts/meiryo.ttc", # メイリオ
-            "C:/Windows/Fonts/msgothic.ttc" # MS ゴシック
-        ]
-    elif sys.platform == 'darwin': # macOS
-        potential_font_paths = [
-            "/System/Library/Fonts/AquaKana.ttc",
-            "/Library/Fonts/ヒラギノ丸ゴ ProN W4.ttc", # ヒラギノ丸ゴシック
-            "/System/Library/Fonts/SFCompactText.ttf" # システムフォント
-        ]
-    else: # Linux (Noto Sans CJK JPの一般的なパス)
-        potential_font_paths = [
-            "/usr/share/fonts/truetype/noto/NotoSansJP-Regular.ttf",
-            "/usr/share/fonts/opentype/ipafont-gothic/ipagp.ttf", # IPA Pゴシック
-            "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf"
-        ]
+font: pygame.font.Font
+large_font: pygame.font.Font # メニュータイトル用
+small_font: pygame.font.Font
+
+def find_font_path() -> Optional[str]:
+    """OSごとの一般的な場所から日本語フォントを探し、見つかったパスを返します。"""
+    try:
+        if sys.platform.startswith('win'): # Windows
+            potential_font_paths = [
+                "C:/Windows/Fonts/YuGothM.ttc", # 游ゴシック Medium
+                "C:/Windows/Fonts/meiryo.ttc", # メイリオ
+                "C:/Windows/Fonts/msgothic.ttc" # MS ゴシック
+            ]
+        elif sys.platform == 'darwin': # macOS
+            potential_font_paths = [
+                "/System/Library/Fonts/AquaKana.ttc",
+                "/Library/Fonts/ヒラギノ丸ゴ ProN W4.ttc", # ヒラギノ丸ゴシック
+                "/System/Library/Fonts/SFCompactText.ttf" # システムフォント
+            ]
+        else: # Linux (Noto Sans CJK JPの一般的なパス)
+            potential_font_paths = [
+                "/usr/share/fonts/truetype/noto/NotoSansJP-Regular.ttf",
+                "/usr/share/fonts/opentype/ipafont-gothic/ipagp.ttf", # IPA Pゴシック
+                "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf"
+            ]
+
+        for path in potential_font_paths:
+            if os.path.exists(path):
+                print(f"使用フォント: {path}")
+                return path
 
-    for path in potential_font_paths:
-        if os.path.exists(path):
-            font_path = path
-            print(f"使用フォント: {font_path}")
-            break
-    
-    if font_path is None:
         print("警告: 適切な日本語フォントが見つかりませんでした。テキストが四角 (□) で表示される可能性があります。")
 
-except Exception as e:
-    print(f"フォントの検索中にエラーが発生しました: {e}")
-    font_path = None # 問題が発生した場合もデフォルトにフォールバック
+    except Exception as e:
+        print(f"フォントの検索中にエラーが発生しました: {e}")
+    return None # 問題が発生した場合もデフォルトにフォールバック
+
+def load_fonts() -> None:
+    """日本語フォントを探して、各サイズのフォントを読み込みます。"""
+    global font_path, font, large_font, small_font
+    font_path = find_font_path()
+    font = pygame.font.Font(font_path, 48)
+    large_font = pygame.font.Font(font_path, 72)
+    small_font = pygame.font.Font(font_path, 36)
 
-font: pygame.font.Font = pygame.font.Font(font_path, 48)
-large_font: pygame.font.Font = pygame.font.Font(font_path, 72) # メニュータイトル用
-small_font: pygame.font.Font = pygame.font.Font(font_path, 36)
+# --- 文字描画のキャッシュ ---
+class TextRenderCache:
+    """
+    (フォント, 文字列, 色) ごとに font.render() の結果を保持するキャッシュ。
+    日本語フォントの描画は重いので、内容が変わらない限り描画し直さない。
+    通常の文字列は最大 max_size 件のLRU (最も長く使われていないものから捨てる) で保持し、
+    preload() した固定の文字列は捨てずに保持し続ける。hits / misses で効果を確認できる。
+    """
+    def __init__(self, max_size: int = TEXT_CACHE_SIZE):
+        self.max_size: int = max_size
+        self.surfaces: 'OrderedDict[Tuple[pygame.font.Font, str, Tuple[int, int, int]], pygame.Surface]' = OrderedDict()
+        self.pinned: Dict[Tuple[pygame.font.Font, str, Tuple[int, int, int]], pygame.Surface] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def preload(self, text_font: pygame.font.Font, text: str, color: Tuple[int, int, int]) -> None:
+        """固定の文字列を描画して、捨てられない領域に保持します。"""
+        self.pinned[(text_font, text, color)] = text_font.render(text, True, color)
+
+    def render(self, text_font: pygame.font.Font, text: str, color: Tuple[int, int, int]) -> pygame.Surface:
+        """文字列を描画したSurfaceを返します。キャッシュにあればそれを返します。"""
+        key = (text_font, text, color)
+        surface = self.pinned.get(key)
+        if surface is not None:
+            self.hits += 1
+            return surface
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+        self.misses += 1
+        surface = text_font.render(text, True, color)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.max_size:
+            self.surfaces.popitem(last=False)
+        return surface
+
+text_cache: TextRenderCache = TextRenderCache()
+
+def render_text(text_font: pygame.font.Font, text: str, color: Tuple[int, int, int]) -> pygame.Surface:
+    """文字列をアンチエイリアス付きで描画したSurfaceを、キャッシュを通して返します。"""
+    return text_cache.render(text_font, text, color)
+
+def prerender_static_texts() -> None:
+    """キャッチフレーズ、メニューの選択肢、レーンのキー文字などの固定の文字列を起動時に描画しておきます。"""
+    static_texts = [
+        (font, MENU_CATCHPHRASE_LINE1, WHITE),
+        (small_font, MENU_CATCHPHRASE_LINE2, WHITE),
+        (font, MENU_OPTION1_TEXT, WHITE),
+        (font, MENU_OPTION2_TEXT, CYAN),
+        (small_font, MENU_OPTION3_TEXT, WHITE),
+        (small_font, MENU_INFO_TEXT, GRAY),
+        (small_font, RESTART_TEXT, WHITE),
+        (large_font, "GAME OVER!", RED),
+        (large_font, "FINISH!", WHITE),
+        (font, CALIBRATION_TITLE_TEXT, WHITE),
+    ]
+    static_texts += [(small_font, key_char, WHITE) for key_char in lane_idx_to_key_char.values()]
+    for text_font, text, color in static_texts:
+        text_cache.preload(text_font, text, color)
 
 # --- 効果音のロード ---
-t_sound: Optional[pygame.mixer.Sound] = None
-try:
-    t_sound = pygame.mixer.Sound(T_SOUND_FULL_PATH)
-except pygame.error:
-    print(f"警告: 効果音ファイル '{T_SOUND_FULL_PATH}' を読み込めませんでした。キーを押しても効果音が鳴りません。")
-except FileNotFoundError:
-    print(f"警告: 効果音ファイル '{T_SOUND_FULL_PATH}' が見つかりません。キーを押しても効果音が鳴りません。")
+t_sound: Optional[pygame.mixer.Sound] = None # ヘッドレス実行時は None のまま (効果音を鳴らさない)
+
+def load_sounds() -> None:
+    """効果音を読み込みます。読み込めない場合は警告を表示し、効果音なしで続けます。"""
+    global t_sound
+    try:
+        t_sound = pygame.mixer.Sound(T_SOUND_FULL_PATH)
+    except pygame.error:
+        print(f"警告: 効果音ファイル '{T_SOUND_FULL_PATH}' を読み込めませんでした。キーを押しても効果音が鳴りません。")
+    except FileNotFoundError:
+        print(f"警告: 効果音ファイル '{T_SOUND_FULL_PATH}' が見つかりません。キーを押しても効果音が鳴りません。")
 
 def play_sound(sound_obj: Optional[pygame.mixer.Sound]) -> None:
     """
@@ -191,13 +352,31 @@ def play_sound(sound_obj: Optional[pygame.mixer.Sound]) -> None:
         sound_obj.play()
 
 # --- レーンごとの円形エフェクトを描画 ---
-def draw_lane_effect(screen: pygame.Surface, x_center: int, color: Tuple[int, int, int], alpha: int = 100, radius: int = 50) -> None:
+# (色, 半径, 透明度) ごとに描画済みの円のスプライトをキャッシュする
+lane_effect_sprites: Dict[Tuple[Tuple[int, int, int], int, int], pygame.Surface] = {}
+
+def get_lane_effect_sprite(color: Tuple[int, int, int], radius: int, alpha: int) -> pygame.Surface:
+    """
+    円形エフェクトのスプライト (円がちょうど収まる大きさの透過Surface) を返します。
+    同じ (色, 半径, 透明度) の組み合わせは初回に一度だけ作成し、以降はキャッシュを使います。
+    """
+    key = (color, radius, alpha)
+    sprite = lane_effect_sprites.get(key)
+    if sprite is None:
+        sprite = pygame.Surface((radius * 2, radius * 2), pygame.SRCALPHA)
+        pygame.draw.circle(sprite, color + (alpha,), (radius, radius), radius)
+        if pygame.display.get_surface() is not None:
+            sprite = sprite.convert_alpha() # 画面と同じピクセル形式にしてblitを速くする
+        lane_effect_sprites[key] = sprite
+    return sprite
+
+def draw_lane_effect(screen: pygame.Surface, x_center: int, color: Tuple[int, int, int], alpha: int = 100, radius: int = 50) -> pygame.Rect:
     """
-    指定された位置に円形のエフェクトを描画します。
+    指定された位置に円形のエフェクトを描画し、描画した範囲を返します。
+    キャッシュしたスプライトを、円を囲む範囲だけにblitします。
     """
-    s = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
-    pygame.draw.circle(s, color + (alpha,), (x_center, JUDGEMENT_LINE_Y), radius)
-    screen.blit(s, (0, 0))
+    sprite = get_lane_effect_sprite(tuple(color), radius, alpha)
+    return screen.blit(sprite, (x_center - radius, JUDGEMENT_LINE_Y - radius))
 
 #***ロングノーツのクラスの追加 (長押しエフェクト用)
 class Long_note:
@@ -212,11 +391,148 @@ class Long_note:
         self.rect = pygame.Rect(x, y, width, height)
         self.color = color
             
-    def update(self, screen: pygame.Surface):
-        pygame.draw.rect(screen, self.color, self.rect)
+    def update(self, screen: pygame.Surface) -> pygame.Rect:
+        return pygame.draw.rect(screen, self.color, self.rect)
+
+# --- ノーツ ---
+class Note:
+    """
+    画面上の1つのノーツ。
+    __slots__ で属性を固定し、辞書やRectを持たないことでノーツ1つあたりのメモリを抑える。
+    x座標と描画高さは生成時に一度だけ計算し、y座標はゲーム時間から毎回直接計算する。
+    """
+    __slots__ = ('lane', 'x', 'height', 'start_time_ms', 'end_time_ms', 'is_long',
+                 'hit', 'is_holding', 'is_released', 'retired')
+
+    def __init__(self, lane: int, start_time_ms: int, end_time_ms: int):
+        self.lane: int = lane
+        self.start_time_ms: int = start_time_ms
+        self.end_time_ms: int = end_time_ms
+        self.is_long: bool = end_time_ms > start_time_ms
+        if self.is_long:
+            # 継続時間(ms)を落下速度に基づいてピクセル単位の高さに変換
+            self.height: int = max(int((end_time_ms - start_time_ms) * SCROLL_SPEED), NOTE_HEIGHT)
+        else:
+            self.height = NOTE_HEIGHT
+        self.x: int = lane_x_starts[lane]
+        self.hit: bool = False # ヒットしたか (ロングノーツの押し始めにも使用)
+        self.is_holding: bool = False # ロングノーツ用: 押し始め判定後、現在押されているか
+        self.is_released: bool = False # ロングノーツ用: 押し終わりの判定済みか
+        self.retired: bool = False # インデックス用: 処理済みで画面から外れたか
+
+    def bottom_at(self, current_game_time_ms: float) -> float:
+        """指定したゲーム時間でのノーツの下端のy座標。開始時間ちょうどに判定ラインに重なる。"""
+        return JUDGEMENT_LINE_Y - (self.start_time_ms - current_game_time_ms) * SCROLL_SPEED
+
+    def top_at(self, current_game_time_ms: float) -> float:
+        """指定したゲーム時間でのノーツの上端のy座標。"""
+        return self.bottom_at(current_game_time_ms) - self.height
+
+def note_start_time(note: Note) -> int:
+    """二分探索のキーに使う、ノーツの開始時間。"""
+    return note.start_time_ms
+
+# --- レーンごとのノーツインデックス ---
+# インデックスを整理 (詰め直し) する際の、処理済みノーツ数の下限
+NOTE_INDEX_COMPACT_THRESHOLD: int = 64
+
+class LaneNoteIndex:
+    """
+    画面上のノーツ (Note) をレーンごとに開始時間順で保持するインデックス。
+    ノーツは譜面順 (開始時間順) に追加されるので、各レーンのリストの先頭が最も判定ラインに近いノーツになる。
+    処理済みのノーツは retired フラグを立てて先頭位置 (heads) を進めるだけなので、削除は O(1)。
+    押下中のロングノーツはレーンごとに holding に記録し、キーを離したときに O(1) で取り出せる。
+    """
+    def __init__(self, lane_count: int):
+        self.lanes: List[List[Note]] = [[] for _ in range(lane_count)]
+        self.heads: List[int] = [0] * lane_count # 各レーンで最初の未処理ノーツの位置
+        self.holding: List[Optional[Note]] = [None] * lane_count # 各レーンで押下中のロングノーツ
+        self.live_count: int = 0
+
+    def add(self, note: Note) -> None:
+        """ノーツを対応するレーンの末尾に追加します。"""
+        lane = note.lane
+        lane_notes = self.lanes[lane]
+        head = self.heads[lane]
+        # 処理済みノーツが溜まったらリストを詰め直す (反復中に行わないよう、追加時にだけ行う)
+        if head >= NOTE_INDEX_COMPACT_THRESHOLD and head * 2 >= len(lane_notes):
+            del lane_notes[:head]
+            self.heads[lane] = 0
+        note.retired = False
+        lane_notes.append(note)
+        self.live_count += 1
+
+    def retire(self, note: Note) -> None:
+        """ノーツを処理済みにし、画面上のノーツから外します。"""
+        if note.retired:
+            return
+        note.retired = True
+        self.live_count -= 1
+        lane = note.lane
+        if self.holding[lane] is note:
+            self.holding[lane] = None
+        lane_notes = self.lanes[lane]
+        head = self.heads[lane]
+        while head < len(lane_notes) and lane_notes[head].retired:
+            head += 1
+        self.heads[lane] = head
+
+    def insert(self, note: Note) -> None:
+        """
+        ノーツを開始時間順の位置に挿入します (譜面のホットリロードで、生成済みの範囲にノーツが増えた場合)。
+        通常の生成は開始時間順なので add() で末尾に追加すればよい。
+        """
+        lane_notes = self.lanes[note.lane]
+        note.retired = False
+        bisect.insort_right(lane_notes, note, lo=self.heads[note.lane], key=note_start_time)
+        self.live_count += 1
+
+    def set_holding(self, note: Note) -> None:
+        """ロングノーツを押下中として記録します。"""
+        self.holding[note.lane] = note
+
+    def find_nearest(self, lane: int, time_ms: float, window_ms: float) -> Optional[Note]:
+        """
+        指定レーンの未ヒットのノーツのうち、開始時間が time_ms ± window_ms に入り、最も time_ms に近いものを返します。
+        開始時間で二分探索するので、レーン内のノーツ数 n に対して O(log n)。
+        """
+        lane_notes = self.lanes[lane]
+        i = bisect.bisect_left(lane_notes, time_ms - window_ms, lo=self.heads[lane], key=note_start_time)
+        best_note: Optional[Note] = None
+        best_diff = window_ms
+        while i < len(lane_notes) and lane_notes[i].start_time_ms <= time_ms + window_ms:
+            note = lane_notes[i]
+            diff = abs(note.start_time_ms - time_ms)
+            if not note.retired and not note.hit and diff <= best_diff:
+                if best_note is None or diff < best_diff:
+                    best_note = note
+                    best_diff = diff
+            i += 1
+        return best_note
+
+    def iter_lane(self, lane: int) -> Iterator[Note]:
+        """指定レーンの未処理ノーツを、判定ラインに近い順 (開始時間順) に返します。"""
+        lane_notes = self.lanes[lane]
+        for i in range(self.heads[lane], len(lane_notes)):
+            note = lane_notes[i]
+            if not note.retired:
+                yield note
+
+    def __iter__(self) -> Iterator[Note]:
+        for lane in range(len(self.lanes)):
+            yield from self.iter_lane(lane)
+
+    def __len__(self) -> int:
+        return self.live_count
+
+    def clear(self) -> None:
+        """全てのノーツを削除します。"""
+        for lane in range(len(self.lanes)):
+            self.lanes[lane].clear()
+            self.heads[lane] = 0
+            self.holding[lane] = None
+        self.live_count = 0
 
-# 「今、どのキーが押され続けているか」を記録するための変数
-held_keys = set()
 # 押されているキーのレーンに表示するエフェクト用の四角 (Long_noteクラスを使用)
 pressing_notes = {}
 for key, data in lane_keys.items():
@@ -227,28 +543,16 @@ for key, data in lane_keys.items():
 
 
 # --- ファイル読み込み処理 (関数化) ---
-def load_beatmap(path: str) -> List[List[int]]:
+def load_beatmap(path: str) -> CompiledBeatmap:
     """
-    譜面ファイルを読み込み、ノーツデータ（時間、レーン、[終了時間]）のリストを返します。
+    譜面ファイルを読み込み、ノーツデータ（時間、レーン、終了時間）の列を返します。
+    CSVは初回 (または更新時) にバイナリ譜面 (.chart) へコンパイルされ、以降は mmap でコピーなしに読み込みます。
     ファイルが見つからない場合はエラーメッセージを表示し、ゲームを終了します。
     """
     try:
         if not os.path.exists(path):
             raise FileNotFoundError(f"'{path}' not found.")
-
-        beatmap_data = []
-        with open(path, 'r') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                if len(row) == 2:
-                    # 単発ノーツ: [開始時間, レーン] -> 終了時間を開始時間と同じにする
-                    beatmap_data.append([int(row[0]), int(row[1]), int(row[0])])
-                elif len(row) == 3:
-                    # ロングノーツ: [開始時間, レーン, 終了時間]
-                    beatmap_data.append([int(row[0]), int(row[1]), int(row[2])])
-                else:
-                    print(f"警告: 不正な譜面データ形式の行をスキップしました: {row}")
-        return beatmap_data
+        return load_compiled_beatmap(path)
     except FileNotFoundError as e:
         print(f"エラー: 譜面ファイルが見つかりません。{e}")
         print("ゲームスクリプトと同じディレクトリに 'beatmap.csv' があるか確認してください。")
@@ -256,71 +560,1125 @@ def load_beatmap(path: str) -> List[List[int]]:
         print(f"期待される譜面パス: {path}")
         pygame.quit()
         sys.exit()
+    except BeatmapFormatError as e:
+        print(f"エラー: バイナリ譜面が不正です。{e}")
+        print("'compile_beatmap.py' で譜面をコンパイルし直してください。")
+        pygame.quit()
+        sys.exit()
     except ValueError as e:
         print(f"エラー: 譜面データの内容が不正です。数値に変換できませんでした。{e}")
         print(f"問題の行を確認してください。")
         pygame.quit()
         sys.exit()
 
-def load_music(path: str) -> None:
+# 現在の譜面。main() (または run_headless) で読み込むまでは空の譜面
+BEATMAP: CompiledBeatmap = CompiledBeatmap(compile_rows(iter(())))
+
+def load_settings(path: str) -> Dict[str, float]:
     """
-    音楽ファイルを読み込みます。ファイルが見つからない場合やロードに失敗した場合は警告を表示します。
+    ユーザー設定ファイル (JSON) を読み込みます。
+    ファイルが無い・壊れている場合や、項目が足りない場合は DEFAULT_SETTINGS の値を使います。
     """
+    settings = dict(DEFAULT_SETTINGS)
     try:
-        if not os.path.exists(path):
-            raise FileNotFoundError(f"'{path}' not found.")
-        pygame.mixer.music.load(path)
-    except pygame.error as e:
-        print(f"警告: 音楽ファイルをロードできませんでした。{e}")
-        print(f"期待される音楽パス: {path}")
-    except FileNotFoundError as e:
-        print(f"警告: 音楽ファイルが見つかりません。{e}")
-        print(f"期待される音楽パス: {path}")
-
-# 譜面と音楽のロードを実行
-BEATMAP: List[List[int]] = load_beatmap(BEATMAP_FULL_PATH)
-load_music(MUSIC_FULL_PATH)
-
-# --- ゲームの状態をリセットする関数 (リスタート用) ---
-def reset_game_state(activate_boost_initially: bool = False) -> None:
-    """ゲームの全状態を初期値にリセットします。
-    activate_boost_initially: ゲーム開始時に判定強化を有効にするかどうか。
-    """
-    global score, combo, max_combo, current_hp, notes, beatmap_index
-    global game_state, game_start_time
-    global judgement_effect_timer, judgement_message, judgement_color
-    global judgement_boost_active, judgement_boost_timer
-    global fever_active, fever_flash_color_timer
-    global lane_effects, lane_effect_timers # エフェクト関連もリセット
-    global held_keys # held_keysもリセット
-
-    score = 0
-    combo = 0
-    max_combo = 0
-    current_hp = MAX_HP
-    notes.clear()
-    beatmap_index = 0
-    game_state = GAME_STATE_PLAYING # ゲーム開始状態に設定
-    game_start_time = 0.0 # ゲーム開始時刻をリセット
-    judgement_effect_timer = 0
-    judgement_message = ""
-    judgement_color = WHITE
-    judgement_boost_active = activate_boost_initially # ここで初期設定を適用
-    judgement_boost_timer = JUDGEMENT_BOOST_DURATION_FRAMES if activate_boost_initially else 0
-    fever_active = False
-    fever_flash_color_timer = 0
-    
-    # レーンエフェクトもリセット
-    lane_effects = [None] * LANE_COUNT
-    lane_effect_timers = [0] * LANE_COUNT
-    held_keys.clear() # held_keysもリセット
+        with open(path, 'r', encoding='utf-8') as f:
+            loaded = json.load(f)
+        for key in settings:
+            if isinstance(loaded.get(key), (int, float)):
+                settings[key] = float(loaded[key])
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, AttributeError) as e:
+        print(f"警告: 設定ファイル '{path}' を読み込めませんでした。既定値を使います。{e}")
+    return settings
+
+# --- 曲の時間 (ソングクロック) ---
+class SongClock:
+    """
+    曲の再生位置をゲーム時間 (ms) として管理するクロック。
+    time.perf_counter() で滑らかに進めつつ、pygame.mixer.music.get_pos() の値に少しずつ寄せて
+    ずれ (ドリフト) を補正する。get_pos() はミキサーのバッファ単位でしか進まないので、そのままは使わない。
+    ゲーム時間は sample() でフレームごとに1回だけ計算し、各処理は now_ms を参照する。
+    audio_offset_ms で音声出力の遅延を補正できる。
+    """
+    def __init__(self, audio_offset_ms: float = 0.0):
+        self.audio_offset_ms: float = audio_offset_ms
+        self.running: bool = False
+        self.anchor: float = 0.0 # 曲の再生位置 0ms に対応する time.perf_counter() の値 (推定)
+        self.now_ms: float = 0.0 # 直近の sample() で計算したゲーム時間
+        self.last_audio_pos_ms: int = -1 # 直近に読んだ get_pos() の値
+        self.start_ms: float = 0.0 # 再生を始めた曲の位置 (練習モードで途中から再生した場合)
+
+    def start(self, start_ms: float = 0.0) -> None:
+        """曲の再生開始 (pygame.mixer.music.play() の直後) に呼びます。start_ms は再生を始めた曲の位置です。"""
+        self.start_ms = start_ms
+        self.anchor = time.perf_counter() - start_ms / 1000
+        self.running = True
+        self.last_audio_pos_ms = -1
+        self.now_ms = self.time_at(self.anchor)
+
+    def stop(self) -> None:
+        """クロックを停止します。"""
+        self.running = False
+        self.now_ms = 0.0
+
+    def time_at(self, timestamp: float) -> float:
+        """time.perf_counter() の値 timestamp に対応するゲーム時間 (ms) を返します。"""
+        return (timestamp - self.anchor) * 1000 - self.audio_offset_ms
+
+    def sample(self) -> float:
+        """
+        フレームの始めに1回呼び、ミキサーの再生位置とのずれを補正して今フレームのゲーム時間を返します。
+        get_pos() の値が変わったときだけ、その値と perf_counter からの予測値の差を補正に使う。
+        get_pos() は再生を始めてからの時間なので、途中から再生した場合は開始位置を足して曲の位置にする。
+        """
+        timestamp = time.perf_counter()
+        if self.running and pygame.mixer.get_init() and pygame.mixer.music.get_busy():
+            audio_pos_ms = pygame.mixer.music.get_pos()
+            if audio_pos_ms >= 0 and audio_pos_ms != self.last_audio_pos_ms:
+                self.last_audio_pos_ms = audio_pos_ms
+                drift_ms = audio_pos_ms + self.start_ms - (timestamp - self.anchor) * 1000
+                if abs(drift_ms) > SONG_CLOCK_RESYNC_THRESHOLD_MS:
+                    self.anchor -= drift_ms / 1000
+                else:
+                    self.anchor -= drift_ms * SONG_CLOCK_DRIFT_GAIN / 1000
+        # 補正でゲーム時間が巻き戻らないようにする (大きなずれで合わせ直した場合を除く)
+        current_ms = self.time_at(timestamp)
+        if self.running and self.now_ms - SONG_CLOCK_RESYNC_THRESHOLD_MS < current_ms < self.now_ms:
+            current_ms = self.now_ms
+        self.now_ms = current_ms
+        return self.now_ms
+
+    def is_playing(self) -> bool:
+        """曲が再生中なら True を返します。"""
+        return bool(pygame.mixer.get_init()) and pygame.mixer.music.get_busy()
+
+class VirtualClock:
+    """
+    SongClock と同じように使える、実時間ではなく advance_to() で進める仮想のクロック。
+    ヘッドレス実行で、曲の再生を待たずにゲーム時間を進めるのに使う。
+    曲の長さ (song_length_ms) を過ぎると、曲の再生が終わったものとして扱う。
+    """
+    def __init__(self, song_length_ms: float, audio_offset_ms: float = 0.0):
+        self.song_length_ms: float = song_length_ms
+        self.audio_offset_ms: float = audio_offset_ms
+        self.running: bool = False
+        self.now_ms: float = 0.0
+
+    def start(self, start_ms: float = 0.0) -> None:
+        """ゲーム時間 start_ms からクロックを開始します。"""
+        self.running = True
+        self.now_ms = start_ms
+
+    def stop(self) -> None:
+        """クロックを停止します。"""
+        self.running = False
+        self.now_ms = 0.0
+
+    def advance_to(self, time_ms: float) -> None:
+        """ゲーム時間を time_ms まで進めます (巻き戻しはしません)。"""
+        self.now_ms = max(self.now_ms, time_ms)
+
+    def time_at(self, timestamp: float) -> float:
+        """開始からの経過秒数 timestamp に対応するゲーム時間 (ms) を返します。"""
+        return timestamp * 1000 - self.audio_offset_ms
+
+    def sample(self) -> float:
+        """現在のゲーム時間を返します。"""
+        return self.now_ms
+
+    def is_playing(self) -> bool:
+        """曲の長さに達するまでは再生中として True を返します。"""
+        return self.running and self.now_ms < self.song_length_ms
+
+def save_settings(path: str, settings: Dict[str, float]) -> None:
+    """ユーザー設定をJSONファイルに保存します。書き込み途中で壊れないよう、一時ファイルに書いてから置き換えます。"""
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(settings, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"警告: 設定ファイル '{path}' を保存できませんでした。{e}")
+
+# --- キャリブレーション (タイミング調整) ---
+class Calibration:
+    """
+    メトロノームに合わせてキーを叩いてもらい、入力と表示の遅延を測定する。
+    1. 音声フェーズ: 拍ごとにクリック音を鳴らす。叩いた時刻と音を鳴らした時刻の差が入力の遅延 (input_offset_ms)
+    2. 表示フェーズ: 音を鳴らさず判定ラインを光らせる。叩いた時刻の差から入力の遅延を引いたものが表示の遅延 (visual_offset_ms)
+    各フェーズの測定値は外れ値に強いよう中央値を使う。
+    """
+    PHASE_AUDIO: str = 'audio'
+    PHASE_VISUAL: str = 'visual'
+    PHASE_RESULT: str = 'result'
+
+    def __init__(self):
+        self.beat_interval_ms: float = 60000.0 / CALIBRATION_BPM
+        self.start()
+
+    def start(self) -> None:
+        """音声フェーズから測定をやり直します。"""
+        self.tap_errors: Dict[str, List[float]] = {self.PHASE_AUDIO: [], self.PHASE_VISUAL: []}
+        self.input_offset_ms: float = 0.0
+        self.visual_offset_ms: float = 0.0
+        self._start_phase(self.PHASE_AUDIO)
+
+    def _start_phase(self, phase: str) -> None:
+        self.phase: str = phase
+        self.beat_times: List[float] = [] # 各拍を出した時刻 (time.perf_counter())
+        self.phase_start: float = time.perf_counter() + CALIBRATION_LEAD_IN_MS / 1000
+
+    def update(self) -> None:
+        """拍の時刻になっていたらクリック音 (または光) を出し、フェーズの終わりで次へ進めます。"""
+        if self.phase == self.PHASE_RESULT:
+            return
+        now = time.perf_counter()
+        beat_count = len(self.beat_times)
+        if beat_count < CALIBRATION_BEATS:
+            if now >= self.phase_start + beat_count * self.beat_interval_ms / 1000:
+                if self.phase == self.PHASE_AUDIO:
+                    play_sound(t_sound)
+                self.beat_times.append(time.perf_counter())
+        elif now >= self.beat_times[-1] + self.beat_interval_ms / 1000:
+            if self.phase == self.PHASE_AUDIO:
+                self._start_phase(self.PHASE_VISUAL)
+            else:
+                self._finish()
+
+    def handle_tap(self, timestamp: float) -> None:
+        """キーが叩かれた時刻 (time.perf_counter()) を、最も近い拍とのずれとして記録します。"""
+        if self.phase == self.PHASE_RESULT or not self.beat_times:
+            return
+        beat_index = min(range(len(self.beat_times)), key=lambda i: abs(timestamp - self.beat_times[i]))
+        error_ms = (timestamp - self.beat_times[beat_index]) * 1000
+        if beat_index >= CALIBRATION_WARMUP_BEATS and abs(error_ms) < self.beat_interval_ms / 2:
+            self.tap_errors[self.phase].append(error_ms)
+
+    def is_flashing(self) -> bool:
+        """表示フェーズで、直前の拍から CALIBRATION_FLASH_MS 以内なら True を返します。"""
+        return self.phase == self.PHASE_VISUAL and bool(self.beat_times) and \
+            (time.perf_counter() - self.beat_times[-1]) * 1000 < CALIBRATION_FLASH_MS
+
+    def _finish(self) -> None:
+        audio_errors = self.tap_errors[self.PHASE_AUDIO]
+        visual_errors = self.tap_errors[self.PHASE_VISUAL]
+        self.input_offset_ms = statistics.median(audio_errors) if audio_errors else 0.0
+        self.visual_offset_ms = statistics.median(visual_errors) - self.input_offset_ms if visual_errors else 0.0
+        self.phase = self.PHASE_RESULT
+
+    def apply(self, settings: Dict[str, float]) -> None:
+        """測定結果を設定に反映します。"""
+        settings['input_offset_ms'] = round(self.input_offset_ms, 1)
+        settings['visual_offset_ms'] = round(self.visual_offset_ms, 1)
+
+# --- 入力遅延の計測 (デバッグ表示用) ---
+class LatencyMonitor:
+    """
+    キー入力を取り出してから、その判定結果を描画した画面が flip されるまでの時間 (入力→判定表示の遅延) を計測する。
+    直近 LATENCY_SAMPLE_COUNT 件を保持し、パーセンタイルを計算できる。
+    """
+    def __init__(self, sample_count: int = LATENCY_SAMPLE_COUNT):
+        self.samples: Deque[float] = deque(maxlen=sample_count)
+        self.pending: List[float] = [] # 今フレームで判定した入力のタイムスタンプ
+
+    def mark_input(self, timestamp: float) -> None:
+        """判定した入力のタイムスタンプ (time.perf_counter()) を記録します。"""
+        self.pending.append(timestamp)
+
+    def frame_presented(self) -> None:
+        """display.flip() の直後に呼び、今フレームで判定した入力の遅延を確定します。"""
+        if self.pending:
+            now = time.perf_counter()
+            for timestamp in self.pending:
+                self.samples.append((now - timestamp) * 1000)
+            self.pending.clear()
+
+    def percentile(self, p: float) -> float:
+        """計測値の p パーセンタイル (ms) を返します (最近傍順位法)。"""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        rank = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered))) - 1))
+        return ordered[rank]
+
+# --- フレームごとの処理時間の計測 (プロファイラ) ---
+class FrameProfiler:
+    """
+    1フレームを処理ごと (PROFILER_PHASES) に分けて時間を計測し、直近 capacity フレーム分をリングバッファに保持する。
+    enter(phase) を呼ぶと、前回の enter からの経過時間をそれまでの処理に加算し、以降の時間を phase に数える。
+    ロジックtick内の処理 (ノーツ生成など) も enter で切り替えるので、各処理の時間は重複せずに数えられる。
+    enabled が False の間は何もしない。
+    """
+    def __init__(self, capacity: int = PROFILER_FRAME_CAPACITY):
+        self.enabled: bool = False
+        self.capacity: int = capacity
+        self.phase_index: Dict[str, int] = {phase: i for i, phase in enumerate(PROFILER_PHASES)}
+        phase_count = len(PROFILER_PHASES)
+        self.samples: array.array = array.array('d', [0.0]) * (capacity * phase_count) # [フレーム][処理] の順 (秒)
+        self.frame_times: array.array = array.array('d', [0.0]) * capacity # 各フレームの合計 (秒)
+        self.frame_count: int = 0 # これまでに記録したフレーム数 (capacity を超えたら古いものから上書き)
+        self.current: List[float] = [0.0] * phase_count # 計測中のフレーム
+        self.phase: str = PROFILER_PHASES[0]
+        self.last_timestamp: float = 0.0
+        self.frame_start: float = 0.0
+        self.cached_stats: Tuple[float, float, str, float] = (0.0, 0.0, "-", 0.0)
+        self.stats_frame_count: int = -1
+
+    def reset(self) -> None:
+        """記録したフレームを全て捨てます (新しいプレイの開始時に呼ぶ)。"""
+        self.frame_count = 0
+        self.stats_frame_count = -1
+
+    def begin_frame(self) -> None:
+        """フレームの最初に呼びます。"""
+        if not self.enabled:
+            return
+        self.frame_start = self.last_timestamp = time.perf_counter()
+        self.phase = PROFILER_PHASES[0]
+        for i in range(len(self.current)):
+            self.current[i] = 0.0
+
+    def enter(self, phase: str) -> str:
+        """ここから先の時間を phase として数えます。それまで計測していた処理の名前を返します。"""
+        previous = self.phase
+        if self.enabled:
+            now = time.perf_counter()
+            self.current[self.phase_index[previous]] += now - self.last_timestamp
+            self.last_timestamp = now
+            self.phase = phase
+        return previous
+
+    def end_frame(self) -> None:
+        """フレームの最後 (clock.tick の後) に呼び、計測したフレームをリングバッファに書き込みます。"""
+        if not self.enabled:
+            return
+        self.enter(self.phase)
+        slot = self.frame_count % self.capacity
+        phase_count = len(self.current)
+        self.samples[slot * phase_count:(slot + 1) * phase_count] = array.array('d', self.current)
+        self.frame_times[slot] = self.last_timestamp - self.frame_start
+        self.frame_count += 1
+
+    def recorded_slots(self) -> List[int]:
+        """記録済みのフレームの位置を古い順に返します。"""
+        if self.frame_count <= self.capacity:
+            return list(range(self.frame_count))
+        start = self.frame_count % self.capacity
+        return list(range(start, self.capacity)) + list(range(start))
+
+    def frame_percentile(self, p: float) -> float:
+        """フレーム時間の p パーセンタイル (ms) を返します (最近傍順位法)。"""
+        count = min(self.frame_count, self.capacity)
+        if count == 0:
+            return 0.0
+        ordered = sorted(self.frame_times[:count])
+        rank = max(0, min(count - 1, int(round(p / 100 * count)) - 1))
+        return ordered[rank] * 1000
+
+    def slowest_phase(self) -> Tuple[str, float]:
+        """clock.tick の待ち時間を除いて、平均時間が最も長い処理の名前と平均 (ms) を返します。"""
+        count = min(self.frame_count, self.capacity)
+        if count == 0:
+            return "-", 0.0
+        phase_count = len(PROFILER_PHASES)
+        best_phase, best_total = "-", -1.0
+        for i, phase in enumerate(PROFILER_PHASES):
+            if phase == 'tick_sleep':
+                continue
+            total = sum(self.samples[i:count * phase_count:phase_count])
+            if total > best_total:
+                best_phase, best_total = phase, total
+        return best_phase, best_total / count * 1000
+
+    def stats(self) -> Tuple[float, float, str, float]:
+        """
+        オーバーレイ用に (フレーム時間p50, p99, 最も遅い処理, その平均) を返します。
+        毎フレームのソートを避けるため、PROFILER_STATS_INTERVAL フレームごとに計算し直します。
+        """
+        if self.stats_frame_count < 0 or self.frame_count - self.stats_frame_count >= PROFILER_STATS_INTERVAL:
+            self.cached_stats = (self.frame_percentile(50), self.frame_percentile(99)) + self.slowest_phase()
+            self.stats_frame_count = self.frame_count
+        return self.cached_stats
+
+    def dump_csv(self, path: str) -> None:
+        """リングバッファの内容を、フレームごとの各処理の時間 (ms) として CSV に書き出します。"""
+        phase_count = len(PROFILER_PHASES)
+        try:
+            with open(path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(['frame', 'frame_ms'] + [f"{phase}_ms" for phase in PROFILER_PHASES])
+                first_frame = max(0, self.frame_count - self.capacity)
+                for offset, slot in enumerate(self.recorded_slots()):
+                    values = self.samples[slot * phase_count:(slot + 1) * phase_count]
+                    writer.writerow([first_frame + offset, f"{self.frame_times[slot] * 1000:.4f}"] +
+                                    [f"{value * 1000:.4f}" for value in values])
+        except OSError as e:
+            print(f"警告: プロファイルを '{path}' に保存できませんでした。{e}")
+
+# --- メモリ確保とGCの計測 ---
+class AllocationTracker:
+    """
+    tracemalloc と gc.callbacks を使って、フレームごとのメモリ確保とGCの停止時間を計測する。
+    フレームごとに記録するのは、確保したまま残ったブロック数とバイト数 (解放された分を差し引いた値)、
+    フレーム中に一時的に増えた最大バイト数、GCの回数と停止時間、フレーム全体の時間。
+    レポートでは、ゲームのモジュール内でメモリを多く確保している行 (計測開始時点との差) も表示する。
+    tracemalloc を有効にしている間は全体が遅くなるので、フレーム時間は相対的な比較にだけ使うこと。
+    """
+    def __init__(self, frame_count: int = ALLOC_TRACK_FRAME_COUNT):
+        self.enabled: bool = False
+        # 1フレーム分: (残ったブロック数, 残ったバイト数, 一時的な最大バイト数, GC回数, GC停止時間ms, フレーム時間ms)
+        self.frames: Deque[Tuple[int, int, int, int, float, float]] = deque(maxlen=frame_count)
+        self.gc_collections: List[int] = [0, 0, 0] # 世代ごとのGC回数
+        self.gc_pause_ms: List[float] = [0.0, 0.0, 0.0] # 世代ごとのGC停止時間の合計
+        self.gc_max_pause_ms: float = 0.0
+        self.gc_started: float = 0.0
+        self.frame_gc_count: int = 0
+        self.frame_gc_ms: float = 0.0
+        self.frame_start: float = 0.0
+        self.frame_start_blocks: int = 0
+        self.frame_start_bytes: int = 0
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+        self.module_filter: tracemalloc.Filter = tracemalloc.Filter(True, os.path.abspath(__file__))
+
+    def start(self) -> None:
+        """計測を開始します。"""
+        if self.enabled:
+            return
+        tracemalloc.start()
+        gc.callbacks.append(self.on_gc)
+        self.enabled = True
+        self.reset()
+
+    def stop(self) -> None:
+        """計測を終了します。"""
+        if not self.enabled:
+            return
+        gc.callbacks.remove(self.on_gc)
+        tracemalloc.stop()
+        self.enabled = False
+
+    def reset(self) -> None:
+        """記録を全て捨て、メモリ確保の多い行を調べる基準をこの時点にします (新しいプレイの開始時に呼ぶ)。"""
+        if not self.enabled:
+            return
+        self.frames.clear()
+        self.gc_collections = [0, 0, 0]
+        self.gc_pause_ms = [0.0, 0.0, 0.0]
+        self.gc_max_pause_ms = 0.0
+        self.baseline = tracemalloc.take_snapshot().filter_traces([self.module_filter])
+
+    def on_gc(self, phase: str, info: Dict[str, int]) -> None:
+        """gc.callbacks から呼ばれ、GCの停止時間を計測します。"""
+        if phase == 'start':
+            self.gc_started = time.perf_counter()
+            return
+        pause_ms = (time.perf_counter() - self.gc_started) * 1000
+        generation = info['generation']
+        self.gc_collections[generation] += 1
+        self.gc_pause_ms[generation] += pause_ms
+        self.gc_max_pause_ms = max(self.gc_max_pause_ms, pause_ms)
+        self.frame_gc_count += 1
+        self.frame_gc_ms += pause_ms
+
+    def begin_frame(self) -> None:
+        """フレームの最初に呼びます。"""
+        if not self.enabled:
+            return
+        self.frame_gc_count = 0
+        self.frame_gc_ms = 0.0
+        tracemalloc.reset_peak()
+        self.frame_start_bytes = tracemalloc.get_traced_memory()[0]
+        self.frame_start_blocks = sys.getallocatedblocks()
+        self.frame_start = time.perf_counter()
+
+    def end_frame(self) -> None:
+        """フレームの最後 (clock.tick の後) に呼び、フレームの計測値を記録します。"""
+        if not self.enabled:
+            return
+        frame_ms = (time.perf_counter() - self.frame_start) * 1000
+        blocks = sys.getallocatedblocks() - self.frame_start_blocks
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        self.frames.append((blocks, current_bytes - self.frame_start_bytes, peak_bytes - self.frame_start_bytes,
+                            self.frame_gc_count, self.frame_gc_ms, frame_ms))
+
+    def overlay_lines(self) -> List[str]:
+        """デバッグ表示用の集計 (直近のフレームの平均と、GCの回数・停止時間) を返します。"""
+        if not self.frames:
+            return []
+        count = len(self.frames)
+        mean_blocks = sum(frame[0] for frame in self.frames) / count
+        mean_peak_kib = sum(frame[2] for frame in self.frames) / count / 1024
+        return [
+            f"Alloc/frame: blocks {mean_blocks:+.1f} / peak {mean_peak_kib:.1f} KiB (n={count})",
+            f"GC gen0/1/2 {self.gc_collections[0]}/{self.gc_collections[1]}/{self.gc_collections[2]}"
+            f" total {sum(self.gc_pause_ms):.1f} ms / max {self.gc_max_pause_ms:.2f} ms",
+        ]
+
+    def top_sites(self, limit: int = ALLOC_TOP_SITE_COUNT) -> List[str]:
+        """計測開始時点から、ゲームのモジュール内でメモリを多く確保した行を返します。"""
+        if not self.enabled or self.baseline is None:
+            return []
+        snapshot = tracemalloc.take_snapshot().filter_traces([self.module_filter])
+        lines = []
+        for stat in snapshot.compare_to(self.baseline, 'lineno')[:limit]:
+            frame = stat.traceback[0]
+            lines.append(f"  {os.path.basename(frame.filename)}:{frame.lineno}  {stat.size_diff / 1024:+.1f} KiB"
+                         f" ({stat.count_diff:+d} blocks, 計 {stat.size / 1024:.1f} KiB)")
+        return lines
+
+    def report(self) -> str:
+        """フレームごとの確保量、GCの停止時間、カクついたフレームとGCの関係、メモリ確保の多い行をまとめた文字列を返します。"""
+        if not self.frames:
+            return "メモリ確保の計測: 記録したフレームがありません。"
+        count = len(self.frames)
+        peaks = sorted(frame[2] for frame in self.frames)
+        hitches = [frame for frame in self.frames if frame[5] > ALLOC_HITCH_FRAME_MS]
+        hitches_with_gc = sum(1 for frame in hitches if frame[3] > 0)
+        frames_with_gc = sum(1 for frame in self.frames if frame[3] > 0)
+        lines = [
+            f"メモリ確保の計測 ({count} フレーム)",
+            f"  残ったブロック数/フレーム: 平均 {sum(frame[0] for frame in self.frames) / count:+.1f}",
+            f"  残ったバイト数/フレーム: 平均 {sum(frame[1] for frame in self.frames) / count:+.0f} B",
+            f"  一時的な最大確保量/フレーム: 中央値 {peaks[count // 2] / 1024:.1f} KiB / 最大 {peaks[-1] / 1024:.1f} KiB",
+            f"  GC回数 (世代0/1/2): {self.gc_collections[0]}/{self.gc_collections[1]}/{self.gc_collections[2]}"
+            f"  停止時間 (世代0/1/2): {self.gc_pause_ms[0]:.1f}/{self.gc_pause_ms[1]:.1f}/{self.gc_pause_ms[2]:.1f} ms"
+            f"  最大 {self.gc_max_pause_ms:.2f} ms",
+            f"  {ALLOC_HITCH_FRAME_MS:.1f} ms を超えたフレーム: {len(hitches)} 件 (うちGCあり {hitches_with_gc} 件)"
+            f" / GCがあったフレーム: {frames_with_gc} 件",
+            "  メモリ確保の多い行 (計測開始時点との差):",
+        ]
+        return "\n".join(lines + self.top_sites())
+
+settings: Dict[str, float] = dict(DEFAULT_SETTINGS) # main() で設定ファイルから読み込む
+song_clock: SongClock = SongClock(settings['audio_offset_ms'])
+calibration: Calibration = Calibration()
+latency_monitor: LatencyMonitor = LatencyMonitor()
+frame_profiler: FrameProfiler = FrameProfiler() # --profile で有効にする
+allocation_tracker: AllocationTracker = AllocationTracker() # --trace-alloc で有効にする
+
+# --- 1プレイ分のゲーム状態 (セッション) ---
+class GameSession:
+    """
+    1プレイ分のゲーム状態 (スコア、コンボ、HP、画面上のノーツ、判定強化・フィーバー、判定表示) と、
+    それを進めるゲームロジックをまとめたもの。
+    状態はモジュールのグローバル変数ではなくインスタンスに持つので、1つのプロセスで複数のセッションを
+    同時に動かせる (画面分割での対戦や、ヘッドレスでのまとめてのシミュレーションなど)。
+    ゲーム時間は clock (SongClock または VirtualClock) から受け取る。音楽の再生・停止は行わない。
+    recorder を渡すと、判定した入力をリプレイとして記録する。
+    """
+    def __init__(self, beatmap: CompiledBeatmap, clock, activate_boost_initially: bool = False,
+                 recorder: Optional[ReplayRecorder] = None):
+        self.beatmap: CompiledBeatmap = beatmap
+        self.clock = clock # SongClock または VirtualClock
+        self.recorder: Optional[ReplayRecorder] = recorder
+        self.profiler: Optional[FrameProfiler] = None # プロファイラが有効なときだけ設定する
+        self.activate_boost_initially: bool = activate_boost_initially
+        self.reset(activate_boost_initially)
+
+    def reset(self, activate_boost_initially: bool = False) -> None:
+        """ゲームの全状態を初期値にします。
+        activate_boost_initially: ゲーム開始時に判定強化を有効にするかどうか。
+        """
+        self.score: int = 0
+        self.combo: int = 0
+        self.max_combo: int = 0
+        self.current_hp: int = MAX_HP
+        # notes はレーンごとに開始時間順でノーツ (Note) を保持するインデックス
+        self.notes: LaneNoteIndex = LaneNoteIndex(LANE_COUNT)
+        self.beatmap_index: int = 0 # 次に生成する譜面のノーツの位置
+        self.spawn_end_index: int = len(self.beatmap) # この位置より前のノーツだけを生成する (練習区間の終わり)
+        self.start_ms: float = 0.0 # プレイを始めるゲーム時間 (練習モードでは区間の始め)
+        self.section_end_ms: Optional[float] = None # 練習区間の終わり。None なら曲の最後まで
+        self.game_state: int = GAME_STATE_PLAYING # ゲーム開始状態に設定
+        self.clock.stop() # ゲーム時間をリセット
+        self.next_logic_tick_ms: float = 0.0 # 次にゲームロジックを進めるゲーム時間 (ms)
+        self.tick_count: int = 0 # これまでに進めたロジックtick数 (リプレイで入力との順序を再現するのに使う)
+        self.judgement_effect_timer: int = 0
+        self.judgement_message: str = ""
+        self.judgement_color: Tuple[int, int, int] = WHITE
+        self.judgement_boost_active: bool = activate_boost_initially # 判定強化が現在有効か
+        self.judgement_boost_timer: int = JUDGEMENT_BOOST_DURATION_FRAMES if activate_boost_initially else 0 # 判定強化の残り時間（ロジックtick数）
+        self.fever_active: bool = False # フィーバーが現在有効か (コンボ数で継続)
+        self.fever_flash_color_timer: int = 0 # 色を点滅させるためのタイマー (今回は背景には使わないが、他の用途のために残しておく)
+        self.lane_effects: List[Optional[Tuple[int, int, int]]] = [None] * LANE_COUNT
+        self.lane_effect_timers: List[int] = [0] * LANE_COUNT
+        # 「今、どのキーが押され続けているか」を記録するための変数
+        self.held_keys = set()
+
+    def result(self) -> Dict[str, int]:
+        """プレイ結果 (スコア、最大コンボ、残りHP、最後まで到達したか) を返します。"""
+        return {
+            'score': self.score,
+            'max_combo': self.max_combo,
+            'current_hp': self.current_hp,
+            'finished': int(self.judgement_message == "FINISH!"), # 1: 最後まで到達 / 0: ゲームオーバー
+        }
+
+    def seek(self, start_ms: float, end_ms: Optional[float] = None) -> None:
+        """
+        練習モード用に、ゲーム時間 start_ms からプレイを始める状態にします (reset() の直後に呼ぶ)。
+        end_ms を指定すると、その時間までに開始するノーツだけを出し、判定が終わったら FINISH! にする。
+        譜面は開始時間順に並んでいるので、最初に生成するノーツの位置は二分探索で O(log n) で求まる。
+        start_ms の時点で判定範囲を過ぎているノーツは飛ばし、落下途中のノーツはこの場で生成する
+        (位置はゲーム時間から計算するので、曲の最初から流した場合と同じ位置に表示される)。
+        押し始めの判定範囲を過ぎていても本体が判定ラインに掛かっているロングノーツは、押せないノーツとして生成する。
+        """
+        start_times = self.beatmap.start_times
+        self.notes.clear()
+        self.beatmap_index = bisect.bisect_left(start_times, start_ms - JUDGEMENT_WINDOW_GOOD)
+        # 譜面で最も長いノーツの長さまで遡れば、start_ms の時点で本体が残っているロングノーツは全て見つかる
+        for i in range(bisect.bisect_left(start_times, start_ms - self.beatmap.max_note_length_ms), self.beatmap_index):
+            note_start_ms, lane, note_end_ms = self.beatmap[i]
+            if note_end_ms >= start_ms:
+                note = Note(lane, note_start_ms, note_end_ms)
+                note.hit = True # 押し始めを取り逃したものとして扱う (区間の外のノーツなので MISS にはしない)
+                self.notes.add(note)
+        self.spawn_end_index = len(self.beatmap) if end_ms is None else bisect.bisect_right(start_times, end_ms)
+        self.start_ms = start_ms
+        self.section_end_ms = end_ms
+        self.next_logic_tick_ms = start_ms
+        self.generate_notes(start_ms)
+
+    def apply_beatmap(self, beatmap: CompiledBeatmap) -> Tuple[int, int]:
+        """
+        プレイ中に譜面を差し替えます (譜面のホットリロード用)。音楽とゲーム時間はそのままで、画面上のノーツも残す。
+        まだ判定できる範囲 (現在から GOOD 判定の範囲より後) で生成済みのノーツだけを新旧の譜面で比べ、
+        増えたノーツはこの場で生成し、消えたノーツのうち未ヒットのものを画面から外す。
+        まだ生成していないノーツは、新しい譜面の対応する位置から続けて生成する。
+        比べるのは画面に出ている分だけなので、譜面全体の長さに関係なく処理は軽い。
+        (追加したノーツ数, 外したノーツ数) を返します。
+        """
+        old_beatmap = self.beatmap
+        cutoff_ms = self.next_logic_tick_ms - JUDGEMENT_WINDOW_GOOD # これより前に始まるノーツはもう押せない
+        old_begin = min(bisect.bisect_left(old_beatmap.start_times, cutoff_ms), self.beatmap_index)
+        new_begin = bisect.bisect_left(beatmap.start_times, cutoff_ms)
+        if self.beatmap_index > old_begin:
+            # 同じ開始時間のノーツはまとめて生成されるので、最後に生成したノーツの開始時間までが生成済み
+            new_index = bisect.bisect_right(beatmap.start_times, old_beatmap.start_times[self.beatmap_index - 1])
+        else:
+            new_index = new_begin
+        old_spawned = Counter(old_beatmap[i] for i in range(old_begin, self.beatmap_index))
+        new_spawned = Counter(beatmap[i] for i in range(new_begin, new_index))
+
+        for start_ms, lane, end_ms in (new_spawned - old_spawned).elements():
+            self.notes.insert(Note(lane, start_ms, end_ms))
+        removed = 0
+        for (start_ms, lane, end_ms), count in (old_spawned - new_spawned).items():
+            for note in self.notes.iter_lane(lane):
+                if count == 0 or note.start_time_ms > start_ms:
+                    break
+                # 押し始めたロングノーツなど、判定を始めたノーツはそのまま残す
+                if note.start_time_ms == start_ms and note.end_time_ms == end_ms and not note.hit:
+                    self.notes.retire(note)
+                    count -= 1
+                    removed += 1
+
+        self.beatmap = beatmap
+        self.beatmap_index = new_index
+        self.spawn_end_index = len(beatmap) if self.section_end_ms is None else \
+            bisect.bisect_right(beatmap.start_times, self.section_end_ms)
+        return sum((new_spawned - old_spawned).values()), removed
+
+    # --- 入力の判定 ---
+    def process_key_press(self, event: pygame.event.Event, event_time_ms: float) -> None:
+        """
+        キーが押された際のノーツ判定処理を行います。
+        単発ノーツのヒット判定と、ロングノーツの押し始め判定を行います。
+        event_time_ms はイベントを取り出した時点のゲーム時間で、ノーツの開始時間とのずれ (ms) で判定します。
+        """
+        if self.game_state == GAME_STATE_PLAYING and event.key in key_to_lane_idx:
+            pressed_lane_idx = key_to_lane_idx[event.key]
+            play_sound(t_sound) # 効果音を鳴らす
+
+            self.judgement_effect_timer = 30
+            self.lane_effect_timers[pressed_lane_idx] = 10
+
+            # 押されたレーンのノーツの中から、開始時間が判定範囲内で最も近い、まだヒットされていないノーツを探す
+            # (単発ノーツ、またはロングノーツの開始点)
+            hit_note = self.notes.find_nearest(pressed_lane_idx, event_time_ms, JUDGEMENT_WINDOW_GOOD)
+
+            if hit_note is not None:
+                time_diff = abs(event_time_ms - hit_note.start_time_ms)
+                score_gained = 0
+
+                # 判定ロジック (単発ノーツまたはロングノーツの押し始め)
+                if self.judgement_boost_active and time_diff <= JUDGEMENT_WINDOW_GOOD:
+                    self.judgement_message = "PERFECT! (Boosted)"
+                    self.judgement_color = GREEN
+                    score_gained = 100
+                elif time_diff <= JUDGEMENT_WINDOW_PERFECT:
+                    self.judgement_message = "PERFECT!"
+                    self.judgement_color = GREEN
+                    score_gained = 100
+                elif time_diff <= JUDGEMENT_WINDOW_GOOD:
+                    self.judgement_message = "GOOD!"
+                    self.judgement_color = YELLOW
+                    score_gained = 50
+
+                self.score += score_gained
+                self.combo += 1
+                self.max_combo = max(self.max_combo, self.combo)
+                self.lane_effects[pressed_lane_idx] = self.judgement_color # エフェクト色を設定
+
+                # HP回復 (コンボが3の倍数で回復)
+                if self.combo > 0 and self.combo % 3 == 0:
+                    hp_recovered = min(10, MAX_HP - self.current_hp)
+                    self.current_hp += hp_recovered
+                    if hp_recovered > 0:
+                        self.judgement_message += f" (+{hp_recovered} HP!)"
+
+                # 判定強化の発動
+                if self.combo > 0 and self.combo % JUDGEMENT_BOOST_COMBO_THRESHOLD == 0:
+                    self.judgement_boost_active = True
+                    self.judgement_boost_timer = JUDGEMENT_BOOST_DURATION_FRAMES
+                    if "BOOST!" not in self.judgement_message:
+                        self.judgement_message += " (BOOST!)"
+
+                # フィーバーの発動
+                if self.combo >= FEVER_COMBO_THRESHOLD:
+                    if not self.fever_active:
+                        self.fever_flash_color_timer = FEVER_FLASH_INTERVAL
+                    self.fever_active = True
+
+                # ノーツの種類に応じた処理
+                if not hit_note.is_long:
+                    # 単発ノーツはヒットしたら削除
+                    self.notes.retire(hit_note)
+                    hit_note.hit = True # 処理済みとしてマーク
+                else:
+                    # ロングノーツは押し始めを判定したら 'is_holding' を True にする
+                    # インデックスからは削除せず、押下中のノーツとして記録する
+                    hit_note.is_holding = True
+                    hit_note.hit = True # 押し始めをヒット済みとしてマーク
+                    self.notes.set_holding(hit_note)
+
+            else: # ノーツが見つからなかった場合 (MISS)
+                self.combo = 0 # コンボリセット
+                self.judgement_message = "MISS!"
+                self.judgement_color = RED
+                self.lane_effects[pressed_lane_idx] = RED # エフェクト色をMISSに設定
+                self.judgement_effect_timer = 30
+                self.current_hp -= HP_LOSS_PER_MISS # HP減少
+                self.check_game_over() # ゲームオーバー判定
+
+                # コンボがリセットされたらフィーバー解除
+                self.fever_active = False
+                self.fever_flash_color_timer = 0
+
+    def process_key_release(self, event: pygame.event.Event, event_time_ms: float) -> None:
+        """
+        キーが離された際の、押下中のロングノーツの押し終わり判定を行います。
+        event_time_ms とノーツの終了時間とのずれ (ms) で判定します。
+        """
+        if self.game_state != GAME_STATE_PLAYING or event.key not in key_to_lane_idx:
+            return
+        released_lane_idx = key_to_lane_idx[event.key]
+
+        # 離されたキーに対応するレーンで、現在「押下中」のロングノーツを取り出す
+        released_long_note = self.notes.holding[released_lane_idx]
+
+        if released_long_note is not None and not released_long_note.is_released:
+            # 離すタイミングの判定
+            release_time_diff = abs(event_time_ms - released_long_note.end_time_ms)
+
+            if self.judgement_boost_active and release_time_diff <= JUDGEMENT_WINDOW_GOOD:
+                self.judgement_message = "PERFECT! (Boosted Release)"
+                self.judgement_color = GREEN
+                self.score += 100 # 離した点数
+            elif release_time_diff <= JUDGEMENT_WINDOW_PERFECT:
+                self.judgement_message = "PERFECT! (Release)"
+                self.judgement_color = GREEN
+                self.score += 100
+            elif release_time_diff <= JUDGEMENT_WINDOW_GOOD:
+                self.judgement_message = "GOOD! (Release)"
+                self.judgement_color = YELLOW
+                self.score += 50
+            else:
+                self.judgement_message = "BAD RELEASE! (Long Note)"
+                self.judgement_color = RED
+                self.current_hp -= HP_LOSS_PER_MISS # ミス時のHP減少
+
+            # 離す判定が行われたので、ノーツをインデックスから外し、状態を更新
+            self.notes.retire(released_long_note) # インデックスから外す
+            released_long_note.is_released = True # 処理済みとしてマーク
+
+            # その他の判定結果更新
+            if self.judgement_color == RED: # リリース判定がMISSならコンボリセット
+                self.combo = 0
+                self.fever_active = False
+            else: # 成功ならコンボ継続
+                self.combo += 1
+            self.max_combo = max(self.max_combo, self.combo)
+            if self.combo >= FEVER_COMBO_THRESHOLD and not self.fever_active:
+                self.fever_active = True
+                self.fever_flash_color_timer = FEVER_FLASH_INTERVAL
+
+            self.lane_effects[released_lane_idx] = self.judgement_color
+            self.judgement_effect_timer = 30
+
+    def handle_play_input(self, event: pygame.event.Event, event_time_ms: float) -> None:
+        """
+        プレイ中のキー入力を処理します。
+        判定の前に、入力の時刻までゲームロジックを進めておく (見逃し判定などと順序が入れ替わらないようにする)。
+        """
+        self.run_logic_ticks(event_time_ms)
+        self.apply_key_event(event, event_time_ms)
+
+    def apply_key_event(self, event: pygame.event.Event, event_time_ms: float) -> None:
+        """ロジックtickは進めずに、キー入力1つを判定します。リプレイの再生ではtick数を合わせてからこれを呼びます。"""
+        if event.type == pygame.KEYDOWN:
+            # 押されたキーをheld_keysに追加
+            if event.key in lane_keys:
+                self.held_keys.add(event.key)
+                if self.recorder is not None:
+                    self.recorder.record(REPLAY_KEY_DOWN, key_to_lane_idx[event.key], self.tick_count, event_time_ms)
+            # キープレス時のノーツ判定（単発ノーツヒット or ロングノーツ押し始め）
+            self.process_key_press(event, event_time_ms)
+
+        if event.type == pygame.KEYUP:
+            # 離されたキーをheld_keysから削除
+            if event.key in self.held_keys:
+                self.held_keys.remove(event.key)
+                if self.recorder is not None:
+                    self.recorder.record(REPLAY_KEY_UP, key_to_lane_idx[event.key], self.tick_count, event_time_ms)
+                # 押下中のロングノーツの押し終わり判定
+                self.process_key_release(event, event_time_ms)
+
+    def close_replay(self) -> None:
+        """リプレイの記録を終わりのレコードを付けて閉じます。記録していなければ何もしません。"""
+        if self.recorder is not None:
+            finished = int(self.judgement_message == "FINISH!")
+            self.recorder.record(REPLAY_END, finished, self.tick_count, self.next_logic_tick_ms)
+            self.recorder.close()
+            self.recorder = None
+
+    # --- ゲーム状態の更新 ---
+    def generate_notes(self, current_game_time_ms: float) -> None:
+        """
+        譜面データに基づいてノーツを生成し、notesインデックスに追加します。
+        譜面は開始時間順 (コンパイル時に並べ替え済み) なので、開始時間の列を先頭から見ていくだけでよい。
+        """
+        if self.game_state == GAME_STATE_PLAYING:
+            beatmap = self.beatmap
+            start_times = beatmap.start_times
+            spawn_until_ms = current_game_time_ms + FALL_TIME_MS # この時間までに判定ラインに届くノーツを画面上端に出す
+            while self.beatmap_index < self.spawn_end_index and start_times[self.beatmap_index] <= spawn_until_ms:
+                note_data = beatmap[self.beatmap_index] # [開始時間, レーン, 終了時間]
+                # 終了時間が開始時間より後ならロングノーツ。x座標と高さは Note の生成時に計算される
+                self.notes.add(Note(note_data[1], note_data[0], note_data[2]))
+                self.beatmap_index += 1
+
+    def miss_note(self, note: Note, message: str) -> None:
+        """判定範囲を過ぎてしまったノーツを処理済みにし、MISSとしてコンボ・HP・フィーバーを更新します。"""
+        self.notes.retire(note)
+        self.combo = 0
+        self.judgement_message = message
+        self.judgement_color = RED
+        self.lane_effects[note.lane] = RED
+        self.judgement_effect_timer = 30
+        self.current_hp -= HP_LOSS_PER_MISS
+        self.check_game_over()
+        self.fever_active = False
+        self.fever_flash_color_timer = 0
+
+    def update_notes_position(self, current_game_time_ms: float) -> None:
+        """
+        指定したゲーム時間で判定範囲を過ぎてしまったノーツを処理します。
+        (TOO LATE! / Missed Note の判定と処理を含みます)
+        ノーツの位置は時間から計算するので、ここでノーツを動かす必要はない。
+        """
+        # レーン内のノーツは開始時間順なので、まだ開始時間になっていないノーツが出てきたらそのレーンの確認を打ち切る
+        # (それより後ろのノーツは判定ラインに届いていない)。反復中の retire にも対応しているのでコピー不要
+        for lane in range(LANE_COUNT):
+            for note in self.notes.iter_lane(lane):
+                if note.start_time_ms > current_game_time_ms:
+                    break
+                # 開始時間から GOOD 判定の範囲を過ぎたノーツはもう押せない
+                missed_start = not note.hit and current_game_time_ms > note.start_time_ms + JUDGEMENT_WINDOW_GOOD
+
+                if not note.is_long:
+                    # 単発ノーツが判定範囲を完全に通り過ぎてしまった場合 (TOO LATE! / Missed Note)
+                    if missed_start:
+                        note.hit = True
+                        self.miss_note(note, "TOO LATE!")
+
+                else:
+                    # ロングノーツが開始時間になっても押されなかった場合 (MISS)
+                    # 開始時間が判定範囲を過ぎたのに、まだヒット（押し始め）されていない場合
+                    if missed_start:
+                        note.hit = True # 処理済みとしてマーク
+                        self.miss_note(note, "MISS! (Long Note Start)")
+
+                    # ロングノーツが押し始められていて、まだ終了していないが、
+                    # 終了時間を大きく過ぎてもキーが離されていない場合 (TOO LATE! for release)
+                    # is_holdingがTrueで、かつ終了時間 + GOOD判定ウィンドウを過ぎてもまだis_releasedがFalse
+                    elif note.is_holding and not note.is_released and \
+                            current_game_time_ms > note.end_time_ms + JUDGEMENT_WINDOW_GOOD:
+                        # ユーザーが離さなかった場合のMISS
+                        note.is_released = True # 終了済みマーク
+                        self.miss_note(note, "TOO LATE! (Long Note End)")
+
+                    # 練習モードで途中から生成した押せないロングノーツは、本体が判定ラインを通り過ぎたら外す
+                    elif note.hit and not note.is_holding and current_game_time_ms > note.end_time_ms:
+                        self.notes.retire(note)
+
+    def update_timers(self) -> None:
+        """各種タイマー（判定エフェクト、判定強化、フィーバー点滅、レーンエフェクト）を更新します。"""
+        # 判定強化タイマーの更新
+        if self.judgement_boost_active:
+            self.judgement_boost_timer -= 1
+            if self.judgement_boost_timer <= 0:
+                self.judgement_boost_active = False
+                self.judgement_boost_timer = 0
+
+        # フィーバー演出の点滅タイマーを更新 (背景色には影響しないが、他の要素で使う可能性を考慮して残す)
+        if self.fever_active:
+            self.fever_flash_color_timer -= 1
+            if self.fever_flash_color_timer <= 0:
+                self.fever_flash_color_timer = FEVER_FLASH_INTERVAL
+
+        # 判定メッセージ表示タイマーの更新
+        if self.judgement_effect_timer > 0:
+            self.judgement_effect_timer -= 1
+
+        # レーンエフェクトタイマーの更新
+        for i in range(LANE_COUNT):
+            if self.lane_effect_timers[i] > 0:
+                self.lane_effect_timers[i] -= 1
+                if self.lane_effect_timers[i] == 0:
+                    self.lane_effects[i] = None # タイマーが0になったらエフェクトを消す
+
+    def check_game_over(self) -> None:
+        """HPが0以下になった場合にゲームオーバー状態を設定します。"""
+        if self.current_hp <= 0:
+            self.current_hp = 0
+            self.game_state = GAME_STATE_GAME_OVER
+
+    def check_game_finish(self) -> None:
+        """
+        全てのノーツが生成され、画面上に残っているノーツがなくなった場合に
+        ゲーム終了状態（ゲームオーバー）に遷移します。
+        """
+        if self.game_state == GAME_STATE_PLAYING:
+            # 練習区間の終わりを過ぎた場合は、曲が続いていても区間の終わりとして扱う
+            section_over = self.section_end_ms is not None and \
+                self.next_logic_tick_ms > self.section_end_ms + JUDGEMENT_WINDOW_GOOD
+            # 音楽が再生中でなく、かつ全てのノーツが処理された（生成済みかつ画面上に残っていない）場合
+            if (section_over or not self.clock.is_playing()) and self.beatmap_index >= self.spawn_end_index and not self.notes:
+                # ゲームオーバー画面へ遷移
+                self.game_state = GAME_STATE_GAME_OVER
+                self.judgement_message = "FINISH!" # ゲーム終了を示すメッセージ
+
+    def update_game_logic(self, tick_time_ms: float) -> None:
+        """ゲームロジックを1tick (LOGIC_TICK_MS) 分進めます。"""
+        profiler = self.profiler
+        if profiler is None:
+            self.generate_notes(tick_time_ms) # ゲーム時間に基づいてノーツを生成
+            self.update_notes_position(tick_time_ms) # 判定外れチェック
+            self.update_timers() # 各種タイマーの更新
+        else:
+            # 同じ処理を、それぞれの時間をプロファイラで計測しながら行う
+            outer_phase = profiler.enter('spawn')
+            self.generate_notes(tick_time_ms)
+            profiler.enter('update_notes_position')
+            self.update_notes_position(tick_time_ms)
+            profiler.enter('update_timers')
+            self.update_timers()
+            profiler.enter(outer_phase)
+        self.check_game_over() # HPが0になったらゲームオーバーにする最終チェック
+        self.check_game_finish() # ゲーム終了判定（音楽終了＆ノーツ枯渇）
+
+    def run_logic_ticks(self, current_game_time_ms: float) -> None:
+        """
+        前回から経過したゲーム時間の分だけ、固定間隔でゲームロジックを進めます。
+        描画が速くても遅くても、ロジックは毎秒 FPS 回だけ進む。
+        大きな処理落ちで MAX_LOGIC_TICKS_PER_FRAME を超えた分は捨てて現在時刻から再開する
+        (ノーツの位置はゲーム時間から計算するので、捨てても譜面と曲はずれない)。
+        """
+        ticks = 0
+        while self.game_state == GAME_STATE_PLAYING and self.next_logic_tick_ms <= current_game_time_ms:
+            self.update_game_logic(self.next_logic_tick_ms)
+            self.next_logic_tick_ms += LOGIC_TICK_MS
+            self.tick_count += 1
+            ticks += 1
+            if ticks >= MAX_LOGIC_TICKS_PER_FRAME:
+                if current_game_time_ms > self.next_logic_tick_ms:
+                    self.next_logic_tick_ms = current_game_time_ms
+                    if self.recorder is not None:
+                        self.recorder.record(REPLAY_SKIP, 0, self.tick_count, self.next_logic_tick_ms)
+                break
+
+# 現在のプレイのセッション。メニューからゲームを開始するたびに作り直す
+session: GameSession = GameSession(BEATMAP, song_clock)
+
+# 練習モードの区間 (開始ms, 終了ms)。main() で --practice-from / --practice-to から設定する。
+# None なら通常のプレイ。終了が None でなければ、区間の最後まで到達するたびに区間の始めからやり直す
+practice_section: Optional[Tuple[float, Optional[float]]] = None
+
+# 譜面のホットリロード。main() で --watch を指定したときに、譜面ファイルを監視する BeatmapWatcher を設定する
+beatmap_watcher: Optional[BeatmapWatcher] = None
+watch_beatmaps: bool = False # --watch: 選んだ曲の譜面ファイルを監視する
+
+# 曲ライブラリ。main() で songs.json から読み込み、メニューで選んでいる曲の位置を selected_song_index に持つ
+song_library: List[SongEntry] = []
+selected_song_index: int = 0
+song_cache: Optional[SongCache] = None # 曲の先読みとキャッシュ (画面を使う場合だけ main() で作る)
+current_song: Optional[LoadedSong] = None # 今 BEATMAP と音楽に読み込まれている曲
+
+def preload_songs_around(index: int) -> None:
+    """選択中の曲と、その前後 SONG_PRELOAD_RADIUS 曲の読み込みを裏で始めます (選択中の曲を最初に読む)。"""
+    count = len(song_library)
+    neighbours = [(index + step) % count for distance in range(1, SONG_PRELOAD_RADIUS + 1) for step in (distance, -distance)]
+    song_cache.preload(song_library[index])
+    for neighbour in neighbours:
+        song_cache.preload(song_library[neighbour])
+    song_cache.preload(song_library[index]) # 選択中の曲を、キャッシュで最も最近使った曲にしておく
+
+def select_song(step: int) -> None:
+    """メニューで選んでいる曲を step 曲分移動し、新しく選んだ曲の周りを先読みします。"""
+    global selected_song_index
+    selected_song_index = (selected_song_index + step) % len(song_library)
+    preload_songs_around(selected_song_index)
+
+def prepare_selected_song() -> bool:
+    """
+    選択中の曲を BEATMAP と音楽に読み込みます。先読みが終わっていればディスクから読まずにすぐ終わり、
+    前回と同じ曲 (リトライ) なら、譜面 (ホットリロードしたものを含む) も音楽もそのまま使う。
+    読み込めない場合は警告を表示して False を返します。
+    """
+    global BEATMAP, current_song, beatmap_watcher
+    entry = song_library[selected_song_index]
+    try:
+        song = song_cache.get(entry)
+    except (OSError, ValueError) as e:
+        print(f"警告: 曲 '{entry.title}' を読み込めませんでした。{e}")
+        return False
+    if song is current_song:
+        return True
+    BEATMAP = song.beatmap
+    if pygame.mixer.get_init():
+        pygame.mixer.music.stop()
+        try:
+            # 音楽ファイルはキャッシュ上のバイト列から読み込む (再生時のデコードは pygame がストリーミングで行う)
+            pygame.mixer.music.load(song.open_audio(), song.audio_format)
+        except pygame.error as e:
+            print(f"警告: 音楽ファイルをロードできませんでした。{e}")
+    current_song = song
+    if watch_beatmaps:
+        if entry.chart_path.endswith('.chart'):
+            print("警告: --watch はCSV譜面にだけ対応しています。この曲の譜面は監視しません。")
+            beatmap_watcher = None
+        else:
+            beatmap_watcher = BeatmapWatcher(entry.chart_path)
+    return True
+
+def open_replay_recorder(activate_boost_initially: bool) -> Optional[ReplayRecorder]:
+    """リプレイの記録を開始します。保存先に書き込めない場合は警告を表示し、記録せずに続けます。"""
+    if not RECORD_REPLAYS:
+        return None
+    try:
+        os.makedirs(REPLAY_DIR, exist_ok=True)
+        path = replay_path_for(REPLAY_DIR, time.strftime('%Y%m%d_%H%M%S'))
+        return ReplayRecorder(path, BEATMAP.checksum, FPS, activate_boost_initially)
+    except OSError as e:
+        print(f"警告: リプレイを記録できません。{e}")
+        return None
+
+def start_game(activate_boost_initially: bool = False) -> None:
+    """
+    新しいセッションでゲームを開始できる状態にします (音楽は読み込み直さず、止めて最初から再生し直せるようにする)。
+    練習モードでは区間の始めに移動します。リプレイは曲の最初から再生する形式なので、練習モードでは記録しない。
+    譜面のホットリロード中も、途中で譜面が変わるとリプレイを再生できないので記録しない。
+    """
+    global session, game_state
+    session.close_replay() # 前のプレイの記録が残っていれば閉じる
+    record_replay = practice_section is None and not watch_beatmaps
+    recorder = open_replay_recorder(activate_boost_initially) if record_replay else None
+    session = GameSession(BEATMAP, song_clock, activate_boost_initially, recorder)
+    if practice_section is not None:
+        session.seek(*practice_section)
+    if frame_profiler.enabled:
+        frame_profiler.reset() # CSVにはこのプレイのフレームだけを書き出す
+        session.profiler = frame_profiler
+    allocation_tracker.reset()
+    game_state = GAME_STATE_PLAYING
 
     if pygame.mixer.get_init():
         pygame.mixer.music.stop()
+
+def play_music_from(start_ms: float) -> None:
+    """音楽を曲の start_ms の位置から再生し、ゲーム時間の計測を同じ位置から始めます。"""
+    if pygame.mixer.get_init():
         try:
-            pygame.mixer.music.load(MUSIC_FULL_PATH)
-        except (pygame.error, FileNotFoundError) as e:
-            print(f"警告: 音楽ファイルを再ロードできませんでした。{e}")
+            pygame.mixer.music.play(start=start_ms / 1000)
+        except pygame.error as e:
+            # 途中からの再生に対応していない形式の場合は最初から再生する (ゲーム時間はずれる)
+            print(f"警告: 音楽を途中から再生できませんでした。{e}")
+            pygame.mixer.music.play()
+    song_clock.start(start_ms) # ゲーム時間の計測を開始
+
+def restart_practice_loop() -> None:
+    """
+    練習区間の始めからやり直します。
+    セッションを初期化して区間の始めに二分探索で移動し、読み込み済みの音楽を同じ位置から再生し直すだけなので、
+    曲のどの位置の区間でも、曲の最初から流し直す必要はない。
+    """
+    session.reset(session.activate_boost_initially)
+    session.seek(*practice_section)
+    play_music_from(session.start_ms)
+
+def sync_game_state() -> None:
+    """
+    セッションが終わっていたら (HPが0になった、または曲とノーツが終わった)、ゲームオーバー画面に移り音楽を止めます。
+    練習区間をループしている場合は、区間の最後まで到達したら区間の始めに戻ります。
+    """
+    global game_state
+    if game_state == GAME_STATE_PLAYING and session.game_state == GAME_STATE_GAME_OVER:
+        if practice_section is not None and practice_section[1] is not None and session.result()['finished']:
+            restart_practice_loop()
+            return
+        game_state = GAME_STATE_GAME_OVER
+        session.close_replay()
+        dump_frame_profile()
+        report_allocations()
+        if pygame.mixer.get_init():
+            pygame.mixer.music.stop()
+
+def reload_beatmap_if_changed() -> None:
+    """
+    譜面ファイルが更新されていれば読み込み直します (--watch のとき)。
+    プレイ中なら音楽を止めずに今のセッションへ差分を反映し、それ以外では次のプレイから新しい譜面を使う。
+    """
+    global BEATMAP
+    beatmap = beatmap_watcher.poll()
+    if beatmap is None:
+        return
+    BEATMAP = beatmap
+    if game_state == GAME_STATE_PLAYING:
+        added, removed = session.apply_beatmap(beatmap)
+        print(f"譜面を再読み込みしました。(ノーツ数: {len(beatmap)}, 解析した行: {beatmap_watcher.reparsed_line_count}, "
+              f"画面に追加: {added}, 画面から削除: {removed})")
+    else:
+        print(f"譜面を再読み込みしました。(ノーツ数: {len(beatmap)}, 解析した行: {beatmap_watcher.reparsed_line_count})")
+
+def report_allocations() -> None:
+    """メモリ確保の計測が有効なら、このプレイの集計を表示します。"""
+    if allocation_tracker.enabled:
+        print(allocation_tracker.report())
+
+def dump_frame_profile() -> None:
+    """プロファイラが有効なら、リングバッファの内容を profiles/ に CSV として書き出します。"""
+    if not frame_profiler.enabled or frame_profiler.frame_count == 0:
+        return
+    try:
+        os.makedirs(PROFILER_DIR, exist_ok=True)
+    except OSError as e:
+        print(f"警告: プロファイルの保存先を作成できませんでした。{e}")
+        return
+    path = os.path.join(PROFILER_DIR, f"profile_{time.strftime('%Y%m%d_%H%M%S')}.csv")
+    frame_profiler.dump_csv(path)
+    print(f"プロファイルを '{path}' に保存しました。")
 
 # --- イベント処理の関数群 ---
 def handle_quit_event(event: pygame.event.Event) -> bool:
@@ -331,19 +1689,43 @@ def handle_quit_event(event: pygame.event.Event) -> bool:
 
 def handle_menu_input(event: pygame.event.Event) -> None:
     """メニュー画面でのキー入力を処理します。"""
-    global game_state, judgement_boost_active, game_start_time
+    global game_state
 
     if event.type == pygame.KEYDOWN: # メニュー画面から1,2キーで選択
-        if event.key == pygame.K_1: # Start without Judgment Boost
-            judgement_boost_active = False
-            reset_game_state(activate_boost_initially=False)
-            pygame.mixer.music.play()
-            game_start_time = time.time() # ゲーム開始時刻を設定
-        elif event.key == pygame.K_2: # Start with Judgment Boost
-            judgement_boost_active = True
-            reset_game_state(activate_boost_initially=True)
-            pygame.mixer.music.play()
-            game_start_time = time.time() # ゲーム開始時刻を設定
+        if event.key in (pygame.K_LEFT, pygame.K_UP): # 前の曲
+            select_song(-1)
+        elif event.key in (pygame.K_RIGHT, pygame.K_DOWN): # 次の曲
+            select_song(1)
+        elif event.key == pygame.K_1 and prepare_selected_song(): # Start without Judgment Boost
+            start_game(activate_boost_initially=False)
+            play_music_from(session.start_ms)
+        elif event.key == pygame.K_2 and prepare_selected_song(): # Start with Judgment Boost
+            start_game(activate_boost_initially=True)
+            play_music_from(session.start_ms)
+        elif event.key == pygame.K_3: # タイミング調整 (キャリブレーション)
+            game_state = GAME_STATE_CALIBRATION
+            calibration.start()
+
+def handle_calibration_input(event: pygame.event.Event, timestamp: float) -> None:
+    """
+    キャリブレーション画面でのキー入力を処理します。
+    測定中はレーンのキー (A,S,D,F) で拍に合わせて叩き、結果画面では Enter で保存、R でやり直します。
+    Esc でいつでもメニューに戻ります (保存はしません)。
+    """
+    global game_state
+    if event.type != pygame.KEYDOWN:
+        return
+    if event.key == pygame.K_ESCAPE:
+        game_state = GAME_STATE_MENU
+    elif calibration.phase == Calibration.PHASE_RESULT:
+        if event.key == pygame.K_RETURN:
+            calibration.apply(settings)
+            save_settings(SETTINGS_FULL_PATH, settings)
+            game_state = GAME_STATE_MENU
+        elif event.key == pygame.K_r:
+            calibration.start()
+    elif event.key in key_to_lane_idx:
+        calibration.handle_tap(timestamp)
 
 def handle_game_over_input(event: pygame.event.Event) -> None:
     """
@@ -353,418 +1735,269 @@ def handle_game_over_input(event: pygame.event.Event) -> None:
     if event.type == pygame.KEYDOWN and event.key == pygame.K_r: # rキーが押されたらリスタート
         game_state = GAME_STATE_MENU # Return to menu
 
-def process_key_press(event: pygame.event.Event) -> None:
-    """
-    キーが押された際のノーツ判定処理を行います。
-    単発ノーツのヒット判定と、ロングノーツの押し始め判定を行います。
-    """
-    global score, combo, max_combo, current_hp, judgement_message, judgement_color, judgement_effect_timer
-    global judgement_boost_active, judgement_boost_timer, fever_active, fever_flash_color_timer
-    global notes, lane_effects, lane_effect_timers
-    
-    if game_state == GAME_STATE_PLAYING and event.key in key_to_lane_idx:
-        pressed_lane_idx = key_to_lane_idx[event.key]
-        play_sound(t_sound) # 効果音を鳴らす
-        
-        judgement_effect_timer = 30
-        lane_effect_timers[pressed_lane_idx] = 10
-        
-        hit_note_index = -1
-        best_distance = float('inf') # 最も近いノーツを探すための距離
-
-        current_game_time_ms = (time.time() - game_start_time) * 1000
-
-        # まず、押されたレーンのノーツの中から、まだヒットされていないノーツを探す
-        # 単発ノーツ、またはロングノーツの開始点が判定ラインの範囲内にあるか
-        for i, note in enumerate(notes):
-            if note['lane'] == pressed_lane_idx and not note['hit']:
-                # ノーツの**下端**が判定ラインにどれだけ近いか
-                distance_to_judgement_line = abs(note['rect'].bottom - JUDGEMENT_LINE_Y) # ★修正点: .centery から .bottom へ
-
-                # 判定範囲内かつ、これまで見つけた中で最も近いノーツを探す
-                if distance_to_judgement_line <= JUDGEMENT_WINDOW_GOOD and distance_to_judgement_line < best_distance:
-                    best_distance = distance_to_judgement_line
-                    hit_note_index = i
-        
-        if hit_note_index != -1:
-            hit_note = notes[hit_note_index]
-            score_gained = 0
-
-            # 判定ロジック (単発ノーツまたはロングノーツの押し始め)
-            if judgement_boost_active and best_distance <= JUDGEMENT_WINDOW_GOOD:
-                judgement_message = "PERFECT! (Boosted)"
-                judgement_color = GREEN
-                score_gained = 100
-            elif best_distance <= JUDGEMENT_WINDOW_PERFECT:
-                judgement_message = "PERFECT!"
-                judgement_color = GREEN
-                score_gained = 100
-            elif best_distance <= JUDGEMENT_WINDOW_GOOD:
-                judgement_message = "GOOD!"
-                judgement_color = YELLOW
-                score_gained = 50
-            
-            score += score_gained
-            combo += 1
-            max_combo = max(max_combo, combo)
-            lane_effects[pressed_lane_idx] = judgement_color # エフェクト色を設定
-            
-            # HP回復 (コンボが3の倍数で回復)
-            if combo > 0 and combo % 3 == 0:
-                hp_recovered = min(10, MAX_HP - current_hp)
-                current_hp += hp_recovered
-                if hp_recovered > 0:
-                    judgement_message += f" (+{hp_recovered} HP!)"
-            
-            # 判定強化の発動
-            if combo > 0 and combo % JUDGEMENT_BOOST_COMBO_THRESHOLD == 0:
-                judgement_boost_active = True
-                judgement_boost_timer = JUDGEMENT_BOOST_DURATION_FRAMES
-                judgement_message = (judgement_message + " (BOOST!)") if "BOOST!" not in judgement_message else judgement_message
-            
-            # フィーバーの発動
-            if combo >= FEVER_COMBO_THRESHOLD:
-                if not fever_active:
-                    fever_flash_color_timer = FEVER_FLASH_INTERVAL
-                fever_active = True
-
-            # ノーツの種類に応じた処理
-            if hit_note['type'] == 'single':
-                # 単発ノーツはヒットしたら削除
-                notes.pop(hit_note_index)
-                hit_note['hit'] = True # 処理済みとしてマーク
-            elif hit_note['type'] == 'long':
-                # ロングノーツは押し始めを判定したら 'is_holding' を True にする
-                # リストからは削除しない
-                hit_note['is_holding'] = True
-                hit_note['hit'] = True # 押し始めをヒット済みとしてマーク
-
-        else: # ノーツが見つからなかった場合 (MISS)
-            combo = 0 # コンボリセット
-            judgement_message = "MISS!"
-            judgement_color = RED
-            lane_effects[pressed_lane_idx] = RED # エフェクト色をMISSに設定
-            judgement_effect_timer = 30
-            current_hp -= HP_LOSS_PER_MISS # HP減少
-            check_game_over() # ゲームオーバー判定
-
-            # コンボがリセットされたらフィーバー解除
-            fever_active = False
-            fever_flash_color_timer = 0
-
-
 # --- ゲーム状態更新の関数群 ---
 def check_game_start() -> None:
     """ゲーム開始条件をチェックし、ゲームを開始します。音楽の再生も行います。"""
-    global game_start_time
-    if game_state == GAME_STATE_PLAYING and pygame.mixer.get_init() and BEATMAP:
-        if not pygame.mixer.music.get_busy() and game_start_time == 0:
-            pygame.mixer.music.play()
-            game_start_time = time.time()
-
-def generate_notes() -> None:
-    """譜面データに基づいてノーツを生成し、notesリストに追加します。"""
-    global beatmap_index, notes
-    if game_state == GAME_STATE_PLAYING:
-        current_game_time_ms = (time.time() - game_start_time) * 1000
-
-        while beatmap_index < len(BEATMAP) and current_game_time_ms >= BEATMAP[beatmap_index][0] - FALL_TIME_MS:
-            note_data = BEATMAP[beatmap_index] # [開始時間, レーン, 終了時間]
-            start_time_ms = note_data[0]
-            target_lane = note_data[1]
-            end_time_ms = note_data[2] # 譜面から取得した終了時間
-
-            note_type = 'single'
-            note_height_to_draw = NOTE_HEIGHT # デフォルトは単発ノーツの高さ
-            
-            if end_time_ms > start_time_ms:
-                # ロングノーツの場合
-                note_type = 'long'
-                duration_ms = end_time_ms - start_time_ms
-                # 継続時間(ms)を落下速度に基づいてピクセル単位の高さに変換
-                # (1000.0 / FPS) は1フレームあたりのミリ秒
-                note_height_to_draw = int(duration_ms / (1000.0 / FPS) * NOTE_SPEED)
-                if note_height_to_draw < NOTE_HEIGHT: # 最低限の高さは確保
-                    note_height_to_draw = NOTE_HEIGHT
-            
-            lane_x_start = LANE_SPACING + target_lane * (LANE_WIDTH + LANE_SPACING)
-            # ノーツのy座標は画面上端から、描画高さは計算された高さ
-            new_note_rect = pygame.Rect(lane_x_start, -note_height_to_draw, LANE_WIDTH, note_height_to_draw)
-            
-            notes.append({
-                'rect': new_note_rect,
-                'lane': target_lane,
-                'hit': False,          # 単発ノーツ用: ヒットしたか (ロングノーツの押し始めにも使用)
-                'type': note_type,
-                'start_time_ms': start_time_ms,
-                'end_time_ms': end_time_ms,
-                'is_holding': False,   # ロングノーツ用: 押し始め判定後、現在押されているか
-                'is_released': False,  # ロングノーツ用: 押し終わりの判定済みか
-                'scored_hold_points': 0 # ロングノーツ用: 加算済みの長押しスコア（任意）
-            })
-            
-            beatmap_index += 1
+    if game_state == GAME_STATE_PLAYING and pygame.mixer.get_init() and session.beatmap:
+        if not pygame.mixer.music.get_busy() and not song_clock.running:
+            play_music_from(session.start_ms)
 
+# --- ヘッドレス実行 (画面・音声なしのシミュレーション) ---
+# 入力1つ分のデータ: (ゲーム時間ms, キー, 押したなら True / 離したなら False)
+HeadlessInput = Tuple[float, int, bool]
+AUTOPLAY_TAP_MS: int = 30 # 自動入力で単発ノーツを押してから離すまでの時間
 
-def update_notes_position() -> None:
+def autoplay_inputs(beatmap: CompiledBeatmap, offset_ms: float = 0.0) -> List[HeadlessInput]:
     """
-    画面上のノーツの位置を更新し、判定ラインを完全に過ぎてしまったノーツを処理します。
-    (TOO LATE! / Missed Note の判定と処理を含みます)
+    譜面の全ノーツをちょうどのタイミング (+ offset_ms) で押す入力列を作ります。
+    ロングノーツは終了時間に離し、単発ノーツは AUTOPLAY_TAP_MS 後に離します。
     """
-    global score, combo, max_combo, current_hp, judgement_message, judgement_color, judgement_effect_timer
-    global judgement_boost_active, judgement_boost_timer, fever_active, fever_flash_color_timer
-    global notes, lane_effects, lane_effect_timers
-
-    current_game_time_ms = (time.time() - game_start_time) * 1000
+    lane_to_key = {lane_idx: key for key, lane_idx in key_to_lane_idx.items()}
+    inputs: List[HeadlessInput] = []
+    for start_time, lane, end_time in beatmap:
+        key = lane_to_key[lane]
+        release_time = end_time if end_time > start_time else start_time + AUTOPLAY_TAP_MS
+        inputs.append((start_time + offset_ms, key, True))
+        inputs.append((release_time + offset_ms, key, False))
+    inputs.sort(key=lambda item: item[0])
+    return inputs
+
+def default_song_length_ms(beatmap: CompiledBeatmap) -> float:
+    """ヘッドレス実行で使う曲の長さ (最後のノーツの判定が終わる時刻) を返します。"""
+    last_end_ms = max(beatmap.end_times) if len(beatmap) else 0
+    return last_end_ms + JUDGEMENT_WINDOW_GOOD + LOGIC_TICK_MS
+
+def finish_headless_session(headless_session: GameSession, virtual_clock: VirtualClock) -> None:
+    """残りのノーツが全て処理され、曲が終わるまでロジックを1tickずつ進めます。"""
+    while headless_session.game_state == GAME_STATE_PLAYING:
+        virtual_clock.advance_to(headless_session.next_logic_tick_ms)
+        headless_session.run_logic_ticks(virtual_clock.sample())
+
+def run_headless(beatmap: CompiledBeatmap, inputs: List[HeadlessInput], activate_boost_initially: bool = False,
+                 song_length_ms: Optional[float] = None, recorder: Optional[ReplayRecorder] = None,
+                 practice: Optional[Tuple[float, Optional[float]]] = None) -> Dict[str, int]:
+    """
+    画面も音声デバイスも使わずに、譜面と入力列から1プレイ分をシミュレーションし、結果を返します。
+    ゲーム時間は VirtualClock で入力の時刻まで一気に進めるので、実時間の数百倍以上の速さで終わる。
+    判定は通常のプレイと同じ GameSession のメソッド (run_logic_ticks, process_key_press, process_key_release) で行う。
+    song_length_ms を省略した場合は、最後のノーツの判定が終わる時刻を曲の長さとする。
+    recorder を渡すと、シミュレーションした入力をリプレイとして記録する。
+    practice に (開始ms, 終了ms) を渡すと、練習モードと同じようにその区間だけをプレイする
+    (区間より前の入力と、区間より後に押した入力は無視する。区間をまたぐロングノーツの押し終わりは判定する)。
+    """
+    if song_length_ms is None:
+        song_length_ms = default_song_length_ms(beatmap)
+
+    virtual_clock = VirtualClock(song_length_ms)
+    headless_session = GameSession(beatmap, virtual_clock, activate_boost_initially, recorder)
+    if practice is not None:
+        headless_session.seek(*practice)
+    virtual_clock.start(headless_session.start_ms)
+    for time_ms, key, is_down in sorted(inputs, key=lambda item: item[0]):
+        if headless_session.game_state != GAME_STATE_PLAYING:
+            break
+        if time_ms < headless_session.start_ms:
+            continue
+        section_end_ms = headless_session.section_end_ms
+        if is_down and section_end_ms is not None and time_ms > section_end_ms:
+            continue # 区間の外のノーツを押す入力 (空振りとして MISS になってしまう)
+        virtual_clock.advance_to(time_ms)
+        headless_session.handle_play_input(pygame.event.Event(pygame.KEYDOWN if is_down else pygame.KEYUP, key=key), time_ms)
+    finish_headless_session(headless_session, virtual_clock)
+    headless_session.close_replay()
+    return headless_session.result()
+
+def run_replay(beatmap: CompiledBeatmap, replay: Replay, song_length_ms: Optional[float] = None,
+               warn: bool = True) -> Dict[str, int]:
+    """
+    リプレイを画面なしで再生し、結果を返します。
+    各入力は記録時と同じ数のロジックtickを進めてから、記録時と同じゲーム時間で apply_key_event に渡すので、
+    処理落ちでtickを捨てた場合も含めて、スコア・最大コンボ・HPが記録時と一致する。
+    warn=False にすると、譜面やロジックtick数の不一致の警告を表示しない (まとめて確認する呼び出し元用)。
+    """
+    if warn and replay.chart_checksum != beatmap.checksum:
+        print("警告: リプレイを記録したときと譜面が異なります。結果が一致しない可能性があります。")
+    if warn and replay.logic_fps != FPS:
+        print(f"警告: リプレイのロジックtick数 ({replay.logic_fps}/秒) が現在の設定 ({FPS}/秒) と異なります。")
+    if song_length_ms is None:
+        song_length_ms = default_song_length_ms(beatmap)
+
+    lane_to_key = {lane_idx: key for key, lane_idx in key_to_lane_idx.items()}
+    virtual_clock = VirtualClock(song_length_ms)
+    replay_session = GameSession(beatmap, virtual_clock, replay.activate_boost_initially)
+    virtual_clock.start()
+    for kind, lane, tick_count, time_ms in replay:
+        # 記録時と同じ数だけロジックtickを進める
+        while replay_session.game_state == GAME_STATE_PLAYING and replay_session.tick_count < tick_count:
+            virtual_clock.advance_to(replay_session.next_logic_tick_ms)
+            replay_session.run_logic_ticks(replay_session.next_logic_tick_ms)
+        if replay_session.game_state != GAME_STATE_PLAYING:
+            break
+        if kind == REPLAY_SKIP:
+            replay_session.next_logic_tick_ms = time_ms
+        elif kind == REPLAY_END:
+            if lane: # 曲の最後まで到達した記録なら、終了判定まで進める
+                finish_headless_session(replay_session, virtual_clock)
+            break
+        else:
+            virtual_clock.advance_to(time_ms)
+            event_type = pygame.KEYDOWN if kind == REPLAY_KEY_DOWN else pygame.KEYUP
+            replay_session.apply_key_event(pygame.event.Event(event_type, key=lane_to_key[lane]), time_ms)
+    else:
+        # 終わりのレコードが無い (記録中に異常終了した) 場合は、最後まで進める
+        finish_headless_session(replay_session, virtual_clock)
+    return replay_session.result()
 
-    for note in notes[:]: # リストをコピーして要素削除時にエラーを防ぐ
-        # ロングノーツが押下中の場合は、そのrectのy座標は動かさない（描画時に調整）
-        # ただし、is_holdingがFalseの通常の落下状態のときは動かす
-        if not (note['type'] == 'long' and note['is_holding']):
-            note['rect'].y += NOTE_SPEED
-        
-        if note['type'] == 'single':
-            # 単発ノーツが判定ラインを完全に通り過ぎてしまった場合 (TOO LATE! / Missed Note)
-            if note['rect'].top > JUDGEMENT_LINE_Y + JUDGEMENT_WINDOW_GOOD and not note['hit']:
-                notes.remove(note)
-                note['hit'] = True
-                # 以下、MISSの処理
-                combo = 0
-                judgement_message = "TOO LATE!"
-                judgement_color = RED
-                lane_effects[note['lane']] = RED
-                judgement_effect_timer = 30
-                current_hp -= HP_LOSS_PER_MISS
-                check_game_over()
-                fever_active = False
-                fever_flash_color_timer = 0
-                if combo < FEVER_COMBO_THRESHOLD and fever_active:
-                    fever_active = False
-                    fever_flash_color_timer = 0
-        
-        elif note['type'] == 'long':
-            # ロングノーツが開始時間になっても押されなかった場合 (MISS)
-            # ノーツの上端が判定ラインを通り過ぎたのに、まだヒット（押し始め）されていない場合
-            if not note['hit'] and note['rect'].top > JUDGEMENT_LINE_Y + JUDGEMENT_WINDOW_GOOD:
-                notes.remove(note)
-                note['hit'] = True # 処理済みとしてマーク
-                # 以下、MISSの処理
-                combo = 0
-                judgement_message = "MISS! (Long Note Start)"
-                judgement_color = RED
-                lane_effects[note['lane']] = RED
-                judgement_effect_timer = 30
-                current_hp -= HP_LOSS_PER_MISS
-                check_game_over()
-                fever_active = False
-                fever_flash_color_timer = 0
-
-            # ロングノーツが押し始められていて、まだ終了していないが、
-            # 終了時間を大きく過ぎてもキーが離されていない場合 (TOO LATE! for release)
-            # is_holdingがTrueで、かつ終了時間 + GOOD判定ウィンドウを過ぎてもまだis_releasedがFalse
-            elif note['is_holding'] and not note['is_released'] and \
-                    current_game_time_ms > note['end_time_ms'] + JUDGEMENT_WINDOW_GOOD:
-                
-                # ユーザーが離さなかった場合のMISS
-                notes.remove(note)
-                note['is_released'] = True # 終了済みマーク
-                
-                combo = 0 # MISSなのでコンボリセット
-                judgement_message = "TOO LATE! (Long Note End)"
-                judgement_color = RED
-                lane_effects[note['lane']] = RED
-                judgement_effect_timer = 30
-                current_hp -= HP_LOSS_PER_MISS
-                check_game_over()
-                fever_active = False
-                fever_flash_color_timer = 0
-            
-            # 画面外に出たロングノーツを削除 (念のため)
-            # is_holding == False の通常落下中のロングノーツが画面外に出た場合も含む
-            elif note['rect'].top > SCREEN_HEIGHT + 100: # 画面下端を十分に過ぎたら削除
-                notes.remove(note)
-
-
-def update_timers() -> None:
-    """各種タイマー（判定エフェクト、判定強化、フィーバー点滅、レーンエフェクト）を更新します。"""
-    global judgement_effect_timer, judgement_boost_timer, judgement_boost_active
-    global fever_flash_color_timer, fever_active
-    global lane_effect_timers
-
-    # 判定強化タイマーの更新
-    if judgement_boost_active:
-        judgement_boost_timer -= 1
-        if judgement_boost_timer <= 0:
-            judgement_boost_active = False
-            judgement_boost_timer = 0
-
-    # フィーバー演出の点滅タイマーを更新 (背景色には影響しないが、他の要素で使う可能性を考慮して残す)
-    if fever_active:
-        fever_flash_color_timer -= 1
-        if fever_flash_color_timer <= 0:
-            fever_flash_color_timer = FEVER_FLASH_INTERVAL
-    
-    # 判定メッセージ表示タイマーの更新
-    if judgement_effect_timer > 0:
-        judgement_effect_timer -= 1
+# --- 描画処理の関数群 ---
+def build_background_layer(background_color: Tuple[int, int, int]) -> pygame.Surface:
+    """
+    プレイ画面の変化しない部分（背景色、レーン枠、対応キー、判定ライン、HPバーの枠）を描画したSurfaceを作ります。
+    毎フレーム描き直さず、このSurfaceから必要な範囲だけを画面に写します。
+    """
+    layer = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT)).convert()
+    layer.fill(background_color)
 
-    # レーンエフェクトタイマーの更新
+    # レーンの描画
     for i in range(LANE_COUNT):
-        if lane_effect_timers[i] > 0:
-            lane_effect_timers[i] -= 1
-            if lane_effect_timers[i] == 0:
-                lane_effects[i] = None # タイマーが0になったらエフェクトを消す
+        lane_x_start = lane_x_starts[i]
+        pygame.draw.rect(layer, GRAY, (lane_x_start, 0, LANE_WIDTH, SCREEN_HEIGHT), 2) # レーンの枠
 
+        # レーンの下に対応するキーを表示
+        key_char_text = render_text(small_font, lane_idx_to_key_char[i], WHITE)
+        layer.blit(key_char_text, (lane_x_start + (LANE_WIDTH - key_char_text.get_width()) // 2, JUDGEMENT_LINE_Y + 50))
 
-def check_game_over() -> None:
-    """HPが0以下になった場合にゲームオーバー状態を設定し、音楽を停止します。"""
-    global current_hp, game_state
-    if current_hp <= 0:
-        current_hp = 0
-        game_state = GAME_STATE_GAME_OVER
-        if pygame.mixer.get_init():
-            pygame.mixer.music.stop()
+    # 判定ラインの背景とライン自体を描画
+    pygame.draw.rect(layer, GRAY, (0, JUDGEMENT_LINE_Y, SCREEN_WIDTH, NOTE_HEIGHT), 0)
+    pygame.draw.line(layer, WHITE, (0, JUDGEMENT_LINE_Y), (SCREEN_WIDTH, JUDGEMENT_LINE_Y), 3)
 
-def check_game_finish() -> None:
-    """
-    全てのノーツが生成され、画面上に残っているノーツがなくなった場合に
-    ゲーム終了状態（ゲームオーバー）に遷移します。
-    """
-    global game_state, judgement_message
-    if game_state == GAME_STATE_PLAYING:
-        # 音楽が再生中でなく、かつ全てのノーツが処理された（生成済みかつ画面上に残っていない）場合
-        if not pygame.mixer.music.get_busy() and beatmap_index >= len(BEATMAP) and not notes:
-            # ゲームオーバー画面へ遷移
-            game_state = GAME_STATE_GAME_OVER
-            judgement_message = "FINISH!" # ゲーム終了を示すメッセージ
+    # HPバーの枠 (中身は draw_info_panel で描画する)
+    pygame.draw.rect(layer, GRAY, (HP_BAR_X, HP_BAR_Y, HP_BAR_WIDTH, HP_BAR_HEIGHT), 2)
+    return layer
 
-# --- 描画処理の関数群 ---
-def draw_background() -> None:
-    """ゲームの背景（レーン枠、判定ライン、対応キー）を描画します。フィーバー中は背景色を特別な色にします。"""
-    if fever_active and game_state == GAME_STATE_PLAYING: # プレイ中のみフィーバー背景
-        screen.fill(FEVER_BACKGROUND_COLOR) # フィーバー中はごく薄い黄色の背景
-    else:
-        screen.fill(BLACK) # 通常の背景は黒
-
-    if game_state == GAME_STATE_PLAYING:
-        # レーンの描画
-        for i in range(LANE_COUNT):
-            lane_x_start = LANE_SPACING + i * (LANE_WIDTH + LANE_SPACING)
-            pygame.draw.rect(screen, GRAY, (lane_x_start, 0, LANE_WIDTH, SCREEN_HEIGHT), 2) # レーンの枠
+# 通常時とフィーバー中 (ごく薄い黄色) の背景レイヤー。起動時に一度だけ作る
+background_layers: Dict[bool, pygame.Surface] = {}
 
-            # レーンエフェクトの描画
-            if lane_effects[i]:
-                draw_lane_effect(screen, lane_x_start + LANE_WIDTH // 2, lane_effects[i], alpha=100)
+def build_background_layers() -> None:
+    """通常時とフィーバー中の背景レイヤーを作ります。画面とフォントの初期化後に呼びます。"""
+    background_layers[False] = build_background_layer(BLACK)
+    background_layers[True] = build_background_layer(FEVER_BACKGROUND_COLOR)
 
-            # レーンの下に対応するキーを表示
-            key_char_text = small_font.render(lane_idx_to_key_char[i], True, WHITE)
-            screen.blit(key_char_text, (lane_x_start + (LANE_WIDTH - key_char_text.get_width()) // 2, JUDGEMENT_LINE_Y + 50))
-        
-        # 判定ラインの背景とライン自体を描画
-        pygame.draw.rect(screen, GRAY, (0, JUDGEMENT_LINE_Y, SCREEN_WIDTH, NOTE_HEIGHT), 0)
-        pygame.draw.line(screen, WHITE, (0, JUDGEMENT_LINE_Y), (SCREEN_WIDTH, JUDGEMENT_LINE_Y), 3)
+def get_background_layer(session: GameSession) -> pygame.Surface:
+    """現在の状態に合った背景レイヤーを返します。フィーバー中は特別な色の背景にします。"""
+    return background_layers[session.fever_active]
 
-def draw_notes() -> None:
-    """現在画面に表示されているノーツを描画します。"""
-    if game_state == GAME_STATE_PLAYING:
-        current_game_time_ms = (time.time() - game_start_time) * 1000 # 現在のゲーム時間を取得
-
-        for note in notes:
-            draw_rect = note['rect'].copy() # 描画用の一時的なRectオブジェクトを作成
+def draw_lane_effects(session: GameSession) -> List[pygame.Rect]:
+    """判定ライン上のレーンエフェクトを描画し、描画した範囲を返します。"""
+    dirty_rects = []
+    for i in range(LANE_COUNT):
+        if session.lane_effects[i]:
+            dirty_rects.append(draw_lane_effect(screen, lane_x_starts[i] + LANE_WIDTH // 2, session.lane_effects[i], alpha=100))
+    return dirty_rects
 
-            if note['type'] == 'long' and note['is_holding'] and not note['is_released']:
-                # 押されているロングノーツの描画
-                # 判定ラインに下端を合わせ、上方向に縮むように描画する
-                
-                # 経過時間（開始判定からの時間）
-                elapsed_hold_time_ms = current_game_time_ms - note['start_time_ms']
-                # ロングノーツの総時間
-                total_duration_ms = note['end_time_ms'] - note['start_time_ms']
-
-                # 残りの描画するべき高さ
-                # 総時間に対する残りの時間の比率で高さを計算
-                # 落下速度基準で計算された元の高さを利用
-                original_total_height = int(total_duration_ms / (1000.0 / FPS) * NOTE_SPEED)
-                
-                # 進行度合いに応じた縮小される高さ
-                played_height = int(elapsed_hold_time_ms / (1000.0 / FPS) * NOTE_SPEED)
-                
-                # 現在の描画高さ
-                current_draw_height = original_total_height - played_height
+def draw_notes(session: GameSession, current_game_time_ms: float) -> List[pygame.Rect]:
+    """
+    現在画面に表示されているノーツを描画し、描画した範囲をレーンごとにまとめて返します。
+    ノーツの位置は描画時点のゲーム時間から計算するので、ロジックの更新間隔に関係なく滑らかに動く。
+    """
+    dirty_rects = []
+    if session.game_state == GAME_STATE_PLAYING:
+        for lane in range(LANE_COUNT):
+            lane_top = SCREEN_HEIGHT
+            lane_bottom = 0
+            for note in session.notes.iter_lane(lane):
+                if note.is_long and note.is_holding and not note.is_released:
+                    # 押されているロングノーツの描画
+                    # 判定ラインに下端を合わせ、上方向に縮むように描画する
                 
-                # 最低限の高さは確保 (例: NOTE_HEIGHT)
-                if current_draw_height < NOTE_HEIGHT:
-                    current_draw_height = NOTE_HEIGHT
-
-                # 描画Rectのy座標と高さを調整
-                # 下端を判定ラインに合わせる (JUDGEMENT_LINE_Yはノーツの下端が来るべき位置)
-                draw_rect.height = current_draw_height
-                draw_rect.y = JUDGEMENT_LINE_Y - current_draw_height # 判定ラインのYから高さを引いてY座標を決定
-
-                # 押下中の色 (例: 元の色の半分)
-                active_color = (lane_colors[note['lane']][0] // 2, lane_colors[note['lane']][1] // 2, lane_colors[note['lane']][2] // 2)
-                pygame.draw.rect(screen, active_color, draw_rect)
-
-            elif note['type'] == 'long' and not note['is_holding'] and not note['is_released']:
-                # まだ押されていない（落下中）のロングノーツ
-                pygame.draw.rect(screen, lane_colors[note['lane']], draw_rect)
-            
-            elif note['type'] == 'single':
-                # 単発ノーツ
-                pygame.draw.rect(screen, lane_colors[note['lane']], draw_rect)
+                    # 経過時間（開始判定からの時間）
+                    elapsed_hold_time_ms = current_game_time_ms - note.start_time_ms
 
-def draw_info_panel() -> None:
-    """スコア、コンボ、最高コンボ、HPバー、判定強化の残り時間を描画します。"""
-    if game_state == GAME_STATE_PLAYING:
+                    # 残りの描画するべき高さ
+                    # 生成時に落下速度基準で計算した高さ (note.height) から、進行度合いに応じて縮める
+                    played_height = int(elapsed_hold_time_ms * SCROLL_SPEED)
+                
+                    # 現在の描画高さ (最低限の高さは確保)
+                    current_draw_height = max(note.height - played_height, NOTE_HEIGHT)
+
+                    # 下端を判定ラインに合わせる (JUDGEMENT_LINE_Yはノーツの下端が来るべき位置)
+                    # 押下中の色は lane_active_colors に事前計算してある
+                    note_top = JUDGEMENT_LINE_Y - current_draw_height
+                    pygame.draw.rect(screen, lane_active_colors[note.lane],
+                                     (note.x, note_top, LANE_WIDTH, current_draw_height))
+                    lane_top = min(lane_top, note_top)
+                    lane_bottom = max(lane_bottom, JUDGEMENT_LINE_Y)
+
+                elif not note.is_released:
+                    # 単発ノーツ、またはまだ押されていない（落下中）のロングノーツ
+                    note_top = note.top_at(current_game_time_ms)
+                    if note_top >= SCREEN_HEIGHT:
+                        continue
+                    if note_top + note.height <= 0:
+                        break # これより後ろのノーツはまだ画面の上にある
+                    pygame.draw.rect(screen, lane_colors[note.lane], (note.x, note_top, LANE_WIDTH, note.height))
+                    lane_top = min(lane_top, note_top)
+                    lane_bottom = max(lane_bottom, note_top + note.height)
+
+            if lane_top < lane_bottom:
+                # 小数座標の丸めで1px ずれても消し残しが出ないよう、上下に1px 余裕を持たせる
+                dirty_rects.append(pygame.Rect(lane_x_starts[lane], int(lane_top) - 1, LANE_WIDTH, int(lane_bottom - lane_top) + 3))
+    return dirty_rects
+
+def draw_info_panel(session: GameSession) -> List[pygame.Rect]:
+    """スコア、コンボ、最高コンボ、HPバー、判定強化の残り時間を描画し、描画した範囲を返します。"""
+    dirty_rects = []
+    if session.game_state == GAME_STATE_PLAYING:
         # スコア、コンボ、最高コンボの表示
-        score_text = font.render(f"Score: {score}", True, WHITE)
+        score_text = render_text(font, f"Score: {session.score}", WHITE)
         # フィーバー中はコンボ文字を黄色にする
-        combo_color = YELLOW if fever_active else WHITE
-        combo_text = font.render(f"Combo: {combo}", True, combo_color)
-        max_combo_text = small_font.render(f"Max Combo: {max_combo}", True, WHITE)
+        combo_color = YELLOW if session.fever_active else WHITE
+        combo_text = render_text(font, f"Combo: {session.combo}", combo_color)
+        max_combo_text = render_text(small_font, f"Max Combo: {session.max_combo}", WHITE)
         
-        screen.blit(score_text, (10, 10))
-        screen.blit(combo_text, (10, 50))
+        dirty_rects.append(screen.blit(score_text, (10, 10)))
+        dirty_rects.append(screen.blit(combo_text, (10, 50)))
         # マックスコンボのY座標を調整してHPバーと重ならないようにする
-        screen.blit(max_combo_text, (SCREEN_WIDTH - max_combo_text.get_width() - 10, 40))
+        dirty_rects.append(screen.blit(max_combo_text, (SCREEN_WIDTH - max_combo_text.get_width() - 10, 40)))
+
+        # HPバーの描画 (枠は背景レイヤーに描画済み)
+        hp_bar_x = HP_BAR_X
+        hp_bar_y = HP_BAR_Y
+        hp_bar_fill_width = int(HP_BAR_WIDTH * (session.current_hp / MAX_HP))
+        dirty_rects.append(pygame.Rect(hp_bar_x, hp_bar_y, HP_BAR_WIDTH, HP_BAR_HEIGHT))
 
-        # HPバーの描画
-        hp_bar_x = (SCREEN_WIDTH - HP_BAR_WIDTH) // 2
-        hp_bar_y = 10
-        hp_bar_fill_width = int(HP_BAR_WIDTH * (current_hp / MAX_HP))
-        
-        pygame.draw.rect(screen, GRAY, (hp_bar_x, hp_bar_y, HP_BAR_WIDTH, HP_BAR_HEIGHT), 2) # HPバーの枠
         # HPに応じて色を変える (今回は紫を追加)
-        if current_hp > MAX_HP / 3:
+        if session.current_hp > MAX_HP / 3:
             hp_fill_color = PURPLE # HPが1/3より上なら紫
         else:
             hp_fill_color = RED # HPが1/3以下なら赤
         pygame.draw.rect(screen, hp_fill_color, (hp_bar_x, hp_bar_y, hp_bar_fill_width, HP_BAR_HEIGHT)) # HPの量
         
-        hp_text = small_font.render(f"HP: {current_hp}/{MAX_HP}", True, WHITE)
-        screen.blit(hp_text, (hp_bar_x + HP_BAR_WIDTH + 10, hp_bar_y)) # HPの数値
+        hp_text = render_text(small_font, f"HP: {session.current_hp}/{MAX_HP}", WHITE)
+        dirty_rects.append(screen.blit(hp_text, (hp_bar_x + HP_BAR_WIDTH + 10, hp_bar_y))) # HPの数値
 
         # 判定強化の残り時間を表示
-        if judgement_boost_active:
-            boost_text = small_font.render(f"Boost: {judgement_boost_timer // FPS + 1}s", True, CYAN) # シアン色で表示
-            screen.blit(boost_text, (SCREEN_WIDTH - boost_text.get_width() - 10, 70)) # この位置も調整したよ
-
-def draw_judgement_message() -> None:
-    """判定メッセージ（PERFECT!, GOOD!, MISS!, TOO LATE!）を表示します。"""
-    if game_state == GAME_STATE_PLAYING and judgement_effect_timer > 0:
-        judgement_display = font.render(judgement_message, True, judgement_color)
+        if session.judgement_boost_active:
+            boost_text = render_text(small_font, f"Boost: {session.judgement_boost_timer // FPS + 1}s", CYAN) # シアン色で表示
+            dirty_rects.append(screen.blit(boost_text, (SCREEN_WIDTH - boost_text.get_width() - 10, 70))) # この位置も調整したよ
+    return dirty_rects
+
+def draw_judgement_message(session: GameSession) -> List[pygame.Rect]:
+    """判定メッセージ（PERFECT!, GOOD!, MISS!, TOO LATE!）を表示し、描画した範囲を返します。"""
+    if session.game_state == GAME_STATE_PLAYING and session.judgement_effect_timer > 0:
+        judgement_display = render_text(font, session.judgement_message, session.judgement_color)
         judgement_rect = judgement_display.get_rect(center=(SCREEN_WIDTH // 2, JUDGEMENT_LINE_Y - 50))
-        screen.blit(judgement_display, judgement_rect)
+        return [screen.blit(judgement_display, judgement_rect)]
+    return []
     
-def draw_game_over_screen() -> None:
+def draw_game_over_screen(session: GameSession) -> None:
     """ゲームオーバー時の画面（メッセージ、最終スコア、リスタート指示）を描画します。"""
-    if game_state == GAME_STATE_GAME_OVER:
+    if session.game_state == GAME_STATE_GAME_OVER:
         # メッセージが"FINISH!"であればそのまま、そうでなければ"GAME OVER!"を表示
-        display_message = judgement_message if judgement_message == "FINISH!" else "GAME OVER!"
-        game_over_text = large_font.render(display_message, True, WHITE if display_message == "FINISH!" else RED)
+        display_message = session.judgement_message if session.judgement_message == "FINISH!" else "GAME OVER!"
+        game_over_text = render_text(large_font, display_message, WHITE if display_message == "FINISH!" else RED)
         
-        final_score_text = font.render(f"Final Score: {score}", True, WHITE)
-        max_combo_final_text = font.render(f"Max Combo: {max_combo}", True, WHITE)
+        final_score_text = render_text(font, f"Final Score: {session.score}", WHITE)
+        max_combo_final_text = render_text(font, f"Max Combo: {session.max_combo}", WHITE)
         
         go_rect = game_over_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 80))
         fs_rect = final_score_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 20))
@@ -774,7 +2007,7 @@ def draw_game_over_screen() -> None:
         screen.blit(final_score_text, fs_rect)
         screen.blit(max_combo_final_text, mc_rect)
         
-        restart_text = small_font.render("Rキーでメニューに戻る", True, WHITE) # 日本語
+        restart_text = render_text(small_font, RESTART_TEXT, WHITE) # 日本語
         restart_rect = restart_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 100))
         screen.blit(restart_text, restart_rect)
 
@@ -783,11 +2016,11 @@ def draw_menu_screen() -> None:
     screen.fill(BLACK) # メニュー画面は黒背景
     
     # ★「君もシャイニングマスターの道へ」キャッチフレーズの表示調整
-    line1_text = "音と光が織りなす究極の律動――"
-    line2_text = "さぁ、君もシャイニングマスターの道へ！"
+    line1_text = MENU_CATCHPHRASE_LINE1
+    line2_text = MENU_CATCHPHRASE_LINE2
 
-    rendered_line1 = font.render(line1_text, True, WHITE)
-    rendered_line2 = small_font.render(line2_text, True, WHITE)
+    rendered_line1 = render_text(font, line1_text, WHITE)
+    rendered_line2 = render_text(small_font, line2_text, WHITE)
 
     y_pos_line1 = SCREEN_HEIGHT // 2 - 180
     y_pos_line2 = SCREEN_HEIGHT // 2 - 130 # 1行目と2行目の間隔を調整
@@ -798,168 +2031,345 @@ def draw_menu_screen() -> None:
     screen.blit(rendered_line1, rect1)
     screen.blit(rendered_line2, rect2)
 
+    # 選択中の曲 (←→キーで切り替え)。読み込みが終わっていればノーツ数も表示する
+    if song_library:
+        entry = song_library[selected_song_index]
+        song_title_text = render_text(font, f"← {entry.title} →", YELLOW)
+        screen.blit(song_title_text, song_title_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 85)))
+        loaded = song_cache.peek(entry) if song_cache is not None else None
+        if loaded is not None:
+            song_detail = f"{entry.artist}  ノーツ数: {len(loaded.beatmap)}"
+        elif song_cache is not None and song_cache.is_loading(entry):
+            song_detail = f"{entry.artist}  読み込み中..."
+        else:
+            song_detail = entry.artist
+        song_detail += f"  ({selected_song_index + 1}/{len(song_library)})"
+        song_detail_text = render_text(small_font, song_detail, GRAY)
+        screen.blit(song_detail_text, song_detail_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 45)))
+
     # ゲームスタートオプション
-    option1_text = font.render("1: ゲームスタート (判定強化なし)", True, WHITE)
+    option1_text = render_text(font, MENU_OPTION1_TEXT, WHITE)
     option1_rect = option1_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2))
     screen.blit(option1_text, option1_rect)
 
-    option2_text = font.render("2: ゲームスタート (判定強化あり)", True, CYAN) # Boostはシアン
+    option2_text = render_text(font, MENU_OPTION2_TEXT, CYAN) # Boostはシアン
     option2_rect = option2_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 60))
     screen.blit(option2_text, option2_rect)
 
+    option3_text = render_text(small_font, MENU_OPTION3_TEXT, WHITE)
+    option3_rect = option3_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 115))
+    screen.blit(option3_text, option3_rect)
+
     # 操作説明
-    info_text = small_font.render("対応する数字キーを押して選択してください", True, GRAY)
-    info_rect = info_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 150))
+    info_text = render_text(small_font, MENU_INFO_TEXT, GRAY)
+    info_rect = info_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 170))
     screen.blit(info_text, info_rect)
 
+    # 練習モードの区間 (起動時に --practice-from / --practice-to で指定した場合)
+    if practice_section is not None:
+        section_start_ms, section_end_ms = practice_section
+        practice_line = f"練習モード: {section_start_ms / 1000:.1f}秒から"
+        if section_end_ms is not None:
+            practice_line += f" {section_end_ms / 1000:.1f}秒までをループ"
+        practice_text = render_text(small_font, practice_line, YELLOW)
+        screen.blit(practice_text, practice_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 215)))
+
+
+def draw_calibration_screen() -> None:
+    """キャリブレーション画面 (測定中の案内と拍の表示、測定結果) を描画します。"""
+    title_text = render_text(font, CALIBRATION_TITLE_TEXT, WHITE)
+    screen.blit(title_text, title_text.get_rect(center=(SCREEN_WIDTH // 2, 80)))
+
+    if calibration.phase == Calibration.PHASE_RESULT:
+        lines = [
+            (f"入力の遅延: {calibration.input_offset_ms:+.1f} ms", WHITE),
+            (f"表示の遅延: {calibration.visual_offset_ms:+.1f} ms", WHITE),
+            ("Enter: 保存してメニューへ  R: やり直す  Esc: 保存せず戻る", GRAY),
+        ]
+        for i, (line, color) in enumerate(lines):
+            text = render_text(small_font, line, color)
+            screen.blit(text, text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 40 + i * 60)))
+        return
 
-# --- メインのゲームループ ---
-clock = pygame.time.Clock() # mainループの外で一度だけ初期化
+    if calibration.phase == Calibration.PHASE_AUDIO:
+        guide = "クリック音に合わせて A/S/D/F を叩いてください"
+    else:
+        guide = "ラインが光るタイミングで A/S/D/F を叩いてください"
+    guide_text = render_text(small_font, guide, WHITE)
+    screen.blit(guide_text, guide_text.get_rect(center=(SCREEN_WIDTH // 2, 160)))
+
+    # 表示フェーズでは拍に合わせて判定ラインを光らせる
+    line_color = CYAN if calibration.is_flashing() else GRAY
+    pygame.draw.rect(screen, line_color, (0, JUDGEMENT_LINE_Y, SCREEN_WIDTH, NOTE_HEIGHT), 0)
+
+    progress = f"{len(calibration.beat_times)}/{CALIBRATION_BEATS}  測定数: {len(calibration.tap_errors[calibration.phase])}"
+    progress_text = render_text(small_font, progress, GRAY)
+    screen.blit(progress_text, progress_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)))
+
+def draw_debug_overlay() -> List[pygame.Rect]:
+    """デバッグ表示 (描画FPSと、入力→判定表示の遅延のパーセンタイル) を左下に描画し、描画した範囲を返します。"""
+    lines = [
+        f"FPS: {clock.get_fps():.0f}",
+        f"Input->Judge p50 {latency_monitor.percentile(50):.1f} / p95 {latency_monitor.percentile(95):.1f}"
+        f" / p99 {latency_monitor.percentile(99):.1f} ms (n={len(latency_monitor.samples)})",
+        f"Offset audio {settings['audio_offset_ms']:+.0f} / input {settings['input_offset_ms']:+.0f}"
+        f" / visual {settings['visual_offset_ms']:+.0f} ms",
+        f"Text cache hits {text_cache.hits} / misses {text_cache.misses} ({len(text_cache.surfaces)}/{text_cache.max_size})",
+    ] + allocation_tracker.overlay_lines()
+    dirty_rects = []
+    for i, line in enumerate(lines):
+        text = render_text(small_font, line, CYAN)
+        dirty_rects.append(screen.blit(text, (10, SCREEN_HEIGHT - 30 * (len(lines) - i))))
+    return dirty_rects
+
+def draw_profiler_overlay() -> List[pygame.Rect]:
+    """プロファイラの集計 (フレーム時間の p50/p99 と、最も時間のかかっている処理) を右下に描画し、描画した範囲を返します。"""
+    p50, p99, slowest, slowest_ms = frame_profiler.stats()
+    lines = [
+        f"Frame p50 {p50:.2f} / p99 {p99:.2f} ms (n={min(frame_profiler.frame_count, frame_profiler.capacity)})",
+        f"Slowest: {slowest} {slowest_ms:.2f} ms/frame",
+    ]
+    dirty_rects = []
+    for i, line in enumerate(lines):
+        text = render_text(small_font, line, YELLOW)
+        rect = text.get_rect(bottomright=(SCREEN_WIDTH - 10, SCREEN_HEIGHT - 10 - 30 * (len(lines) - 1 - i)))
+        dirty_rects.append(screen.blit(text, rect))
+    return dirty_rects
+
+# --- 差分描画 (ダーティ矩形) ---
+class DirtyRectRenderer:
+    """
+    プレイ画面を、変化した範囲 (ダーティ矩形) だけ描き直して画面に送る。
+    前フレームで動く要素を描いた範囲を背景レイヤーで消し、今フレームの要素を描いて、
+    両方の範囲だけを pygame.display.update(rects) で送る。画面全体の塗りつぶしと flip は、
+    背景が切り替わったとき (フィーバーの開始・終了、画面遷移) だけ行う。
+    """
+    def __init__(self):
+        self.background: Optional[pygame.Surface] = None
+        self.previous_rects: List[pygame.Rect] = []
+        self.full_redraw: bool = True
+        self.screen_rect: pygame.Rect = screen.get_rect()
+
+    def invalidate(self) -> None:
+        """次のフレームで画面全体を描き直すようにします (プレイ画面以外を描画したときなど)。"""
+        self.full_redraw = True
+
+    def begin_frame(self, background: pygame.Surface) -> None:
+        """前フレームで描いた範囲を背景で消します。背景が変わっていれば画面全体に背景を描きます。"""
+        if background is not self.background:
+            self.background = background
+            self.full_redraw = True
+        if self.full_redraw:
+            screen.blit(background, (0, 0))
+        else:
+            for rect in self.previous_rects:
+                screen.blit(background, rect, rect)
+
+    def present(self, dirty_rects: List[pygame.Rect]) -> None:
+        """今フレームで描いた範囲と、前フレームで消した範囲を画面に送ります。"""
+        rects = [rect.clip(self.screen_rect) for rect in dirty_rects]
+        rects = [rect for rect in rects if rect.width > 0 and rect.height > 0]
+        if self.full_redraw:
+            pygame.display.flip()
+            self.full_redraw = False
+        else:
+            pygame.display.update(self.previous_rects + rects)
+        self.previous_rects = rects
 
-running = True
-while running:
+# --- メインのゲームループ ---
+clock: pygame.time.Clock
+renderer: DirtyRectRenderer
 
-    # ゲームの状態更新
-    if game_state == GAME_STATE_PLAYING:
-        check_game_start() # 音楽再生とゲーム開始のチェック
-    
-        # Generate notes based on current game time, not just frame count
-        # This makes note generation more robust against frame rate drops
-        current_game_time_ms = (time.time() - game_start_time) * 1000
-        while beatmap_index < len(BEATMAP) and current_game_time_ms >= BEATMAP[beatmap_index][0] - FALL_TIME_MS:
-            note_data = BEATMAP[beatmap_index]
-            start_time_ms = note_data[0]
-            target_lane = note_data[1]
-            end_time_ms = note_data[2]
-
-            note_type = 'single'
-            note_height_to_draw = NOTE_HEIGHT
-            
-            if end_time_ms > start_time_ms:
-                note_type = 'long'
-                duration_ms = end_time_ms - start_time_ms
-                # Calculate height based on duration and note speed
-                note_height_to_draw = int(duration_ms / (1000.0 / FPS) * NOTE_SPEED)
-                if note_height_to_draw < NOTE_HEIGHT:
-                    note_height_to_draw = NOTE_HEIGHT
-            
-            lane_x_start = LANE_SPACING + target_lane * (LANE_WIDTH + LANE_SPACING)
-            new_note_rect = pygame.Rect(lane_x_start, -note_height_to_draw, LANE_WIDTH, note_height_to_draw)
-            
-            notes.append({
-                'rect': new_note_rect,
-                'lane': target_lane,
-                'hit': False,
-                'type': note_type,
-                'start_time_ms': start_time_ms,
-                'end_time_ms': end_time_ms,
-                'is_holding': False,
-                'is_released': False,
-                'scored_hold_points': 0
-            })
-            beatmap_index += 1
-
-        update_notes_position() # ノーツの移動と判定外れチェック
-        update_timers() # 各種タイマーの更新
-        check_game_over() # HPが0になったらゲームオーバーにする最終チェック
-        check_game_finish() # ゲーム終了判定（音楽終了＆ノーツ枯渇）
-
-    # 描画
-    screen.fill(BLACK) # 毎フレーム画面をクリア
-
-    if game_state == GAME_STATE_MENU:
-        draw_menu_screen()
-    elif game_state == GAME_STATE_PLAYING:
-        draw_background() # 背景とレーン枠、判定ライン、キーの描画
-        draw_notes() # ノーツの描画
-        draw_info_panel() # スコア、コンボ、HPバーなどの描画
-        draw_judgement_message() # 判定メッセージの描画
-    elif game_state == GAME_STATE_GAME_OVER:
-        draw_game_over_screen() # ゲームオーバー画面の描画
-
-    for event in pygame.event.get():
-        running = handle_quit_event(event) # QUITイベントを処理
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    ゲームを起動します。--headless を付けると、画面を開かずに譜面を自動プレイした結果を表示します。
+    --replay を付けると、リプレイファイルを画面なしで再生した結果を表示します。
+    --profile を付けると、フレームごとの処理時間を計測します (F4キーで集計を表示、プレイ終了時にCSVへ保存)。
+    --trace-alloc を付けると、フレームごとのメモリ確保とGCの停止時間を計測します (プレイ終了時に集計を表示)。
+    --watch を付けると、プレイ中に譜面ファイルを保存するとその場で反映します (譜面作成用)。
+    曲は songs.json の曲ライブラリからメニューで選びます (--beatmap を指定した場合はその譜面の1曲だけ)。
+    """
+    global clock, renderer, BEATMAP, settings, song_clock, practice_section, watch_beatmaps, song_library, song_cache
+
+    parser = argparse.ArgumentParser(description="君もシャイニングマスターの道へ")
+    parser.add_argument('--headless', action='store_true', help="画面・音声なしで譜面を自動プレイし、結果を表示して終了します")
+    parser.add_argument('--beatmap', default=BEATMAP_FULL_PATH, help="使用する譜面ファイル (既定: beatmap.csv)")
+    parser.add_argument('--boost', action='store_true', help="判定強化を有効にして開始します (--headless 用)")
+    parser.add_argument('--replay', default=None, help="リプレイファイル (.rpl) を画面なしで再生し、結果を表示して終了します")
+    parser.add_argument('--practice-from', type=float, default=None, metavar='秒',
+                        help="練習モード: 曲のこの位置 (秒) から始めます")
+    parser.add_argument('--practice-to', type=float, default=None, metavar='秒',
+                        help="練習モード: --practice-from からこの位置 (秒) までの区間をループします")
+    parser.add_argument('--profile', action='store_true', help="フレームごとの処理時間を計測し、プレイ終了時に profiles/ へCSVで保存します")
+    parser.add_argument('--trace-alloc', action='store_true',
+                        help="フレームごとのメモリ確保とGCの停止時間を計測し、プレイ終了時に集計を表示します (動作は遅くなります)")
+    parser.add_argument('--watch', action='store_true',
+                        help="譜面ファイル (CSV) を監視し、保存するとプレイ中でも音楽を止めずに反映します (リプレイは記録しません)")
+    args = parser.parse_args(argv)
+
+    if args.practice_from is not None or args.practice_to is not None:
+        section_start_ms = max(0.0, (args.practice_from or 0.0) * 1000)
+        section_end_ms = args.practice_to * 1000 if args.practice_to is not None else None
+        if section_end_ms is not None and section_end_ms <= section_start_ms:
+            parser.error("--practice-to には --practice-from より後の位置を指定してください")
+        practice_section = (section_start_ms, section_end_ms)
+
+    if args.replay:
+        BEATMAP = load_beatmap(args.beatmap)
+        try:
+            replay = Replay.load(args.replay)
+        except (OSError, ReplayFormatError) as e:
+            print(f"エラー: リプレイファイルを読み込めませんでした。{e}")
+            sys.exit(1)
+        print(json.dumps(run_replay(BEATMAP, replay), ensure_ascii=False))
+        sys.exit(0)
+
+    if args.headless:
+        BEATMAP = load_beatmap(args.beatmap)
+        wall_start = time.perf_counter()
+        result = run_headless(BEATMAP, autoplay_inputs(BEATMAP), activate_boost_initially=args.boost, practice=practice_section)
+        wall_ms = (time.perf_counter() - wall_start) * 1000
+        song_ms = max(BEATMAP.end_times) if len(BEATMAP) else 0
+        print(json.dumps(result, ensure_ascii=False))
+        print(f"シミュレーション時間: {wall_ms:.1f} ms (実時間の {song_ms / max(wall_ms, 1e-3):.0f} 倍)")
+        sys.exit(0)
+
+    pygame.init()
+    pygame.mixer.init()
+    init_display()
+    load_fonts()
+    prerender_static_texts()
+    load_sounds()
+    build_background_layers()
+
+    # 曲ライブラリを読み込み、選択中の曲とその前後を裏で読み込み始める (メニューを表示している間に終わる)
+    default_song = SongEntry(DEFAULT_SONG_TITLE, DEFAULT_SONG_ARTIST, MUSIC_FULL_PATH, args.beatmap)
+    if args.beatmap == BEATMAP_FULL_PATH:
+        song_library = load_song_library(SONG_LIBRARY_FULL_PATH, default_song)
+    else:
+        song_library = [default_song] # 譜面を指定した場合は、その譜面だけを遊ぶ
+    song_cache = SongCache()
+    preload_songs_around(selected_song_index)
+    watch_beatmaps = args.watch
+    settings = load_settings(SETTINGS_FULL_PATH)
+    song_clock = SongClock(settings['audio_offset_ms'])
+
+    clock = pygame.time.Clock() # mainループの外で一度だけ初期化
+    renderer = DirtyRectRenderer()
+    show_debug_overlay = False # F3キーで切り替える
+    show_profiler_overlay = False # F4キーで切り替える (--profile のときのみ)
+    frame_profiler.enabled = args.profile
+    if args.trace_alloc:
+        allocation_tracker.start()
+
+    running = True
+    while running:
+        frame_profiler.begin_frame()
+        allocation_tracker.begin_frame()
+        profiler_enter = frame_profiler.enter
+
+        # 1. 入力: 描画より先にイベントを処理し、入力が1フレーム遅れないようにする
+        events = pygame.event.get()
+        # イベントを取り出した時点の高精度タイムスタンプ。判定はフレームの描画時刻ではなくこの時刻で行う
+        event_timestamp = time.perf_counter()
+        for event in events:
+            running = handle_quit_event(event) # QUITイベントを処理
+            if not running:
+                break
+
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                show_debug_overlay = not show_debug_overlay # デバッグ表示の切り替え
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F4 and frame_profiler.enabled:
+                show_profiler_overlay = not show_profiler_overlay # プロファイラ表示の切り替え
+            elif game_state == GAME_STATE_MENU:
+                handle_menu_input(event)
+            elif game_state == GAME_STATE_CALIBRATION:
+                handle_calibration_input(event, event_timestamp)
+            elif game_state == GAME_STATE_PLAYING:
+                # 入力の遅延補正 (キャリブレーションで測定) を引いたゲーム時間で判定する
+                event_time_ms = song_clock.time_at(event_timestamp) - settings['input_offset_ms']
+                if event.type == pygame.KEYDOWN and event.key in lane_keys:
+                    latency_monitor.mark_input(event_timestamp)
+                session.handle_play_input(event, event_time_ms)
+                sync_game_state()
+
+            elif game_state == GAME_STATE_GAME_OVER:
+                handle_game_over_input(event)
         if not running:
             break
 
-        if game_state == GAME_STATE_MENU:
-            handle_menu_input(event)
-        elif game_state == GAME_STATE_PLAYING:
-            if event.type == pygame.KEYDOWN:
-                # 押されたキーをheld_keysに追加
-                if event.key in lane_keys:
-                    held_keys.add(event.key)
-                # キープレス時のノーツ判定（単発ノーツヒット or ロングノーツ押し始め）
-                process_key_press(event)
-            
-            if event.type==pygame.KEYUP:
-                # 離されたキーをheld_keysから削除
-                if event.key in held_keys:
-                    released_lane_idx = key_to_lane_idx[event.key]
-                    held_keys.remove(event.key)
-
-                    current_game_time_ms = (time.time() - game_start_time) * 1000
-
-                    # 離されたキーに対応するレーンで、現在「押下中」のロングノーツを探す
-                    found_long_note_index = -1
-                    for i, note in enumerate(notes):
-                        if note['type'] == 'long' and note['lane'] == released_lane_idx and note['is_holding'] and not note['is_released']:
-                            found_long_note_index = i
-                            break
-                    
-                    if found_long_note_index != -1:
-                        released_long_note = notes[found_long_note_index]
-                        
-                        # 離すタイミングの判定
-                        release_time_diff = abs(current_game_time_ms - released_long_note['end_time_ms'])
-
-                        if judgement_boost_active and release_time_diff <= JUDGEMENT_WINDOW_GOOD:
-                            judgement_message = "PERFECT! (Boosted Release)"
-                            judgement_color = GREEN
-                            score += 100 # 離した点数
-                        elif release_time_diff <= JUDGEMENT_WINDOW_PERFECT:
-                            judgement_message = "PERFECT! (Release)"
-                            judgement_color = GREEN
-                            score += 100
-                        elif release_time_diff <= JUDGEMENT_WINDOW_GOOD:
-                            judgement_message = "GOOD! (Release)"
-                            judgement_color = YELLOW
-                            score += 50
-                        else:
-                            judgement_message = "BAD RELEASE! (Long Note)"
-                            judgement_color = RED
-                            current_hp -= HP_LOSS_PER_MISS # ミス時のHP減少
-
-                        # 離す判定が行われたので、ノーツをリストから削除し、状態を更新
-                        notes.pop(found_long_note_index) # リストから削除
-                        released_long_note['is_released'] = True # 処理済みとしてマーク
-
-                        # その他の判定結果更新
-                        if judgement_color == RED: # リリース判定がMISSならコンボリセット
-                            combo = 0
-                            fever_active = False
-                        else: # 成功ならコンボ継続
-                            combo += 1
-                        max_combo = max(max_combo, combo)
-                        if combo >= FEVER_COMBO_THRESHOLD and not fever_active:
-                            fever_active = True
-                            fever_flash_color_timer = FEVER_FLASH_INTERVAL
-
-                        lane_effects[released_lane_idx] = judgement_color
-                        judgement_effect_timer = 30
-                        # break # そのレーンのロングノーツは一つしかありえないので抜ける (popでリストのインデックスが変わるためbreakは必要)
-
-        elif game_state == GAME_STATE_GAME_OVER:
-            handle_game_over_input(event)
-    
-    # 長押し中のノーツ表示 (キーが押されている間、下部の四角を描画する機能)
-    for key in held_keys:
-        if key in pressing_notes:
-            pressing_notes[key].update(screen)
+        # 2. 更新: 描画のフレームレートに関係なく、固定間隔のロジックtickで進める
+        profiler_enter('logic')
+        if beatmap_watcher is not None:
+            reload_beatmap_if_changed()
+        if game_state == GAME_STATE_PLAYING:
+            check_game_start() # 音楽再生とゲーム開始のチェック
+            current_game_time_ms = song_clock.sample() # ゲーム時間はフレームごとに1回だけ計算する
+            session.run_logic_ticks(current_game_time_ms)
+            sync_game_state()
+        elif game_state == GAME_STATE_CALIBRATION:
+            calibration.update()
+
+        # 3. 描画
+        if game_state == GAME_STATE_PLAYING:
+            # プレイ画面は背景レイヤーの上に動く要素だけを描き、変化した範囲だけを画面に送る
+            profiler_enter('draw_background')
+            renderer.begin_frame(get_background_layer(session))
+            profiler_enter('draw_lane_effects')
+            dirty_rects = draw_lane_effects(session) # 判定ライン上のレーンエフェクト
+            # ノーツの描画 (描画時点のゲーム時間から位置を計算し、表示の遅延補正の分だけ先の位置に描く)
+            profiler_enter('draw_notes')
+            dirty_rects += draw_notes(session, current_game_time_ms + settings['visual_offset_ms'])
+            profiler_enter('draw_info_panel')
+            dirty_rects += draw_info_panel(session) # スコア、コンボ、HPバーなどの描画
+            profiler_enter('draw_judgement_message')
+            dirty_rects += draw_judgement_message(session) # 判定メッセージの描画
+            profiler_enter('draw_other')
+
+            # 長押し中のノーツ表示 (キーが押されている間、下部の四角を描画する機能)
+            for key in session.held_keys:
+                if key in pressing_notes:
+                    dirty_rects.append(pressing_notes[key].update(screen))
+
+            if show_debug_overlay:
+                dirty_rects += draw_debug_overlay()
+            if show_profiler_overlay:
+                dirty_rects += draw_profiler_overlay()
+            profiler_enter('present')
+            renderer.present(dirty_rects)
+        else:
+            profiler_enter('draw_other')
+            screen.fill(BLACK) # プレイ画面以外は毎フレーム画面全体を描き直す
+            if game_state == GAME_STATE_MENU:
+                draw_menu_screen()
+            elif game_state == GAME_STATE_CALIBRATION:
+                draw_calibration_screen()
+            elif game_state == GAME_STATE_GAME_OVER:
+                draw_game_over_screen(session) # ゲームオーバー画面の描画
+
+            if show_debug_overlay:
+                draw_debug_overlay()
+            if show_profiler_overlay:
+                draw_profiler_overlay()
+            renderer.invalidate()
+            profiler_enter('present')
+            pygame.display.flip()
+
+        latency_monitor.frame_presented()
+        profiler_enter('tick_sleep')
+        clock.tick(render_fps_limit)
+        frame_profiler.end_frame()
+        allocation_tracker.end_frame()
+
+    session.close_replay() # プレイ中に終了した場合も、そこまでの入力を保存する
+    if game_state == GAME_STATE_PLAYING:
+        dump_frame_profile() # プレイ中に終了した場合も、そこまでの計測結果を保存する
+        report_allocations()
+    allocation_tracker.stop()
+    song_cache.shutdown()
+    pygame.quit()
+    sys.exit()
 
-    # 画面の更新とフレームレート固定
-    pygame.display.flip()
-    clock.tick(FPS)
 
-pygame.quit()
-sys.exit()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
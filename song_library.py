@@ -0,0 +1,190 @@
+import io
+import json
+import os
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from compile_beatmap import CHART_RECORD_SIZE, CompiledBeatmap, load_compiled_beatmap
+
+#  曲ライブラリ
+# 遊べる曲を (音楽ファイル, 譜面, 曲名などの情報) の組として songs.json に並べる。
+# 曲の読み込み (譜面のコンパイルと mmap、音楽ファイルの読み込み) はスレッドプールで先読みし、
+# 合計サイズに上限のあるLRUキャッシュに保持するので、曲を選び直したりリトライしたりしてもディスクから読み直さない。
+#
+# songs.json の形式 (audio / chart は songs.json のあるディレクトリからの相対パス):
+#   {"songs": [{"title": "曲名", "artist": "作曲者", "audio": "曲.mp3", "chart": "譜面.csv"}, ...]}
+
+SONG_CACHE_MAX_BYTES: int = 64 * 1024 * 1024 # キャッシュに保持する曲の合計サイズの上限 (音楽ファイル + 譜面)
+SONG_PRELOAD_WORKERS: int = 2 # 先読みに使うスレッド数
+
+# 読み込んだときの元ファイルの状態: (音楽ファイルのサイズ, 更新時刻ns, 譜面のサイズ, 更新時刻ns)
+SourceStamp = Tuple[int, int, int, int]
+
+
+class SongEntry:
+    """ライブラリの1曲分の情報 (曲名、作曲者、音楽ファイルと譜面のパス)。"""
+    def __init__(self, title: str, artist: str, audio_path: str, chart_path: str):
+        self.title: str = title
+        self.artist: str = artist
+        self.audio_path: str = audio_path
+        self.chart_path: str = chart_path
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        """キャッシュのキー。同じ音楽ファイルと譜面の組なら同じ曲として扱う。"""
+        return self.audio_path, self.chart_path
+
+
+class LoadedSong:
+    """読み込み済みの曲。譜面はコンパイル済みの CompiledBeatmap、音楽ファイルはデコード前のバイト列で保持する。"""
+    def __init__(self, entry: SongEntry, beatmap: CompiledBeatmap, audio_data: bytes, stamp: SourceStamp):
+        self.entry: SongEntry = entry
+        self.beatmap: CompiledBeatmap = beatmap
+        self.audio_data: bytes = audio_data
+        self.stamp: SourceStamp = stamp
+        self.size_bytes: int = len(audio_data) + len(beatmap) * CHART_RECORD_SIZE
+
+    def open_audio(self) -> io.BytesIO:
+        """pygame.mixer.music.load() に渡せる、メモリ上の音楽ファイルを返します (再生のたびに新しく作る)。"""
+        return io.BytesIO(self.audio_data)
+
+    @property
+    def audio_format(self) -> str:
+        """音楽ファイルの形式 (拡張子)。メモリから読み込むときに pygame に形式を伝えるのに使う。"""
+        return os.path.splitext(self.entry.audio_path)[1].lstrip('.').lower()
+
+
+def source_stamp(entry: SongEntry) -> SourceStamp:
+    """曲の音楽ファイルと譜面のサイズと更新時刻を返します。"""
+    audio = os.stat(entry.audio_path)
+    chart = os.stat(entry.chart_path)
+    return audio.st_size, audio.st_mtime_ns, chart.st_size, chart.st_mtime_ns
+
+
+def load_song(entry: SongEntry) -> LoadedSong:
+    """
+    曲の譜面と音楽ファイルを読み込みます (スレッドプールから呼ばれる)。
+    ファイルが無い場合は OSError、譜面が不正な場合は ValueError (BeatmapFormatError を含む) を送出します。
+    """
+    stamp = source_stamp(entry) # 読み込む前に取り、読み込み中に更新された場合は次回読み込み直されるようにする
+    beatmap = load_compiled_beatmap(entry.chart_path)
+    with open(entry.audio_path, 'rb') as f:
+        audio_data = f.read()
+    return LoadedSong(entry, beatmap, audio_data, stamp)
+
+
+def load_song_library(path: str, default_entry: SongEntry) -> List[SongEntry]:
+    """
+    songs.json から曲の一覧を読み込みます。
+    ファイルが無い・読めない場合は default_entry だけの一覧を返し、不正な曲の項目は警告を表示して飛ばします。
+    """
+    if not os.path.exists(path):
+        return [default_entry]
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            items = json.load(f)['songs']
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"警告: 曲ライブラリ '{path}' を読み込めませんでした。既定の曲だけを使います。{e}")
+        return [default_entry]
+    base_dir = os.path.dirname(os.path.abspath(path))
+    songs: List[SongEntry] = []
+    for item in items:
+        try:
+            songs.append(SongEntry(str(item['title']), str(item.get('artist', '')),
+                                   os.path.join(base_dir, item['audio']), os.path.join(base_dir, item['chart'])))
+        except (KeyError, TypeError, AttributeError) as e:
+            print(f"警告: 曲ライブラリの不正な項目をスキップしました: {item} ({e})")
+    return songs or [default_entry]
+
+
+class SongCache:
+    """
+    読み込み済みの曲を、合計サイズが max_bytes 以下になるよう LRU (最も長く使われていないものから捨てる) で保持する。
+    preload() は読み込みをスレッドプールに任せてすぐに戻るので、曲を選んでいる間に裏で読み込んでおける。
+    get() は読み込みが終わるまで待って曲を返す。元のファイルが更新されていた場合だけ読み込み直す。
+    hits / misses で効果を確認できる。キャッシュの操作はメインスレッドからだけ行う。
+    """
+    def __init__(self, max_bytes: int = SONG_CACHE_MAX_BYTES, workers: int = SONG_PRELOAD_WORKERS):
+        self.max_bytes: int = max_bytes
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='song-preload')
+        self.songs: 'OrderedDict[Tuple[str, str], Future]' = OrderedDict() # Future の結果は LoadedSong
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def preload(self, entry: SongEntry) -> None:
+        """曲の読み込みを (まだなら) 始めます。読み込み済みなら最近使ったものとして扱います。"""
+        future = self.songs.get(entry.key)
+        if future is None or self._is_stale(future):
+            self.songs[entry.key] = self.executor.submit(load_song, entry)
+        self.songs.move_to_end(entry.key)
+        self._evict(entry.key)
+
+    def peek(self, entry: SongEntry) -> Optional[LoadedSong]:
+        """読み込みが終わっていれば曲を返します (待たない)。読み込み中・失敗した場合は None を返します。"""
+        future = self.songs.get(entry.key)
+        if future is None or not future.done() or future.exception() is not None:
+            return None
+        return future.result()
+
+    def is_loading(self, entry: SongEntry) -> bool:
+        future = self.songs.get(entry.key)
+        return future is not None and not future.done()
+
+    def get(self, entry: SongEntry) -> LoadedSong:
+        """
+        曲を返します。読み込み中なら終わるまで待ち、キャッシュに無い・元のファイルが更新されていれば読み込みます。
+        読み込みに失敗した場合は load_song() の例外をそのまま送出します (失敗した結果はキャッシュに残さない)。
+        """
+        future = self.songs.get(entry.key)
+        if future is not None and not self._is_stale(future):
+            self.hits += 1
+        else:
+            self.misses += 1
+            future = self.executor.submit(load_song, entry)
+            self.songs[entry.key] = future
+        self.songs.move_to_end(entry.key)
+        try:
+            song = future.result()
+        except BaseException:
+            del self.songs[entry.key]
+            raise
+        self._evict(entry.key)
+        return song
+
+    def size_bytes(self) -> int:
+        """読み込み済みの曲の合計サイズ。"""
+        return sum(song.size_bytes for song in self._loaded_songs())
+
+    def shutdown(self) -> None:
+        """まだ始まっていない先読みを取り消し、スレッドプールを終了します。"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _loaded_songs(self) -> List[LoadedSong]:
+        return [future.result() for future in self.songs.values() if future.done() and future.exception() is None]
+
+    def _is_stale(self, future: Future) -> bool:
+        """読み込みに失敗したか、読み込んだ後に元のファイルが更新された (または消えた) 場合に True を返します。"""
+        if not future.done():
+            return False
+        if future.exception() is not None:
+            return True
+        song = future.result()
+        try:
+            return source_stamp(song.entry) != song.stamp
+        except OSError:
+            return True
+
+    def _evict(self, keep: Tuple[str, str]) -> None:
+        """合計サイズが上限を超えていれば、keep 以外の読み込み済みの曲を古いものから捨てます。"""
+        total = self.size_bytes()
+        for key in list(self.songs):
+            if total <= self.max_bytes:
+                break
+            future = self.songs[key]
+            if key == keep or not future.done():
+                continue
+            if future.exception() is None:
+                total -= future.result().size_bytes
+            del self.songs[key]
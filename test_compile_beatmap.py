@@ -0,0 +1,58 @@
+import os
+import threading
+
+from compile_beatmap import compile_beatmap, compiled_path_for, is_compiled_chart_stale, load_compiled_beatmap
+
+
+def test_chart_is_stale_when_csv_is_restored_with_old_mtime(tmp_path):
+    # git checkout や cp -p のように、コンパイル済み譜面より古い更新時刻のCSVに置き換わった (同じ長さの行に書き換え)
+    csv_path = tmp_path / 'beatmap.csv'
+    csv_path.write_text("1000,0\n2000,1\n")
+    old_mtime_ns = os.stat(csv_path).st_mtime_ns
+    chart_path = compile_beatmap(str(csv_path))
+    assert not is_compiled_chart_stale(str(csv_path), chart_path)
+
+    csv_path.write_text("1000,2\n2000,3\n")
+    restored_mtime_ns = old_mtime_ns - 10 * 10**9
+    os.utime(csv_path, ns=(restored_mtime_ns, restored_mtime_ns))
+
+    assert is_compiled_chart_stale(str(csv_path), chart_path)
+    assert list(load_compiled_beatmap(str(csv_path))) == [(1000, 2, 1000), (2000, 3, 2000)]
+
+
+def test_chart_without_source_stamp_is_stale(tmp_path):
+    # ヘッダが壊れた・古い形式の譜面は、CSVより新しくてもコンパイルし直す
+    csv_path = tmp_path / 'beatmap.csv'
+    csv_path.write_text("1000,0\n")
+    chart_path = compiled_path_for(str(csv_path))
+    with open(chart_path, 'wb') as f:
+        f.write(b'RGBM\x02\x00')
+
+    assert is_compiled_chart_stale(str(csv_path), chart_path)
+    assert list(load_compiled_beatmap(str(csv_path))) == [(1000, 0, 1000)]
+
+
+def test_concurrent_compiles_of_the_same_chart(tmp_path):
+    # 曲の先読みのスレッドプールのように、同じ譜面を複数のスレッドが同時にコンパイルする
+    csv_path = tmp_path / 'beatmap.csv'
+    csv_path.write_text("".join(f"{i * 100},{i % 4}\n" for i in range(2000)))
+    barrier = threading.Barrier(4)
+    errors = []
+
+    def compile_repeatedly() -> None:
+        barrier.wait()
+        try:
+            for _ in range(20):
+                compile_beatmap(str(csv_path))
+        except OSError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=compile_repeatedly) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(load_compiled_beatmap(str(csv_path))) == 2000
+    assert sorted(os.listdir(tmp_path)) == ['beatmap.chart', 'beatmap.csv']
@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import create_beatmap
+
+
+def write_journal(path, text: str) -> None:
+    with open(path, 'w', newline='') as f:
+        f.write(text)
+
+
+def read_lines(path) -> list:
+    with open(path, 'r') as f:
+        return f.read().splitlines()
+
+
+def test_recover_drops_torn_last_row(tmp_path):
+    # 異常終了で "500,3,900" の途中までしか書かれなかったジャーナル。切れた行は別のノーツとして読めてしまう
+    output = tmp_path / 'beatmap.csv'
+    write_journal(create_beatmap.journal_path_for(str(output)), "2000,1,2500\n1000,0\n500,3,9")
+
+    with pytest.raises(SystemExit):
+        create_beatmap.main(['-o', str(output), '--recover'])
+
+    assert read_lines(output) == ["1000,0", "2000,1,2500"]
+    assert not os.path.exists(create_beatmap.journal_path_for(str(output)))
+
+
+def test_truncate_partial_line_keeps_complete_rows(tmp_path):
+    journal = tmp_path / 'beatmap.csv.journal'
+    write_journal(journal, "1000,0\n9000,2,95")
+
+    create_beatmap.truncate_partial_line(str(journal))
+
+    assert read_lines(journal) == ["1000,0"]
+    assert create_beatmap.last_journal_time(str(journal)) == 1000
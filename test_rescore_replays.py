@@ -0,0 +1,58 @@
+import csv
+import os
+import struct
+
+import pytest
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import rescore_replays
+from replay import (Replay, ReplayFormatError, REPLAY_END, REPLAY_HEADER_FORMAT, REPLAY_KEY_DOWN, REPLAY_KEY_UP,
+                    REPLAY_MAGIC, REPLAY_RECORD_FORMAT, REPLAY_VERSION)
+
+
+def write_replay(path, records) -> None:
+    """(種類, レーン, ロジックtick数, ゲーム時間ms) のレコードからリプレイファイルを書きます。"""
+    with open(path, 'wb') as f:
+        f.write(struct.pack(REPLAY_HEADER_FORMAT, REPLAY_MAGIC, REPLAY_VERSION, 0, 60, 0, 0))
+        for kind, lane, tick_count, time_ms in records:
+            f.write(struct.pack(REPLAY_RECORD_FORMAT, time_ms, tick_count, lane, kind))
+
+
+def test_replay_rejects_bad_lane(tmp_path):
+    path = tmp_path / 'bad_lane.rpl'
+    write_replay(path, [(REPLAY_KEY_DOWN, 7, 0, 1000.0)])
+
+    with pytest.raises(ReplayFormatError):
+        Replay.load(str(path))
+
+
+def test_replay_rejects_unknown_kind(tmp_path):
+    path = tmp_path / 'bad_kind.rpl'
+    write_replay(path, [(9, 0, 0, 1000.0)])
+
+    with pytest.raises(ReplayFormatError):
+        Replay.load(str(path))
+
+
+def test_bad_replay_becomes_error_row(tmp_path):
+    # 壊れたリプレイが1つあっても、他のリプレイは採点されて結果の CSV が書き出される
+    beatmap = tmp_path / 'beatmap.csv'
+    beatmap.write_text("1000,0\n2000,1\n")
+    good = tmp_path / 'good.rpl'
+    write_replay(good, [(REPLAY_KEY_DOWN, 0, 60, 1000.0), (REPLAY_KEY_UP, 0, 66, 1100.0), (REPLAY_END, 0, 66, 1100.0)])
+    bad = tmp_path / 'bad.rpl'
+    write_replay(bad, [(REPLAY_KEY_DOWN, 7, 60, 1000.0)])
+    output = tmp_path / 'results.csv'
+
+    rescore_replays.main([str(good), str(bad), '--beatmap', str(beatmap), '-j', '1',
+                          '-o', str(output), '-d', str(tmp_path / 'distribution.csv')])
+
+    with open(output, newline='', encoding='utf-8') as f:
+        rows = {os.path.basename(row['replay']): row for row in csv.DictReader(f)}
+    assert rows['good.rpl']['error'] == ''
+    assert int(rows['good.rpl']['score']) > 0
+    assert rows['bad.rpl']['score'] == ''
+    assert 'lane=7' in rows['bad.rpl']['error']
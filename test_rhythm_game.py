@@ -0,0 +1,47 @@
+import os
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import rhythm_game
+from compile_beatmap import load_compiled_beatmap
+
+
+def load_chart(tmp_path, text: str):
+    path = tmp_path / 'beatmap.csv'
+    path.write_text(text)
+    return load_compiled_beatmap(str(path))
+
+
+def test_seek_into_long_note_keeps_its_body(tmp_path):
+    # 1000ms から 3000ms までのロングノーツの途中 (2000ms) から練習を始める
+    beatmap = load_chart(tmp_path, "1000,2,3000\n4000,0\n")
+    clock = rhythm_game.VirtualClock(rhythm_game.default_song_length_ms(beatmap))
+    session = rhythm_game.GameSession(beatmap, clock)
+    session.seek(2000)
+
+    assert [(note.lane, note.start_time_ms, note.end_time_ms) for note in session.notes] == [(2, 1000, 3000)]
+    long_note = next(session.notes.iter_lane(2))
+    assert long_note.hit and not long_note.is_holding
+
+    # 本体は判定ラインを通り過ぎるまで残り、その後は MISS にならずに外れる
+    clock.start(session.start_ms)
+    clock.advance_to(2900)
+    session.run_logic_ticks(2900)
+    assert long_note in list(session.notes)
+    clock.advance_to(3100)
+    session.run_logic_ticks(3100)
+    assert long_note not in list(session.notes)
+    assert session.current_hp == rhythm_game.MAX_HP
+
+
+def test_headless_practice_ignores_presses_after_section(tmp_path):
+    # 区間 (0-1500ms) の終わりをまたぐロングノーツが判定されている間に、区間の外のノーツを押す入力が来る
+    beatmap = load_chart(tmp_path, "1000,0,3000\n2000,1\n2500,2\n")
+
+    result = rhythm_game.run_headless(beatmap, rhythm_game.autoplay_inputs(beatmap), practice=(0, 1500))
+
+    assert result['current_hp'] == rhythm_game.MAX_HP
+    assert result['score'] > 0
+    assert result['finished'] == 1
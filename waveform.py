@@ -0,0 +1,168 @@
+import array
+import os
+import struct
+import sys
+
+from typing import List, Optional, Tuple
+
+import pygame
+
+#  波形の概要 (ピークのミップマップ)
+# 曲の波形を、一定のサンプル数ごとの最小値・最大値 (ピーク) の列として持つ。
+# レベル0は WAVEFORM_BASE_BLOCK フレームごとのピークで、レベルが1つ上がるごとに隣り合う2つをまとめて半分の長さにする。
+# 表示するときは、1ピクセルあたりの時間に最も近いレベルを選べば、ズームの倍率に関係なく画面の幅の数だけ読めばよい。
+# 一度作ったピークは音楽ファイルの隣 (song.mp3.peaks) に保存し、次回からは音声をデコードせずに読み込む。
+#
+# ファイル形式 (全てリトルエンディアン):
+#   ヘッダ (32バイト): マジック b'RGWF', バージョン(uint16), レベル数(uint16), サンプリング周波数(uint32),
+#                      レベル0のフレーム数(uint32), 元ファイルのサイズ(uint64), 元ファイルの更新時刻ns(uint64)
+#   レベルごとに: ピーク数(uint32), 最小値(int16 × ピーク数), 最大値(int16 × ピーク数)
+
+WAVEFORM_MAGIC: bytes = b'RGWF'
+WAVEFORM_VERSION: int = 1
+WAVEFORM_HEADER_FORMAT: str = '<4sHHIIQQ'
+WAVEFORM_HEADER_SIZE: int = struct.calcsize(WAVEFORM_HEADER_FORMAT)
+WAVEFORM_EXTENSION: str = '.peaks'
+WAVEFORM_BASE_BLOCK: int = 128 # レベル0の1ピークあたりのフレーム数 (44.1kHz で約2.9ms)
+
+
+def peaks_path_for(song_path: str) -> str:
+    """音楽ファイルに対応するピークのキャッシュのパスを返します (song.mp3 -> song.mp3.peaks)。"""
+    return song_path + WAVEFORM_EXTENSION
+
+
+def _source_stamp(song_path: str) -> Tuple[int, int]:
+    stat = os.stat(song_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _little_endian(values: array.array) -> bytes:
+    if sys.byteorder != 'little':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_little_endian(typecode: str, data: bytes) -> array.array:
+    values = array.array(typecode, data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+class WaveformPeaks:
+    """
+    曲の波形のピークのミップマップ。levels[k] は (最小値の列, 最大値の列) で、
+    1ピークが WAVEFORM_BASE_BLOCK * 2**k フレームに対応する。
+    """
+    def __init__(self, sample_rate: int, levels: List[Tuple[array.array, array.array]]):
+        self.sample_rate: int = sample_rate
+        self.levels: List[Tuple[array.array, array.array]] = levels
+
+    @classmethod
+    def from_sound(cls, sound: pygame.mixer.Sound) -> 'WaveformPeaks':
+        """デコード済みの音声 (16bit のミキサー形式) からピークを計算します。"""
+        sample_rate, bit_format, channels = pygame.mixer.get_init()
+        if bit_format != -16:
+            raise ValueError(f"未対応のミキサーのサンプル形式です: {bit_format}")
+        samples = array.array('h', sound.get_raw())
+        block = WAVEFORM_BASE_BLOCK * channels # 全チャンネルをまとめて1つの波形として扱う
+        mins = array.array('h', (min(samples[i:i + block]) for i in range(0, len(samples), block)))
+        maxs = array.array('h', (max(samples[i:i + block]) for i in range(0, len(samples), block)))
+        levels = [(mins, maxs)]
+        while len(mins) > 1:
+            # 隣り合う2つのピークをまとめて、1つ上のレベルを作る (奇数個なら最後の1つはそのまま残す)
+            mins = array.array('h', map(min, mins[0::2], mins[1::2])) + mins[len(mins) - len(mins) % 2:]
+            maxs = array.array('h', map(max, maxs[0::2], maxs[1::2])) + maxs[len(maxs) - len(maxs) % 2:]
+            levels.append((mins, maxs))
+        return cls(sample_rate, levels)
+
+    @classmethod
+    def load(cls, path: str, song_path: str) -> 'WaveformPeaks':
+        """ピークのキャッシュを読み込みます。形式が違う・元の音楽ファイルが変わっている場合は ValueError を送出します。"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < WAVEFORM_HEADER_SIZE:
+            raise ValueError("ヘッダが短すぎます。")
+        magic, version, level_count, sample_rate, _, size, mtime_ns = struct.unpack_from(WAVEFORM_HEADER_FORMAT, data)
+        if magic != WAVEFORM_MAGIC or version != WAVEFORM_VERSION:
+            raise ValueError("ピークのキャッシュの形式が違います。")
+        if (size, mtime_ns) != _source_stamp(song_path):
+            raise ValueError("音楽ファイルが更新されています。")
+        levels = []
+        offset = WAVEFORM_HEADER_SIZE
+        for _ in range(level_count):
+            (count,) = struct.unpack_from('<I', data, offset)
+            offset += 4
+            mins = _from_little_endian('h', data[offset:offset + count * 2])
+            maxs = _from_little_endian('h', data[offset + count * 2:offset + count * 4])
+            if len(maxs) != count:
+                raise ValueError("ファイルが短すぎます。")
+            levels.append((mins, maxs))
+            offset += count * 4
+        return cls(sample_rate, levels)
+
+    def save(self, path: str, song_path: str) -> None:
+        """ピークをキャッシュとして保存します。書き込み途中のファイルが読まれないよう、一時ファイルに書いてから置き換えます。"""
+        size, mtime_ns = _source_stamp(song_path)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(struct.pack(WAVEFORM_HEADER_FORMAT, WAVEFORM_MAGIC, WAVEFORM_VERSION, len(self.levels),
+                                self.sample_rate, len(self.levels[0][0]), size, mtime_ns))
+            for mins, maxs in self.levels:
+                f.write(struct.pack('<I', len(mins)))
+                f.write(_little_endian(mins))
+                f.write(_little_endian(maxs))
+        os.replace(tmp_path, path)
+
+    def block_ms(self, level: int) -> float:
+        """指定レベルの1ピークあたりの時間 (ms) を返します。"""
+        return WAVEFORM_BASE_BLOCK * (1 << level) * 1000.0 / self.sample_rate
+
+    def level_for(self, ms_per_pixel: float) -> int:
+        """1ピクセルあたりの時間に対して、1ピークが1ピクセル以下になる最も粗いレベルを返します。"""
+        level = 0
+        while level + 1 < len(self.levels) and self.block_ms(level + 1) <= ms_per_pixel:
+            level += 1
+        return level
+
+    def column_peaks(self, start_ms: float, ms_per_pixel: float, width: int) -> List[Optional[Tuple[int, int]]]:
+        """
+        start_ms から1ピクセル ms_per_pixel ずつ、width 列分の (最小値, 最大値) を返します (曲の範囲外は None)。
+        選んだレベルでは1列が数ピーク分にしかならないので、処理量はズームの倍率に関係なく画面の幅に比例する。
+        """
+        level = self.level_for(ms_per_pixel)
+        mins, maxs = self.levels[level]
+        block_ms = self.block_ms(level)
+        columns: List[Optional[Tuple[int, int]]] = []
+        for x in range(width):
+            first = int((start_ms + x * ms_per_pixel) / block_ms)
+            last = max(first + 1, int((start_ms + (x + 1) * ms_per_pixel) / block_ms))
+            if first < 0 or first >= len(mins):
+                columns.append(None)
+                continue
+            columns.append((min(mins[first:last]), max(maxs[first:last])))
+        return columns
+
+
+def load_waveform_peaks(song_path: str) -> Optional[WaveformPeaks]:
+    """
+    音楽ファイルの波形のピークを返します。キャッシュがあればそれを読み、なければ音声をデコードして計算し保存します。
+    ミキサーが初期化されている必要があります。読み込めない場合は警告を表示して None を返します。
+    """
+    cache_path = peaks_path_for(song_path)
+    if os.path.exists(cache_path):
+        try:
+            return WaveformPeaks.load(cache_path, song_path)
+        except (OSError, ValueError, struct.error) as e:
+            print(f"警告: 波形のキャッシュを読み込めませんでした。作り直します。{e}")
+    try:
+        peaks = WaveformPeaks.from_sound(pygame.mixer.Sound(song_path))
+    except (pygame.error, FileNotFoundError, ValueError) as e:
+        print(f"警告: 波形を表示できません。{e}")
+        return None
+    try:
+        peaks.save(cache_path, song_path)
+    except OSError as e:
+        print(f"警告: 波形のキャッシュを保存できませんでした。{e}")
+    return peaks